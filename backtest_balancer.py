@@ -0,0 +1,348 @@
+# =========================================================================
+# ========== БЭКТЕСТ БАЛАНСИРОВЩИКА НА ИСТОРИИ ИГР ==========
+# =========================================================================
+#
+# Проигрывает все сохраненные игры (games + player_game_stats) по порядку
+# и для каждой восстанавливает статистику игроков такой, какой она была
+# ДО этой игры (WR, сыгранные роли и WR на них). Затем для каждой
+# конфигурации весов balancer.py считает "перевес" Radiant над Dire
+# в реальном составе и сравнивает прогноз с реальным результатом.
+#
+# Итог — метрики калибровки на конфигурацию (log-loss, Brier, точность,
+# ECE и таблица надежности), чтобы менять веса по данным, а не наугад.
+# Наклон калибровки подбирается на ранних играх, а метрики считаются на
+# более поздних (отложенных), которые при подборе не участвовали.
+#
+# Запуск:  python backtest_balancer.py                      (история из DATABASE_URL)
+#          python backtest_balancer.py --dump history.json  (сохранить историю и выйти)
+#          python backtest_balancer.py --from-json history.json --workers 4 \
+#              --config roles_x3:ROLE_FIT_WEIGHT=60 --out backtest.json
+#
+# MMR в истории не хранится, поэтому берется текущий players.mmr.
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+
+import balancer
+
+# Веса balancer.py, которые можно менять в конфигурациях
+TUNABLE_WEIGHTS = (
+    "COMPOSITION_DEFICIT_WEIGHT", "ROLE_SATURATION_WEIGHT", "MMR_WR_WEIGHT",
+    "ROLE_CONFLICT_WEIGHT", "ROLE_FIT_WEIGHT", "OFF_ROLE_WEIGHT", "ROLE_WR_PRIOR_GAMES",
+)
+DEFAULT_WEIGHTS = {name: getattr(balancer, name) for name in TUNABLE_WEIGHTS}
+
+# Готовые конфигурации: отличия от текущих весов
+BACKTEST_PRESETS = {
+    "current": {},
+    "v5": {"ROLE_FIT_WEIGHT": 0.0, "OFF_ROLE_WEIGHT": 0.0},
+    "mmr_wr_only": {
+        "COMPOSITION_DEFICIT_WEIGHT": 0.0, "ROLE_SATURATION_WEIGHT": 0.0,
+        "ROLE_CONFLICT_WEIGHT": 0.0, "ROLE_FIT_WEIGHT": 0.0, "OFF_ROLE_WEIGHT": 0.0,
+    },
+    "roles_heavy": {"ROLE_FIT_WEIGHT": 60.0},
+}
+
+# Сколько игр отдаем одному процессу за раз
+GAMES_PER_TASK = 50
+# Корзины для таблицы надежности и ECE
+CALIBRATION_BINS = 10
+# Доля ранних игр (по времени), на которых подбирается наклон; метрики - на остальных
+TRAIN_FRACTION = 0.7
+
+
+# ----- ЗАГРУЗКА ИСТОРИИ -----
+
+def load_history_from_db(dsn):
+    """
+    Вся история одним проходом: игры по порядку (date, time, id), строки
+    player_game_stats и текущий MMR игроков. psycopg2 нужен только здесь.
+    """
+    import psycopg2
+    conn = psycopg2.connect(dsn, sslmode=os.getenv('PGSSLMODE', 'require'))
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT id, radiant_players, dire_players, result FROM games ORDER BY date, time, id')
+            games = cur.fetchall()
+            cur.execute('SELECT game_id, player_nickname, team, position FROM player_game_stats ORDER BY game_id, id')
+            stats = cur.fetchall()
+            cur.execute('SELECT nickname, mmr FROM players')
+            mmr = dict(cur.fetchall())
+    finally:
+        conn.close()
+
+    rows_by_game = {}
+    for game_id, nickname, team, position in stats:
+        rows_by_game.setdefault(game_id, []).append([nickname, team, position or 0])
+    history = []
+    for game_id, radiant_str, dire_str, result in games:
+        rows = rows_by_game.get(game_id)
+        if not rows:
+            # Старые игры без player_game_stats: составы только из строк games
+            rows = [[nick, "radiant", 0] for nick in _split_names(radiant_str)] + \
+                   [[nick, "dire", 0] for nick in _split_names(dire_str)]
+        history.append({"id": game_id, "result": result, "players": rows})
+    return {"games": history, "mmr": mmr}
+
+
+def _split_names(players_str):
+    return [name.strip() for name in (players_str or "").split(",") if name.strip()]
+
+
+# ----- ВОССТАНОВЛЕНИЕ СТАТИСТИКИ "ДО ИГРЫ" -----
+
+def build_snapshots(history):
+    """
+    Идет по играм по порядку и перед каждой собирает player_data обеих
+    команд из накопленной к этому моменту статистики; после — учитывает
+    результат игры. Игры без победителя или с пустой командой пропускаются.
+    """
+    mmr = history["mmr"]
+    records = {}  # nickname -> {"wins", "losses", "roles": {позиция: [wins, losses]}}
+    snapshots = []
+    for game in history["games"]:
+        teams = {"radiant": [], "dire": []}
+        for nickname, team, position in game["players"]:
+            if team in teams:
+                teams[team].append((nickname, position))
+        if game["result"] not in teams or not teams["radiant"] or not teams["dire"]:
+            continue
+
+        snapshot = {"id": game["id"], "result": game["result"]}
+        for team, members in teams.items():
+            snapshot[team] = [_player_before_game(nickname, records, mmr) for nickname, _ in members]
+        snapshots.append(snapshot)
+
+        for team, members in teams.items():
+            won = team == game["result"]
+            for nickname, position in members:
+                rec = records.setdefault(nickname, {"wins": 0, "losses": 0, "roles": {}})
+                rec["wins" if won else "losses"] += 1
+                if position > 0:
+                    role = rec["roles"].setdefault(position, [0, 0])
+                    role[0 if won else 1] += 1
+    return snapshots
+
+
+def _player_before_game(nickname, records, mmr):
+    rec = records.get(nickname, {"wins": 0, "losses": 0, "roles": {}})
+    total = rec["wins"] + rec["losses"]
+    played = sorted(rec["roles"].items(), key=lambda item: sum(item[1]), reverse=True)
+    return {
+        'nickname': nickname,
+        'mmr': mmr.get(nickname, 0),
+        'wr': round(rec["wins"] / total * 100, 1) if total > 0 else 0,
+        'positions': [pos for pos, (w, l) in played if w + l > 0],
+        'role_records': {pos: (w, l) for pos, (w, l) in played if w + l > 0},
+    }
+
+
+# ----- ПРОГНОЗ ДЛЯ ОДНОЙ ИГРЫ -----
+
+def _role_penalty(team):
+    """Ролевая часть score_team (цели = суммы самой команды, поэтому MMR/WR-часть равна 0)."""
+    return balancer.score_team(team, sum(p['mmr'] for p in team), sum(p['wr'] for p in team))
+
+
+def evaluate_game(snapshot):
+    """
+    Перевес Radiant (edge > 0 — сильнее Radiant) по текущим весам balancer.py:
+    MMR/WR-преимущество со знаком минус разница ролевых штрафов и штрафов
+    расстановки. balance — штраф реального разбиения (чем меньше, тем ровнее).
+    """
+    radiant, dire = snapshot["radiant"], snapshot["dire"]
+    target_mmr, target_wr = balancer.get_targets(radiant + dire)
+    mmr_adv = (sum(p['mmr'] for p in radiant) - sum(p['mmr'] for p in dire)) / target_mmr if target_mmr > 0 else 0
+    wr_adv = (sum(p['wr'] for p in radiant) - sum(p['wr'] for p in dire)) / target_wr if target_wr > 0 else 0
+
+    radiant_assignment = balancer.assignment_cost([balancer.position_costs(p) for p in radiant])
+    dire_assignment = balancer.assignment_cost([balancer.position_costs(p) for p in dire])
+    edge = balancer.MMR_WR_WEIGHT * (mmr_adv + wr_adv) \
+        - (_role_penalty(radiant) + radiant_assignment) \
+        + (_role_penalty(dire) + dire_assignment)
+    balance = balancer.score_team(radiant, target_mmr, target_wr) + radiant_assignment + dire_assignment
+    return {"id": snapshot["id"], "edge": edge, "balance": balance, "radiant_won": snapshot["result"] == "radiant"}
+
+
+def _evaluate_chunk(task):
+    """Задача для процесса: выставляет веса конфигурации и считает свою пачку игр."""
+    weights, chunk = task
+    for name, value in weights.items():
+        setattr(balancer, name, value)
+    return [evaluate_game(snapshot) for snapshot in chunk]
+
+
+# ----- МЕТРИКИ КАЛИБРОВКИ -----
+
+def _sigmoid(x):
+    if x >= 0:
+        return 1.0 / (1.0 + math.exp(-x))
+    z = math.exp(x)
+    return z / (1.0 + z)
+
+
+def _log_loss(games, slope):
+    total = 0.0
+    for g in games:
+        p = min(max(_sigmoid(slope * g["edge"]), 1e-12), 1 - 1e-12)
+        total -= math.log(p if g["radiant_won"] else 1 - p)
+    return total / len(games)
+
+
+def fit_slope(games):
+    """
+    Platt scaling с одним параметром: P(Radiant) = sigmoid(slope * edge).
+    Перевес — в единицах очков балансировщика, поэтому наклон подбирается
+    по сетке. Наклон не отрицательный: если перевес предсказывает "наоборот",
+    лучшим будет 0 (монетка), а не перевернутый прогноз.
+    """
+    grid = [0.0] + [10 ** (k / 20.0) for k in range(-100, 21)]
+    return min(grid, key=lambda slope: _log_loss(games, slope))
+
+
+def split_train_holdout(games, train_fraction=TRAIN_FRACTION):
+    """
+    Игры идут по времени: ранние - для подбора наклона, поздние - для метрик.
+    На совсем короткой истории (нечего отложить) обе части - вся история.
+    """
+    cut = int(len(games) * train_fraction)
+    if cut < 1 or cut >= len(games):
+        return games, games
+    return games[:cut], games[cut:]
+
+
+def calibration_metrics(games, train_fraction=TRAIN_FRACTION):
+    """
+    log-loss, Brier, точность по знаку перевеса, ECE и таблица надежности
+    на отложенных играх; наклон подбирается только на ранних.
+    """
+    train, games = split_train_holdout(games, train_fraction)
+    slope = fit_slope(train)
+    probs = [_sigmoid(slope * g["edge"]) for g in games]
+    outcomes = [1.0 if g["radiant_won"] else 0.0 for g in games]
+
+    bins = [[] for _ in range(CALIBRATION_BINS)]
+    for p, y in zip(probs, outcomes):
+        bins[min(int(p * CALIBRATION_BINS), CALIBRATION_BINS - 1)].append((p, y))
+    reliability, ece = [], 0.0
+    for items in bins:
+        if not items:
+            continue
+        mean_p = sum(p for p, _ in items) / len(items)
+        rate = sum(y for _, y in items) / len(items)
+        ece += len(items) / len(games) * abs(mean_p - rate)
+        reliability.append({"predicted": round(mean_p, 4), "actual": round(rate, 4), "games": len(items)})
+
+    decided = [(g["edge"] > 0) == g["radiant_won"] for g in games if g["edge"] != 0]
+    return {
+        "games": len(games),
+        "train_games": len(train),
+        "radiant_win_rate": round(sum(outcomes) / len(games), 4),
+        "slope": slope,
+        "log_loss": round(_log_loss(games, slope), 5),
+        "log_loss_coin": round(math.log(2), 5),
+        "brier": round(sum((p - y) ** 2 for p, y in zip(probs, outcomes)) / len(games), 5),
+        "accuracy": round(sum(decided) / len(decided), 4) if decided else None,
+        "ece": round(ece, 5),
+        "mean_balance": round(sum(g["balance"] for g in games) / len(games), 3),
+        "reliability": reliability,
+    }
+
+
+# ----- ЗАПУСК -----
+
+def parse_config(spec):
+    """'name' (готовая) или 'name:KEY=VAL,KEY=VAL' (отличия от текущих весов)."""
+    name, _, body = spec.partition(":")
+    if not body:
+        if name not in BACKTEST_PRESETS:
+            raise ValueError(f"Неизвестная конфигурация {name!r}, есть: {', '.join(BACKTEST_PRESETS)}")
+        return name, dict(BACKTEST_PRESETS[name])
+    overrides = {}
+    for item in body.split(","):
+        key, _, value = item.partition("=")
+        key = key.strip().upper()
+        if key not in TUNABLE_WEIGHTS:
+            raise ValueError(f"Неизвестный вес {key!r}, есть: {', '.join(TUNABLE_WEIGHTS)}")
+        overrides[key] = float(value)
+    return name, overrides
+
+
+def run_backtest(snapshots, configs, workers, train_fraction=TRAIN_FRACTION):
+    """
+    Для каждой конфигурации считает все игры в пуле процессов и метрики калибровки.
+    pool.map сохраняет порядок пачек, поэтому игры остаются в порядке истории.
+    """
+    chunks = [snapshots[i:i + GAMES_PER_TASK] for i in range(0, len(snapshots), GAMES_PER_TASK)]
+    report = {}
+    with multiprocessing.Pool(processes=workers) as pool:
+        for name, overrides in configs:
+            weights = dict(DEFAULT_WEIGHTS, **overrides)
+            started = time.perf_counter()
+            games = [g for part in pool.map(_evaluate_chunk, [(weights, chunk) for chunk in chunks]) for g in part]
+            report[name] = dict(calibration_metrics(games, train_fraction), weights=weights,
+                                seconds=round(time.perf_counter() - started, 3))
+    return report
+
+
+def print_report(report):
+    print(f"{'конфигурация':>14} | {'игр':>5} | {'log-loss':>8} | {'Brier':>7} | {'точность':>8} | {'ECE':>7} | наклон")
+    for name, m in sorted(report.items(), key=lambda item: item[1]["log_loss"]):
+        accuracy = f"{m['accuracy'] * 100:>7.1f}%" if m["accuracy"] is not None else f"{'-':>8}"
+        print(f"{name:>14} | {m['games']:>5} | {m['log_loss']:>8.4f} | {m['brier']:>7.4f} | {accuracy} | "
+              f"{m['ece']:>7.4f} | {m['slope']:.4g}")
+    print(f"(метрики на отложенных поздних играх, наклон подобран на ранних; "
+          f"монетка: log-loss {math.log(2):.4f}, Brier 0.25)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бэктест весов балансировщика на истории игр")
+    parser.add_argument("--from-json", help="история из файла (см. --dump) вместо БД")
+    parser.add_argument("--dump", help="сохранить историю из БД в JSON и выйти")
+    parser.add_argument("--config", action="append", default=[],
+                        help="конфигурация: имя готовой или name:KEY=VAL,KEY=VAL (можно несколько)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--train-fraction", type=float, default=TRAIN_FRACTION,
+                        help="доля ранних игр для подбора наклона (метрики - на остальных)")
+    parser.add_argument("--out", help="куда записать метрики в JSON")
+    args = parser.parse_args(argv)
+
+    if args.from_json:
+        with open(args.from_json, encoding="utf-8") as f:
+            history = json.load(f)
+    else:
+        dsn = os.getenv('DATABASE_URL')
+        if not dsn:
+            print("❌ DATABASE_URL не задан (или используйте --from-json).")
+            return 1
+        history = load_history_from_db(dsn)
+    if args.dump:
+        with open(args.dump, "w", encoding="utf-8") as f:
+            json.dump(history, f, ensure_ascii=False)
+        print(f"💾 История ({len(history['games'])} игр) записана в {args.dump}")
+        return 0
+
+    configs = [parse_config(spec) for spec in args.config] or \
+              [(name, dict(overrides)) for name, overrides in BACKTEST_PRESETS.items()]
+    snapshots = build_snapshots(history)
+    if not snapshots:
+        print("❌ Нет игр с результатом и обеими командами.")
+        return 1
+    print(f"🔁 Игр в бэктесте: {len(snapshots)}, конфигураций: {len(configs)}, процессов: {args.workers}")
+
+    report = run_backtest(snapshots, configs, args.workers, args.train_fraction)
+    print_report(report)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 Метрики записаны в {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
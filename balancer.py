@@ -0,0 +1,896 @@
+# =========================================================================
+# ========== БАЛАНСИРОВЩИК КОМАНД (ЧИСТАЯ ЛОГИКА, БЕЗ БД И TELEGRAM) ==========
+# =========================================================================
+#
+# Модуль ничего не знает про Postgres и бота: на вход получает уже
+# собранный `player_data` (список словарей с 'nickname', 'mmr', 'wr',
+# 'positions', ...), на выход отдает разбиение на две команды.
+# Поэтому его можно гонять в бенчмарках и проверках без БД.
+
+import heapq
+import itertools
+import math
+import random
+import time
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:  # numpy не обязателен: без него работает чистый Python
+    np = None
+
+# --- Веса для очков (v5) ---
+MAX_ROLE_PLAYERS = 3                # Максимум 3 игрока могут иметь одну позицию как реальную
+
+COMPOSITION_DEFICIT_WEIGHT = 1000.0 # Штраф за отсутствие 1/2/3/4/5
+ROLE_SATURATION_WEIGHT = 5000.0     # Критический штраф за переизбыток (> 3)
+MMR_WR_WEIGHT = 200.0               # Вес MMR/WR
+ROLE_CONFLICT_WEIGHT = 5.0          # Штраф за минимальный конфликт (2 или 3 игрока)
+REQUIRED_ROLES = {1, 2, 3, 4, 5}
+
+# --- Расстановка по позициям 1-5 (v7) ---
+LINEUP_POSITIONS = tuple(sorted(REQUIRED_ROLES))
+ROLE_FIT_WEIGHT = 20.0              # Вес (1 - WR игрока на назначенной позиции)
+OFF_ROLE_WEIGHT = 500.0             # Штраф за игрока на позиции, где у него нет ни одной игры
+ROLE_WR_PRIOR_GAMES = 4             # Сглаживание WR роли: столько "виртуальных" игр с WR 50%
+_FULL_POSITIONS_MASK = (1 << len(LINEUP_POSITIONS)) - 1
+
+# Бюджет времени по умолчанию для точного поиска (секунды).
+# Если он исчерпан, возвращается лучшее найденное разбиение (exact=False).
+DEFAULT_TIME_BUDGET = 2.0
+
+# Сколько лучших разных разбиений держать для кнопки "другой вариант"
+DEFAULT_TOP_K = 1
+
+# Погрешность сравнения нижней границы с лучшим счетом (защита от округления float)
+_BOUND_EPS = 1e-9
+
+
+def get_targets(player_data):
+    """Целевые суммы MMR и WR для одной команды (половина от общих)."""
+    total_mmr = sum(p['mmr'] for p in player_data)
+    total_wr = sum(p['wr'] for p in player_data)
+    return total_mmr / 2.0, total_wr / 2.0
+
+
+def score_team(team_players, target_mmr, target_wr):
+    """
+    УМНЫЙ БАЛАНС v5: считает "штраф" команды.
+    Жесткий лимит на количество игроков одной позиции (максимум 3 из 5),
+    приоритет покрытия всех 5 слотов, затем баланс MMR/WR.
+    Чем меньше результат, тем лучше разбиение.
+    """
+    # --- 1. Считаем MMR/WR score ---
+    team1_mmr_sum = sum(p['mmr'] for p in team_players)
+    team1_wr_sum = sum(p['wr'] for p in team_players)
+
+    mmr_diff = abs(team1_mmr_sum - target_mmr)
+    wr_diff = abs(team1_wr_sum - target_wr)
+
+    mmr_norm_diff = (mmr_diff / target_mmr) if target_mmr > 0 else 0
+    wr_norm_diff = (wr_diff / target_wr) if target_wr > 0 else 0
+
+    mmr_wr_score = (mmr_norm_diff + wr_norm_diff) if target_mmr > 0 and target_wr > 0 else (mmr_norm_diff or wr_norm_diff)
+
+    # --- 2. Считаем Role Conflict score & Saturation Penalty ---
+    all_roles = []
+    for p in team_players:
+        player_roles = p['positions']
+        if player_roles:
+            all_roles.extend(player_roles)
+
+    role_counts = Counter(all_roles)
+    role_conflict_score = 0
+    saturation_penalty = 0
+
+    for role_id, role_count in role_counts.items():
+        if role_count > MAX_ROLE_PLAYERS:
+            # 🔴 КРИТИЧЕСКИЙ ШТРАФ: 4 или 5 саппортов сразу делают команду неоптимальной
+            saturation_penalty += (role_count - MAX_ROLE_PLAYERS)
+
+        if role_count > 1 and role_count <= MAX_ROLE_PLAYERS:
+            # Небольшой штраф за 2-3 игрока (не идеальный состав, но допустимый)
+            role_conflict_score += (role_count - 1)
+
+    # --- 3. Считаем Composition Coverage score (ШТРАФ ЗА ОТСУТСТВИЕ СЛОТОВ) ---
+    covered_roles = set(role_counts.keys())
+    composition_coverage_penalty = len(REQUIRED_ROLES - covered_roles)
+
+    # --- 4. Итоговый score (SATURATION > COMPOSITION > MMR/WR) ---
+    return (ROLE_SATURATION_WEIGHT * saturation_penalty) + \
+           (COMPOSITION_DEFICIT_WEIGHT * composition_coverage_penalty) + \
+           (ROLE_CONFLICT_WEIGHT * role_conflict_score) + \
+           (MMR_WR_WEIGHT * mmr_wr_score)
+
+
+def position_costs(player):
+    """
+    Штраф игрока на каждой из позиций 1-5 (кортеж из 5 чисел, меньше = лучше).
+    Позиция с играми: ROLE_FIT_WEIGHT * (1 - сглаженный WR на этой роли).
+    Позиция без игр: OFF_ROLE_WEIGHT.
+    'role_records' = {позиция: (wins, losses)}; если его нет, позиции
+    из 'positions' считаются сыгранными с WR 50%.
+    """
+    records = player.get('role_records')
+    if records is None:
+        records = {pos: (0, 0) for pos in player['positions'] or []}
+    costs = []
+    for pos in LINEUP_POSITIONS:
+        record = records.get(pos)
+        if record is None:
+            costs.append(OFF_ROLE_WEIGHT)
+        else:
+            wins, losses = record
+            fit = (wins + ROLE_WR_PRIOR_GAMES * 0.5) / (wins + losses + ROLE_WR_PRIOR_GAMES)
+            costs.append(ROLE_FIT_WEIGHT * (1.0 - fit))
+    return tuple(costs)
+
+
+# Переходы DP расстановки, сгруппированные по числу уже занятых позиций:
+# [занято] -> ((маска, позиция, новая маска), ...)
+_POSITION_TRANSITIONS = tuple(
+    tuple((mask, bit, mask | (1 << bit))
+          for mask in range(_FULL_POSITIONS_MASK + 1) if bin(mask).count("1") == taken
+          for bit in range(len(LINEUP_POSITIONS)) if not mask >> bit & 1)
+    for taken in range(len(LINEUP_POSITIONS))
+)
+
+
+def assignment_cost(cost_rows):
+    """
+    Точная расстановка одной команды по позициям: DP по маске занятых
+    позиций (32 состояния), игроки по очереди. Если игроков больше 5,
+    лишние остаются в запасе; если меньше, заняты не все позиции.
+    cost_rows: position_costs каждого игрока. Возвращает минимальный штраф.
+    """
+    slots = len(LINEUP_POSITIONS)
+    allow_bench = len(cost_rows) > slots
+    inf = float("inf")
+    dp = [inf] * (_FULL_POSITIONS_MASK + 1)
+    dp[0] = 0.0
+    for step, costs in enumerate(cost_rows):
+        nxt = dp[:] if allow_bench else [inf] * (_FULL_POSITIONS_MASK + 1)
+        # После `step` игроков достижимы маски ровно с `step` позициями (с запасом — не больше)
+        for taken in range(0 if allow_bench else step, min(step, slots - 1) + 1):
+            for mask, bit, new_mask in _POSITION_TRANSITIONS[taken]:
+                candidate = dp[mask] + costs[bit]
+                if candidate < nxt[new_mask]:
+                    nxt[new_mask] = candidate
+        dp = nxt
+    return dp[_FULL_POSITIONS_MASK] if allow_bench else min(dp)
+
+
+def assign_positions(team_players):
+    """
+    То же DP, что в assignment_cost, но с восстановлением ответа:
+    список позиций (1-5) по игрокам команды, None = запас.
+    """
+    allow_bench = len(team_players) > len(LINEUP_POSITIONS)
+    dp = {0: (0.0, ())}
+    for p in team_players:
+        costs = position_costs(p)
+        nxt = {mask: (value, path + (None,)) for mask, (value, path) in dp.items()} if allow_bench else {}
+        for mask, (value, path) in dp.items():
+            for bit, cost in enumerate(costs):
+                if mask >> bit & 1:
+                    continue
+                new_mask = mask | (1 << bit)
+                candidate = value + cost
+                old = nxt.get(new_mask)
+                if old is None or candidate < old[0]:
+                    nxt[new_mask] = (candidate, path + (LINEUP_POSITIONS[bit],))
+        dp = nxt
+    if allow_bench:
+        return list(dp[_FULL_POSITIONS_MASK][1])
+    return list(min(dp.values(), key=lambda item: item[0])[1])
+
+
+def _split_score(player_data, pos_costs, team, target_mmr, target_wr):
+    """
+    Полный штраф разбиения (v7): score_team первой команды (индексы `team`
+    по возрастанию) плюс штраф лучшей расстановки по позициям в обеих командах.
+    """
+    chosen = set(team)
+    return score_team([player_data[i] for i in team], target_mmr, target_wr) + \
+           assignment_cost([pos_costs[i] for i in team]) + \
+           assignment_cost([costs for i, costs in enumerate(pos_costs) if i not in chosen])
+
+
+def _assignment_lower_bound(pos_costs, team_size, other_size):
+    """
+    Нижняя граница суммарного штрафа расстановки для любого разбиения:
+    если обе команды не меньше 5, каждую позицию занимают двое разных игроков,
+    поэтому это оптимальное заполнение 10 слотов (по 2 на позицию) всем ростером.
+    DP по счетчикам занятых слотов (3^5 состояний). Для маленьких лобби 0.
+    """
+    slots = len(LINEUP_POSITIONS)
+    if min(team_size, other_size) < slots:
+        return 0.0
+    dp = {(0,) * slots: 0.0}
+    for costs in pos_costs:
+        nxt = dict(dp)
+        for state, value in dp.items():
+            for bit, cost in enumerate(costs):
+                if state[bit] >= 2:
+                    continue
+                new_state = state[:bit] + (state[bit] + 1,) + state[bit + 1:]
+                candidate = value + cost
+                if candidate < nxt.get(new_state, float("inf")):
+                    nxt[new_state] = candidate
+        dp = nxt
+    return dp[(2,) * slots]
+
+
+def _with_positions(team_players):
+    """Копии игроков команды с назначенной позицией 'assigned_pos' (None = запас)."""
+    return [dict(p, assigned_pos=pos) for p, pos in zip(team_players, assign_positions(team_players))]
+
+
+def _make_result(player_data, top, evaluated, exact):
+    """
+    Собирает словарь результата из TopSplits: лучший вариант в radiant/dire/score,
+    все K вариантов (лучший первым) в alternatives. У игроков проставлена
+    назначенная позиция 'assigned_pos'.
+    """
+    alternatives = []
+    for score, team in top.results():
+        chosen = set(team)
+        alternatives.append({
+            "radiant": _with_positions([player_data[i] for i in sorted(chosen)]),
+            "dire": _with_positions([p for i, p in enumerate(player_data) if i not in chosen]),
+            "score": score,
+        })
+    best = alternatives[0]
+    return {
+        "radiant": best["radiant"],
+        "dire": best["dire"],
+        "score": best["score"],
+        "alternatives": alternatives,
+        "evaluated": evaluated,
+        "exact": exact,
+    }
+
+
+class TopSplits:
+    """
+    Ограниченная куча из K лучших РАЗНЫХ разбиений.
+
+    Разбиение и оно же с поменянными сторонами считаются одним вариантом,
+    остается сторона с лучшим счетом. Порядок вариантов (score, team) тот же,
+    что у перебора: при равном счете раньше идет комбинация, которую
+    itertools.combinations выдает первой. На вершине кучи лежит худший вариант.
+    """
+
+    def __init__(self, k, n):
+        self.k = max(1, k)
+        self.full_mask = (1 << n) - 1
+        self.symmetric = n % 2 == 0  # при нечетном n стороны разного размера
+        self.heap = []     # (-score, team с обратным порядком, team, key)
+        self.members = {}  # key -> запись кучи
+
+    def _key(self, team):
+        mask = 0
+        for i in team:
+            mask |= 1 << i
+        return min(mask, self.full_mask ^ mask) if self.symmetric else mask
+
+    def threshold(self):
+        """Счет, который нужно побить, чтобы попасть в кучу (inf, пока она не полна)."""
+        if len(self.heap) < self.k:
+            return float('inf')
+        return -self.heap[0][0]
+
+    def best(self):
+        score, team = min((-item[0], item[2]) for item in self.heap)
+        return team, score
+
+    def push(self, team, score):
+        """Добавляет вариант, если он входит в K лучших. Возвращает True, если добавлен."""
+        key = self._key(team)
+        item = (-score, tuple(-i for i in team), team, key)
+        old = self.members.get(key)
+        if old is not None:
+            if (score, team) >= (-old[0], old[2]):
+                return False
+            self.heap.remove(old)
+            heapq.heapify(self.heap)
+        elif len(self.heap) >= self.k:
+            worst = self.heap[0]
+            if (score, team) >= (-worst[0], worst[2]):
+                return False
+            del self.members[heapq.heappop(self.heap)[3]]
+        heapq.heappush(self.heap, item)
+        self.members[key] = item
+        return True
+
+    def results(self):
+        """[(score, team)] от лучшего к худшему."""
+        return sorted((-item[0], item[2]) for item in self.heap)
+
+
+def balance_brute_force(player_data, top_k=DEFAULT_TOP_K, time_budget=None):
+    """
+    Старый полный перебор всех itertools.combinations (эталон для проверок
+    и бенчмарков). Годится только для маленьких лобби.
+    time_budget (сек, None - без ограничения): по его исчерпании перебор
+    останавливается и возвращает лучшее найденное с exact=False.
+    """
+    top = TopSplits(top_k, len(player_data))
+    if len(player_data) < 2:
+        top.push((), 0.0)
+        return _make_result(player_data, top, 0, True)
+
+    team_size = len(player_data) // 2
+    target_mmr, target_wr = get_targets(player_data)
+    pos_costs = [position_costs(p) for p in player_data]
+    deadline = (time.monotonic() + time_budget) if time_budget else None
+
+    evaluated = 0
+    exact = True
+    for team1 in itertools.combinations(range(len(player_data)), team_size):
+        if deadline is not None and evaluated & 1023 == 0 and evaluated and time.monotonic() > deadline:
+            exact = False
+            break
+        evaluated += 1
+        total_score = _split_score(player_data, pos_costs, team1, target_mmr, target_wr)
+        if total_score <= top.threshold():
+            top.push(team1, total_score)
+
+    return _make_result(player_data, top, evaluated, exact)
+
+
+def _role_cost(count):
+    """Взвешенный штраф одной роли при `count` игроках с ней (conflict + saturation)."""
+    if count > MAX_ROLE_PLAYERS:
+        return ROLE_SATURATION_WEIGHT * (count - MAX_ROLE_PLAYERS)
+    if count > 1:
+        return ROLE_CONFLICT_WEIGHT * (count - 1)
+    return 0.0
+
+
+def _seed_split(player_data, pos_costs, team_size, target_mmr, target_wr):
+    """
+    Быстрое стартовое решение для отсечений: "змейка" по MMR
+    и жадные обмены игроков между командами, пока счет улучшается.
+    """
+    n = len(player_data)
+    order = sorted(range(n), key=lambda i: -player_data[i]['mmr'])
+    team = set()
+    for rank, i in enumerate(order):
+        if len(team) < team_size and rank % 4 in (0, 3):
+            team.add(i)
+    for i in order:
+        if len(team) >= team_size:
+            break
+        team.add(i)
+
+    def _score(indices):
+        return _split_score(player_data, pos_costs, tuple(sorted(indices)), target_mmr, target_wr)
+
+    best = _score(team)
+    improved = True
+    while improved:
+        improved = False
+        for a in sorted(team):
+            for b in range(n):
+                if b in team:
+                    continue
+                candidate = (team - {a}) | {b}
+                score = _score(candidate)
+                if score < best:
+                    team, best = candidate, score
+                    improved = True
+                    break
+            if improved:
+                break
+    return tuple(sorted(team)), best
+
+
+def _search(player_data, pos_costs, order, team_size, target_mmr, target_wr, top, lex_mode, deadline, stats):
+    """
+    Один проход ветвей и границ по игрокам в порядке `order`.
+
+    Обычный режим (lex_mode=False) складывает в `top` (TopSplits) все листья,
+    которые строго лучше худшего из K вариантов.
+    Лексикографический режим (lex_mode=True) обходит игроков в исходном
+    порядке, т.е. листья идут в том же порядке, что и у itertools.combinations,
+    и ищет самую раннюю комбинацию со счетом не хуже лучшего в `top`.
+    """
+    n = len(order)
+    # Расстановка по позициям считается только в листьях; в границу идет ее общий минимум
+    assignment_floor = _assignment_lower_bound(pos_costs, team_size, n - team_size)
+    mmrs = [player_data[i]['mmr'] for i in order]
+    wrs = [player_data[i]['wr'] for i in order]
+
+    # Роли -> биты; у каждого игрока список (бит, сколько раз роль встречается)
+    role_bits = {}
+    player_roles = []
+    player_masks = []
+    for i in order:
+        counts = Counter(player_data[i]['positions'] or [])
+        entries = []
+        mask = 0
+        for role_id, cnt in counts.items():
+            bit = role_bits.setdefault(role_id, len(role_bits))
+            entries.append((bit, cnt))
+            mask |= 1 << bit
+        player_roles.append(entries)
+        player_masks.append(mask)
+    required_mask = 0
+    for role_id in REQUIRED_ROLES:
+        bit = role_bits.setdefault(role_id, len(role_bits))
+        required_mask |= 1 << bit
+
+    # Нижняя граница штрафа роли: минимум _role_cost по всем будущим значениям счетчика
+    max_count = sum(cnt for entries in player_roles for _, cnt in entries) + 1
+    min_future_cost = [min(_role_cost(c) for c in range(start, max_count + 1)) for start in range(max_count + 1)]
+
+    # Суффиксные объединения ролей и суммы k наименьших/наибольших MMR/WR
+    suffix_union = [0] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        suffix_union[i] = suffix_union[i + 1] | player_masks[i]
+
+    def _k_sums(values):
+        lo_table, hi_table = [], []
+        for i in range(n + 1):
+            tail = sorted(values[i:])
+            lo, hi = [0], [0]
+            for k in range(len(tail)):
+                lo.append(lo[-1] + tail[k])
+                hi.append(hi[-1] + tail[-1 - k])
+            lo_table.append(lo)
+            hi_table.append(hi)
+        return lo_table, hi_table
+
+    mmr_lo, mmr_hi = _k_sums(mmrs)
+    wr_lo, wr_hi = _k_sums(wrs)
+    # Сколько вхождений ролей минимум добавят еще k игроков из хвоста
+    sizes_lo, _ = _k_sums([sum(cnt for _, cnt in entries) for entries in player_roles])
+    role_count_range = range(len(role_bits))
+
+    # Переход через лимит (MAX_ROLE_PLAYERS -> +1) стоит меньше ROLE_SATURATION_WEIGHT:
+    # уже набранный conflict-штраф роли при этом обнуляется
+    crossing_cost = _role_cost(MAX_ROLE_PLAYERS + 1) - _role_cost(MAX_ROLE_PLAYERS)
+
+    def _forced_role_cost(extra):
+        """
+        Минимальный дополнительный штраф, если раскидать `extra` вхождений ролей
+        по ролям самым дешевым образом: сначала в пустые роли (бесплатно),
+        потом до лимита MAX_ROLE_PLAYERS (conflict), потом по одному переходу
+        через лимит на роль (crossing_cost), остальное в saturation.
+        Приращения _role_cost не убывают, поэтому это точный минимум.
+        """
+        if extra <= 0:
+            return 0.0
+        free = conflict = crossing = 0
+        for bit in role_count_range:
+            c = role_counts[bit]
+            if c == 0:
+                free += 1
+            if c < MAX_ROLE_PLAYERS:
+                conflict += MAX_ROLE_PLAYERS - max(c, 1)
+            if c <= MAX_ROLE_PLAYERS:
+                crossing += 1
+        extra -= free
+        if extra <= 0:
+            return 0.0
+        cost = ROLE_CONFLICT_WEIGHT * min(extra, conflict)
+        extra -= conflict
+        if extra <= 0:
+            return cost
+        cost += crossing_cost * min(extra, crossing)
+        extra -= crossing
+        if extra <= 0:
+            return cost
+        return cost + ROLE_SATURATION_WEIGHT * extra
+
+    def _gap(value_lo, value_hi, target):
+        if target <= 0:
+            return 0.0
+        if value_lo > target:
+            return (value_lo - target) / target
+        if value_hi < target:
+            return (target - value_hi) / target
+        return 0.0
+
+    role_counts = [0] * len(role_bits)
+    chosen = []
+    best_team, best_score = top.best()
+    state = {"done": False}
+
+    def _dfs(i, mmr_sum, wr_sum, role_cost, covered):
+        need = team_size - len(chosen)
+        if need == 0:
+            stats["evaluated"] += 1
+            team = tuple(sorted(order[j] for j in chosen))
+            # Точный счет считаем ровно так же, как полный перебор (порядок суммирования тот же)
+            score = _split_score(player_data, pos_costs, team, target_mmr, target_wr)
+            if lex_mode:
+                if score <= best_score:
+                    # Первый такой лист в порядке обхода и есть ответ перебора
+                    top.push(team, score)
+                    state["done"] = True
+            elif score <= top.threshold():
+                # Равные порогу тоже отдаем в кучу: при равном счете она сама
+                # оставит ту сторону/комбинацию, что раньше у перебора
+                top.push(team, score)
+            return
+        if n - i < need:
+            return
+
+        stats["nodes"] += 1
+        if deadline is not None and stats["nodes"] & 1023 == 0 and time.monotonic() > deadline:
+            stats["timed_out"] = True
+        if stats["timed_out"] or state["done"]:
+            return
+        if lex_mode and tuple(chosen) + tuple(range(i, i + need)) >= best_team:
+            # Все листья дальше по обходу позже текущего лучшего
+            state["done"] = True
+            return
+
+        # --- Нижняя граница итогового счета для этой ветки ---
+        missing = required_mask & ~(covered | suffix_union[i])
+        bound = role_cost + assignment_floor + _forced_role_cost(sizes_lo[i][need])
+        bound += COMPOSITION_DEFICIT_WEIGHT * bin(missing).count("1")
+        bound += MMR_WR_WEIGHT * (
+            _gap(mmr_sum + mmr_lo[i][need], mmr_sum + mmr_hi[i][need], target_mmr) +
+            _gap(wr_sum + wr_lo[i][need], wr_sum + wr_hi[i][need], target_wr)
+        )
+        if lex_mode:
+            if bound > best_score + _BOUND_EPS:
+                return
+        elif bound > top.threshold() + _BOUND_EPS:
+            return
+
+        # Ветка 1: берем игрока i
+        added = 0.0
+        for bit, cnt in player_roles[i]:
+            c = role_counts[bit]
+            added += min_future_cost[c + cnt] - min_future_cost[c]
+            role_counts[bit] = c + cnt
+        chosen.append(i)
+        _dfs(i + 1, mmr_sum + mmrs[i], wr_sum + wrs[i], role_cost + added, covered | player_masks[i])
+        chosen.pop()
+        for bit, cnt in player_roles[i]:
+            role_counts[bit] -= cnt
+
+        # Ветка 2: пропускаем игрока i
+        _dfs(i + 1, mmr_sum, wr_sum, role_cost, covered)
+
+    _dfs(0, 0, 0, 0.0, 0)
+
+
+def balance_branch_and_bound(player_data, time_budget=DEFAULT_TIME_BUDGET, top_k=DEFAULT_TOP_K):
+    """
+    Точный поиск лучшего разбиения методом ветвей и границ.
+
+    Отсечения по нижним границам:
+      * штраф ролей (conflict/saturation) только растет при добавлении игроков;
+      * непокрытые роли, которые не может закрыть ни один оставшийся игрок;
+      * отклонение MMR/WR от цели, если добрать k самых "легких"/"тяжелых" игроков.
+
+    Проход 1 (игроки по убыванию MMR) находит оптимальный счет. Проход 2
+    (исходный порядок) выбирает среди равных самую раннюю комбинацию,
+    поэтому ответ совпадает с полным перебором itertools.combinations.
+
+    При top_k > 1 за тот же проход собираются K лучших разных разбиений:
+    отсечение идет по худшему из них, а не по лучшему.
+
+    Если `time_budget` (сек) исчерпан в первом проходе, возвращается лучшее
+    найденное разбиение с флагом exact=False.
+    """
+    n = len(player_data)
+    top = TopSplits(top_k, n)
+    if n < 2:
+        top.push((), 0.0)
+        return _make_result(player_data, top, 0, True)
+
+    team_size = n // 2
+    target_mmr, target_wr = get_targets(player_data)
+    deadline = (time.monotonic() + time_budget) if time_budget else None
+    stats = {"nodes": 0, "evaluated": 0, "timed_out": False}
+
+    pos_costs = [position_costs(p) for p in player_data]
+    top.push(*_seed_split(player_data, pos_costs, team_size, target_mmr, target_wr))
+    heavy_first = sorted(range(n), key=lambda i: (-player_data[i]['mmr'], -player_data[i]['wr'], i))
+    _search(player_data, pos_costs, heavy_first, team_size, target_mmr, target_wr, top, False, deadline, stats)
+    exact = not stats["timed_out"]
+    if exact:
+        # Счет уже оптимален; второй проход только выбирает комбинацию среди равных
+        _search(player_data, pos_costs, list(range(n)), team_size, target_mmr, target_wr, top, True, deadline, stats)
+    return _make_result(player_data, top, stats["evaluated"], exact)
+
+
+def quick_split(player_data, top_k=DEFAULT_TOP_K):
+    """
+    Мгновенный приближенный ответ ("змейка" + жадные обмены) на случай,
+    если точный поиск не успел уложиться в отведенное время (exact=False).
+    """
+    top = TopSplits(top_k, len(player_data))
+    if len(player_data) < 2:
+        top.push((), 0.0)
+        return _make_result(player_data, top, 0, True)
+    target_mmr, target_wr = get_targets(player_data)
+    pos_costs = [position_costs(p) for p in player_data]
+    top.push(*_seed_split(player_data, pos_costs, len(player_data) // 2, target_mmr, target_wr))
+    return _make_result(player_data, top, 1, False)
+
+
+# ===== ВЕКТОРИЗОВАННЫЙ ПЕРЕБОР (NUMPY) =====
+
+# Сколько комбинаций считаем за один проход numpy
+NUMPY_CHUNK_SIZE = 65536
+# Самая маленькая пачка при ограниченном времени (первая пачка и хвост перед дедлайном)
+NUMPY_MIN_CHUNK_SIZE = 1024
+
+
+def encode_players(player_data):
+    """
+    Кодирует игроков в массивы numpy: MMR, WR и матрицу игрок×роль
+    (сколько раз роль встречается у игрока, обычно 0/1).
+    и матрицу игрок×позиция со штрафами position_costs.
+    Возвращает (mmr, wr, role_matrix, required_columns, pos_cost_matrix).
+    """
+    role_columns = {}
+    for p in player_data:
+        for role_id in p['positions'] or []:
+            role_columns.setdefault(role_id, len(role_columns))
+
+    mmr = np.array([p['mmr'] for p in player_data])
+    wr = np.array([p['wr'] for p in player_data], dtype=np.float64)
+    role_matrix = np.zeros((len(player_data), max(len(role_columns), 1)), dtype=np.int64)
+    for row, p in enumerate(player_data):
+        for role_id in p['positions'] or []:
+            role_matrix[row, role_columns[role_id]] += 1
+    required_columns = [role_columns[r] for r in REQUIRED_ROLES if r in role_columns]
+    pos_cost_matrix = np.array([position_costs(p) for p in player_data], dtype=np.float64)
+    return mmr, wr, role_matrix, required_columns, pos_cost_matrix
+
+
+def assignment_cost_numpy(team_indices, pos_cost_matrix):
+    """
+    assignment_cost сразу для пачки команд (массив k×размер): то же DP
+    по маскам позиций, те же сложения в том же порядке (совпадает бит в бит).
+    """
+    rows, size = team_indices.shape
+    allow_bench = size > len(LINEUP_POSITIONS)
+    dp = np.full((rows, _FULL_POSITIONS_MASK + 1), np.inf)
+    dp[:, 0] = 0.0
+    for col in range(size):
+        costs = pos_cost_matrix[team_indices[:, col]]
+        nxt = dp.copy() if allow_bench else np.full_like(dp, np.inf)
+        for taken in range(0 if allow_bench else col, min(col, len(LINEUP_POSITIONS) - 1) + 1):
+            for mask, bit, new_mask in _POSITION_TRANSITIONS[taken]:
+                np.minimum(nxt[:, new_mask], dp[:, mask] + costs[:, bit], out=nxt[:, new_mask])
+        dp = nxt
+    return dp[:, _FULL_POSITIONS_MASK] if allow_bench else dp.min(axis=1)
+
+
+def score_teams_numpy(team_indices, mmr, wr, role_matrix, required_columns, target_mmr, target_wr):
+    """
+    Считает score v5 сразу для пачки команд `team_indices` (массив k×team_size).
+    Порядок арифметики повторяет score_team, поэтому значения совпадают бит в бит.
+    """
+    # --- 1. MMR/WR score (суммируем по столбцам слева направо, как sum()) ---
+    mmr_sum = mmr[team_indices[:, 0]]
+    wr_sum = wr[team_indices[:, 0]]
+    roles = role_matrix[team_indices[:, 0]]
+    for col in range(1, team_indices.shape[1]):
+        mmr_sum = mmr_sum + mmr[team_indices[:, col]]
+        wr_sum = wr_sum + wr[team_indices[:, col]]
+        roles = roles + role_matrix[team_indices[:, col]]
+
+    mmr_norm_diff = (np.abs(mmr_sum - target_mmr) / target_mmr) if target_mmr > 0 else 0
+    wr_norm_diff = (np.abs(wr_sum - target_wr) / target_wr) if target_wr > 0 else 0
+    if target_mmr > 0 and target_wr > 0:
+        mmr_wr_score = mmr_norm_diff + wr_norm_diff
+    elif target_mmr > 0:
+        mmr_wr_score = mmr_norm_diff
+    else:
+        mmr_wr_score = wr_norm_diff + np.zeros(len(team_indices))
+
+    # --- 2. Saturation / Conflict ---
+    saturation_penalty = np.where(roles > MAX_ROLE_PLAYERS, roles - MAX_ROLE_PLAYERS, 0).sum(axis=1)
+    role_conflict_score = np.where((roles > 1) & (roles <= MAX_ROLE_PLAYERS), roles - 1, 0).sum(axis=1)
+
+    # --- 3. Coverage: обязательные роли, которых нет ни у кого в команде ---
+    uncovered_outside = len(REQUIRED_ROLES) - len(required_columns)
+    if required_columns:
+        composition_coverage_penalty = (roles[:, required_columns] == 0).sum(axis=1) + uncovered_outside
+    else:
+        composition_coverage_penalty = uncovered_outside
+
+    return (ROLE_SATURATION_WEIGHT * saturation_penalty) + \
+           (COMPOSITION_DEFICIT_WEIGHT * composition_coverage_penalty) + \
+           (ROLE_CONFLICT_WEIGHT * role_conflict_score) + \
+           (MMR_WR_WEIGHT * mmr_wr_score)
+
+
+def balance_numpy(player_data, chunk_size=NUMPY_CHUNK_SIZE, top_k=DEFAULT_TOP_K, time_budget=None):
+    """
+    Полный перебор, но комбинации считаются пачками по `chunk_size` в numpy.
+    Ответ совпадает с balance_brute_force (включая выбор среди равных).
+    Имеет смысл примерно до 24 игроков: дальше комбинаций слишком много.
+    time_budget проверяется между пачками, как в balance_brute_force; при
+    бюджете пачки начинаются с маленькой, растут не больше чем вдвое и
+    подгоняются под оставшееся время по скорости предыдущей пачки, чтобы
+    последняя не выходила за дедлайн.
+    """
+    if np is None:
+        raise RuntimeError("numpy не установлен: векторизованный режим недоступен")
+    top = TopSplits(top_k, len(player_data))
+    if len(player_data) < 2:
+        top.push((), 0.0)
+        return _make_result(player_data, top, 0, True)
+
+    team_size = len(player_data) // 2
+    target_mmr, target_wr = get_targets(player_data)
+    mmr, wr, role_matrix, required_columns, pos_cost_matrix = encode_players(player_data)
+    everyone = np.arange(len(player_data))
+
+    combos = itertools.combinations(range(len(player_data)), team_size)
+    deadline = (time.monotonic() + time_budget) if time_budget else None
+    next_size = chunk_size if deadline is None else min(chunk_size, NUMPY_MIN_CHUNK_SIZE)
+    chunk_started = last_size = None
+    evaluated = 0
+    exact = True
+    while True:
+        if deadline is not None:
+            now = time.monotonic()
+            if last_size:
+                if now > deadline:
+                    exact = False
+                    break
+                per_combo = (now - chunk_started) / last_size
+                next_size = int(min(chunk_size, 2 * last_size,
+                                    max(NUMPY_MIN_CHUNK_SIZE, (deadline - now) / per_combo)))
+            chunk_started = now
+        flat = np.fromiter(itertools.chain.from_iterable(itertools.islice(combos, next_size)),
+                           dtype=np.intp)
+        if not flat.size:
+            break
+        chunk = flat.reshape(-1, team_size)
+        last_size = len(chunk)
+        evaluated += last_size
+        # Вторая команда: оставшиеся игроки по возрастанию индекса (как dire в _make_result)
+        in_team = np.zeros((len(chunk), len(player_data)), dtype=bool)
+        in_team[np.arange(len(chunk))[:, None], chunk] = True
+        other = np.broadcast_to(everyone, in_team.shape)[~in_team].reshape(len(chunk), -1)
+        scores = score_teams_numpy(chunk, mmr, wr, role_matrix, required_columns, target_mmr, target_wr) + \
+                 assignment_cost_numpy(chunk, pos_cost_matrix) + \
+                 assignment_cost_numpy(other, pos_cost_matrix)
+        # Кандидаты в кучу: 2K лучших счетов пачки (у разбиения максимум две стороны)
+        # плюс все равные последнему из них, в порядке перебора
+        cut = min(2 * top.k, len(scores)) - 1
+        limit = min(float(np.partition(scores, cut)[cut]), top.threshold())
+        for pos in np.flatnonzero(scores <= limit):
+            top.push(tuple(int(i) for i in chunk[pos]), float(scores[pos]))
+
+    return _make_result(player_data, top, evaluated, exact)
+
+
+# ===== НЕСКОЛЬКО ЛОББИ СРАЗУ (5 на 5 + запас) =====
+
+LOBBY_TEAM_SIZE = len(LINEUP_POSITIONS)
+# Время на отжиг (сек); точная доводка каждого лобби идет сверху и занимает миллисекунды
+DEFAULT_LOBBY_TIME_BUDGET = 0.8
+# Температура отжига: от "почти любой обмен" до "только улучшения"
+LOBBY_START_TEMPERATURE = 50.0
+LOBBY_END_TEMPERATURE = 0.5
+
+
+def _lobby_score(player_data, pos_costs, radiant, dire):
+    """Штраф одного лобби: как _split_score, цели MMR/WR считаются по его 10 игрокам."""
+    target_mmr, target_wr = get_targets([player_data[i] for i in radiant + dire])
+    return score_team([player_data[i] for i in radiant], target_mmr, target_wr) + \
+           assignment_cost([pos_costs[i] for i in radiant]) + \
+           assignment_cost([pos_costs[i] for i in dire])
+
+
+def _snake_teams(player_data, team_count):
+    """Стартовое распределение: "змейка" по MMR на team_count команд, остальные в запас."""
+    order = sorted(range(len(player_data)), key=lambda i: (-player_data[i]['mmr'], i))
+    teams = [[] for _ in range(team_count)]
+    for rank, i in enumerate(order[:team_count * LOBBY_TEAM_SIZE]):
+        lap, pos = divmod(rank, team_count)
+        teams[pos if lap % 2 == 0 else team_count - 1 - pos].append(i)
+    return teams, order[team_count * LOBBY_TEAM_SIZE:]
+
+
+def split_lobbies(player_data, time_budget=DEFAULT_LOBBY_TIME_BUDGET, seed=0):
+    """
+    Делит игроков на N = len // 10 одновременных матчей 5 на 5 и запас,
+    минимизируя сумму штрафов всех матчей.
+
+    Старт: "змейка" по MMR на 2N команд. Затем отжиг (simulated annealing):
+    случайные обмены двух игроков между командами или с запасом, пока не
+    кончится `time_budget`. В конце каждое лобби доводится точным
+    balance_branch_and_bound (10 игроков — миллисекунды).
+
+    Возвращает словарь: lobbies (список {radiant, dire, score}, сильные
+    лобби первыми), bench, score (сумма), evaluated (число обменов).
+    """
+    lobby_count = len(player_data) // (2 * LOBBY_TEAM_SIZE)
+    if lobby_count == 0:
+        return {"lobbies": [], "bench": list(player_data), "score": 0.0, "evaluated": 0}
+
+    rnd = random.Random(seed)
+    pos_costs = [position_costs(p) for p in player_data]
+    teams, bench = _snake_teams(player_data, 2 * lobby_count)
+    if lobby_count == 1 and not bench:
+        time_budget = 0  # Одно лобби без запаса: хватает точной доводки
+    groups = teams + [bench]  # Последняя группа — запас (может быть пустой)
+
+    def _score_lobby(lobby):
+        return _lobby_score(player_data, pos_costs, sorted(groups[2 * lobby]), sorted(groups[2 * lobby + 1]))
+
+    scores = [_score_lobby(lobby) for lobby in range(lobby_count)]
+    total = sum(scores)
+    best_total, best_groups = total, [list(g) for g in groups]
+
+    slots = [(g, k) for g, group in enumerate(groups) for k in range(len(group))]
+    started = time.monotonic()
+    deadline = started + (time_budget or 0)
+    temperature = LOBBY_START_TEMPERATURE
+    cooling = math.log(LOBBY_END_TEMPERATURE / LOBBY_START_TEMPERATURE)
+    evaluated = 0
+    while True:
+        if evaluated & 255 == 0:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            # Геометрическое охлаждение по доле израсходованного времени
+            temperature = LOBBY_START_TEMPERATURE * math.exp(cooling * (now - started) / time_budget)
+        evaluated += 1
+        (g1, k1), (g2, k2) = rnd.sample(slots, 2)
+        if g1 == g2 or (g1 >= 2 * lobby_count and g2 >= 2 * lobby_count):
+            continue
+        groups[g1][k1], groups[g2][k2] = groups[g2][k2], groups[g1][k1]
+        touched = {g // 2 for g in (g1, g2) if g < 2 * lobby_count}
+        new_scores = {lobby: _score_lobby(lobby) for lobby in touched}
+        delta = sum(new_scores[lobby] - scores[lobby] for lobby in touched)
+        if delta <= 0 or rnd.random() < math.exp(-delta / temperature):
+            for lobby, score in new_scores.items():
+                scores[lobby] = score
+            total += delta
+            if total < best_total - _BOUND_EPS:
+                best_total, best_groups = total, [list(g) for g in groups]
+        else:
+            groups[g1][k1], groups[g2][k2] = groups[g2][k2], groups[g1][k1]
+
+    # Точная доводка каждого лобби: лучшее разбиение его 10 игроков и расстановка по позициям
+    lobbies = []
+    for lobby in range(lobby_count):
+        members = sorted(best_groups[2 * lobby] + best_groups[2 * lobby + 1])
+        result = balance_branch_and_bound([player_data[i] for i in members], time_budget=None)
+        lobbies.append({"radiant": result["radiant"], "dire": result["dire"], "score": result["score"]})
+    lobbies.sort(key=lambda lobby: -sum(p['mmr'] for p in lobby["radiant"] + lobby["dire"]))
+    return {
+        "lobbies": lobbies,
+        "bench": [player_data[i] for i in sorted(best_groups[-1])],
+        "score": sum(lobby["score"] for lobby in lobbies),
+        "evaluated": evaluated,
+    }
+
+
+# ===== ВЫБОР РЕЖИМА =====
+
+BALANCE_MODES = ("bnb", "numpy", "brute")
+
+
+def find_best_split(player_data, time_budget=DEFAULT_TIME_BUDGET, mode="bnb", top_k=DEFAULT_TOP_K):
+    """
+    Главная точка входа балансировщика.
+    mode: "bnb" (ветви и границы, по умолчанию), "numpy" (векторизованный
+    полный перебор), "brute" (старый цикл на чистом Python).
+    Если numpy недоступен, режим "numpy" откатывается на "bnb".
+    time_budget действует во всех режимах: по его исчерпании возвращается
+    лучшее найденное разбиение (exact=False).
+    top_k: сколько лучших разных разбиений вернуть в alternatives.
+    Возвращает словарь: radiant, dire, score, alternatives, evaluated, exact.
+    """
+    if mode == "numpy" and np is not None:
+        return balance_numpy(player_data, top_k=top_k, time_budget=time_budget)
+    if mode == "brute":
+        return balance_brute_force(player_data, top_k=top_k, time_budget=time_budget)
+    return balance_branch_and_bound(player_data, time_budget=time_budget, top_k=top_k)
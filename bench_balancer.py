@@ -0,0 +1,221 @@
+# =========================================================================
+# ========== БЕНЧМАРК БАЛАНСИРОВЩИКА (БЕЗ БД) ==========
+# =========================================================================
+#
+# Гоняет balancer.py на синтетических ростерах (player_data собирается
+# здесь же, Postgres не нужен) и пишет время, число оцененных кандидатов
+# и итоговый счет. Результат можно сохранить в JSON и сравнить со старым
+# прогоном, чтобы видеть регрессии и по скорости, и по качеству.
+#
+# Запуск:  python bench_balancer.py                          (таблица, 10-16 игроков)
+#          python bench_balancer.py --sizes 4 10 20 30 --modes bnb numpy
+#          python bench_balancer.py --mmr bimodal --roles supports --repeats 3
+#          python bench_balancer.py --out new.json --compare old.json
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+import balancer
+
+# --- Распределения для синтетических ростеров ---
+MMR_DISTRIBUTIONS = ("uniform", "normal", "bimodal", "flat")
+WR_DISTRIBUTIONS = ("uniform", "normal", "zero")
+ROLE_PATTERNS = ("spread", "specialist", "flex", "supports", "none")
+
+# Выше этих размеров полный перебор бессмысленно долгий, режим пропускается
+MODE_MAX_SIZE = {"brute": 16, "numpy": 20}
+
+# Во сколько раз прогон может быть медленнее старого, прежде чем это регрессия
+# (меньше 5 мс не сравниваем: там один шум)
+TIME_REGRESSION_RATIO = 1.5
+TIME_NOISE_FLOOR_MS = 5.0
+
+
+def _draw_mmr(rnd, dist):
+    if dist == "normal":
+        return int(min(9000, max(0, rnd.gauss(3500, 1000))))
+    if dist == "bimodal":
+        center = 2000 if rnd.random() < 0.5 else 5500
+        return int(max(0, rnd.gauss(center, 400)))
+    if dist == "flat":
+        return 3000
+    return rnd.randint(1000, 7000)
+
+
+def _draw_wr(rnd, dist):
+    if dist == "normal":
+        return round(min(100.0, max(0.0, rnd.gauss(50, 8))), 1)
+    if dist == "zero":
+        return 0
+    return round(rnd.uniform(30, 70), 1)
+
+
+def _draw_roles(rnd, pattern):
+    roles = sorted(balancer.REQUIRED_ROLES)
+    if pattern == "specialist":
+        return [rnd.choice(roles)]
+    if pattern == "flex":
+        return sorted(rnd.sample(roles, rnd.randint(3, 5)))
+    if pattern == "supports":
+        # Большинство хочет 4/5: проверка лимита ролей и расстановки
+        if rnd.random() < 0.6:
+            return sorted(rnd.sample([4, 5], rnd.randint(1, 2)))
+        return sorted(rnd.sample(roles, rnd.randint(1, 2)))
+    if pattern == "none":
+        return []
+    return sorted(rnd.sample(roles, rnd.randint(1, 3)))
+
+
+def make_roster(size, seed=0, mmr="uniform", wr="uniform", roles="spread"):
+    """
+    Синтетический ростер в формате player_data балансировщика.
+    mmr: uniform (1000-7000), normal, bimodal, flat (у всех одинаковый);
+    wr: uniform (30-70%), normal, zero (новички); roles: spread (1-3 роли),
+    specialist (1 роль), flex (3-5), supports (перекос в 4/5), none.
+    """
+    rnd = random.Random(seed)
+    roster = []
+    for i in range(size):
+        positions = _draw_roles(rnd, roles)
+        roster.append({
+            'nickname': f"player{i}",
+            'mmr': _draw_mmr(rnd, mmr),
+            'wr': _draw_wr(rnd, wr),
+            'rating': 1000,
+            'pos_str': "",
+            'positions': positions,
+            'role_records': {pos: (rnd.randint(0, 20), rnd.randint(0, 20)) for pos in positions},
+        })
+    return roster
+
+
+def _run_mode(mode, player_data, time_budget):
+    if mode == "lobbies":
+        return balancer.split_lobbies(player_data, time_budget=time_budget or balancer.DEFAULT_LOBBY_TIME_BUDGET)
+    if mode == "bnb":
+        return balancer.balance_branch_and_bound(player_data, time_budget=time_budget)
+    return balancer.find_best_split(player_data, time_budget=time_budget, mode=mode)
+
+
+def run_once(mode, player_data, time_budget=None):
+    """Один прогон: (время в мс, результат балансировщика)."""
+    started = time.perf_counter()
+    result = _run_mode(mode, player_data, time_budget)
+    return (time.perf_counter() - started) * 1000, result
+
+
+def run_suite(sizes, modes, mmr, wr, roles, repeats, time_budget):
+    """Все сочетания размер × повтор × режим; повтор = другой seed ростера."""
+    records = []
+    for size in sizes:
+        for repeat in range(repeats):
+            seed = size * 1000 + repeat
+            player_data = make_roster(size, seed, mmr, wr, roles)
+            for mode in modes:
+                if size > MODE_MAX_SIZE.get(mode, size):
+                    continue
+                if mode == "numpy" and balancer.np is None:
+                    continue
+                if mode == "lobbies" and size < 2 * balancer.LOBBY_TEAM_SIZE:
+                    continue
+                elapsed, result = run_once(mode, player_data, time_budget)
+                records.append({
+                    "size": size, "seed": seed, "mmr": mmr, "wr": wr, "roles": roles, "mode": mode,
+                    "time_ms": round(elapsed, 3),
+                    "evaluated": result["evaluated"],
+                    "score": result["score"],
+                    "exact": result.get("exact", False),
+                })
+    return records
+
+
+def print_table(records):
+    print(f"{'игроков':>8} | {'seed':>6} | {'режим':>8} | {'время':>10} | {'кандидатов':>10} | {'счет':>10} | точно")
+    for r in records:
+        print(f"{r['size']:>8} | {r['seed']:>6} | {r['mode']:>8} | {r['time_ms']:>8.1f}ms | "
+              f"{r['evaluated']:>10} | {r['score']:>10.2f} | {'✅' if r['exact'] else '⏱️'}")
+    # Все точные режимы обязаны давать один и тот же счет
+    by_roster = {}
+    for r in records:
+        if r["exact"] and r["mode"] != "lobbies":
+            by_roster.setdefault((r["size"], r["seed"]), set()).add(r["score"])
+    mismatched = [key for key, scores in by_roster.items() if len(scores) > 1]
+    if mismatched:
+        print(f"❌ Точные режимы разошлись по счету: {mismatched}")
+
+
+def _record_key(r):
+    return (r["size"], r["seed"], r["mmr"], r["wr"], r["roles"], r["mode"])
+
+
+def compare(records, baseline_path):
+    """
+    Сравнивает прогон со старым JSON: счет хуже (выше) — регрессия качества,
+    время больше в TIME_REGRESSION_RATIO раз — регрессия скорости.
+    Возвращает число регрессий.
+    """
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {_record_key(r): r for r in json.load(f)["results"]}
+    regressions = 0
+    print(f"\n📊 Сравнение с {baseline_path}:")
+    for r in records:
+        old = baseline.get(_record_key(r))
+        if old is None:
+            continue
+        notes = []
+        if r["score"] > old["score"] + balancer._BOUND_EPS:
+            notes.append(f"счет {old['score']:.2f} -> {r['score']:.2f}")
+        if r["time_ms"] > max(old["time_ms"], TIME_NOISE_FLOOR_MS) * TIME_REGRESSION_RATIO:
+            notes.append(f"время {old['time_ms']:.1f} -> {r['time_ms']:.1f} мс")
+        if notes:
+            regressions += 1
+            print(f"❌ {r['size']} игроков, seed {r['seed']}, {r['mode']}: " + "; ".join(notes))
+    print("✅ Регрессий нет." if not regressions else f"⚠️ Регрессий: {regressions}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк балансировщика на синтетических ростерах")
+    parser.add_argument("sizes_pos", nargs="*", type=int, help="размеры лобби (как --sizes)")
+    parser.add_argument("--sizes", nargs="+", type=int, default=None, help="размеры ростеров, 4-30")
+    parser.add_argument("--modes", nargs="+", default=["brute", "numpy", "bnb"],
+                        choices=list(balancer.BALANCE_MODES) + ["lobbies"])
+    parser.add_argument("--mmr", default="uniform", choices=MMR_DISTRIBUTIONS)
+    parser.add_argument("--wr", default="uniform", choices=WR_DISTRIBUTIONS)
+    parser.add_argument("--roles", default="spread", choices=ROLE_PATTERNS)
+    parser.add_argument("--repeats", type=int, default=1, help="сколько разных ростеров на размер")
+    parser.add_argument("--time-budget", type=float, default=None,
+                        help="бюджет поиска/лобби в секундах (по умолчанию без ограничения)")
+    parser.add_argument("--out", help="куда записать результаты в JSON")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes or args.sizes_pos or [10, 12, 14, 16]
+    records = run_suite(sizes, args.modes, args.mmr, args.wr, args.roles, args.repeats, args.time_budget)
+    print_table(records)
+
+    if args.out:
+        payload = {
+            "meta": {
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "python": platform.python_version(),
+                "numpy": getattr(balancer.np, "__version__", None),
+                "args": vars(args),
+            },
+            "results": records,
+        }
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False, indent=2)
+        print(f"💾 Результаты записаны в {args.out}")
+
+    if args.compare:
+        return 1 if compare(records, args.compare) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
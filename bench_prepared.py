@@ -0,0 +1,139 @@
+# =========================================================================
+# ========== БЕНЧМАРК ПОДГОТОВЛЕННЫХ ЗАПРОСОВ (НУЖНА БД) ==========
+# =========================================================================
+#
+# Гоняет каждый запрос из prepared_statements.py двумя способами на одном и
+# том же соединении: обычным cur.execute (разбор + план каждый раз) и через
+# execute_prepared (PREPARE один раз, дальше EXECUTE). Пишет медиану и p95
+# задержки и сколько экономится на одном запросе.
+# Запись (activity_upsert) выполняется в транзакции, которая откатывается.
+#
+# Запуск:  DATABASE_URL=... python bench_prepared.py
+#          python bench_prepared.py --dsn postgres://... --repeats 500 --statements leaderboard_rows role_stats
+#          python bench_prepared.py --out prepared.json
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import psycopg2
+
+from prepared_statements import PREPARED_STATEMENTS, PreparedConnection, execute_prepared
+
+# Для журнала активности - заведомо несуществующие user_id (всё равно откатываем)
+BENCH_USER_IDS = list(range(-50, 0))
+
+
+def sample_params(cur):
+    """Параметры для каждого запроса из реальных данных (первые игроки по нику)."""
+    cur.execute('SELECT nickname FROM players ORDER BY nickname LIMIT 10')
+    nicknames = [row[0] for row in cur.fetchall()] or ["nobody"]
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    size = len(BENCH_USER_IDS)
+    return {
+        "leaderboard_rows": (),
+        "player_rows": (nicknames,),
+        "player_role_rows": (nicknames,),
+        "player_top_heroes": (nicknames, 3),
+        "top_heroes": (nicknames[0], 3),
+        "role_stats": (nicknames[0],),
+        "activity_upsert": (BENCH_USER_IDS, ["bench"] * size, ["bench"] * size, [""] * size,
+                            [now] * size, [now] * size, [1] * size),
+    }
+
+
+def _percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def time_statement(conn, name, params, repeats, prepared):
+    """Задержки одного запроса в мкс (каждый вызов - своя транзакция, как в боте)."""
+    sql = PREPARED_STATEMENTS[name]
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        with conn.cursor() as cur:
+            if prepared:
+                execute_prepared(cur, name, params)
+            else:
+                cur.execute(sql, params)
+            if cur.description is not None:
+                cur.fetchall()
+        conn.rollback()
+        timings.append((time.perf_counter() - started) * 1e6)
+    return timings
+
+
+def run_suite(conn, names, repeats, warmup):
+    with conn.cursor() as cur:
+        params = sample_params(cur)
+    conn.rollback()
+    records = []
+    for name in names:
+        # Разогрев: кэши Postgres и сам PREPARE не должны попадать в замер
+        time_statement(conn, name, params[name], warmup, prepared=False)
+        time_statement(conn, name, params[name], warmup, prepared=True)
+        plain = time_statement(conn, name, params[name], repeats, prepared=False)
+        prepared = time_statement(conn, name, params[name], repeats, prepared=True)
+        records.append({
+            "statement": name, "repeats": repeats,
+            "plain_median_us": round(statistics.median(plain), 1),
+            "plain_p95_us": round(_percentile(plain, 0.95), 1),
+            "prepared_median_us": round(statistics.median(prepared), 1),
+            "prepared_p95_us": round(_percentile(prepared, 0.95), 1),
+        })
+        records[-1]["saved_median_us"] = round(records[-1]["plain_median_us"] - records[-1]["prepared_median_us"], 1)
+    return records
+
+
+def print_table(records):
+    print(f"{'запрос':>18} | {'обычный':>10} | {'p95':>10} | {'prepared':>10} | {'p95':>10} | экономия")
+    for r in records:
+        share = r["saved_median_us"] / r["plain_median_us"] * 100 if r["plain_median_us"] else 0
+        print(f"{r['statement']:>18} | {r['plain_median_us']:>8.0f}мкс | {r['plain_p95_us']:>8.0f}мкс | "
+              f"{r['prepared_median_us']:>8.0f}мкс | {r['prepared_p95_us']:>8.0f}мкс | "
+              f"{r['saved_median_us']:>7.0f}мкс ({share:.0f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Обычные vs подготовленные запросы на живой БД")
+    parser.add_argument("--dsn", default=os.getenv("DATABASE_URL"), help="строка подключения (по умолчанию DATABASE_URL)")
+    parser.add_argument("--statements", nargs="+", default=list(PREPARED_STATEMENTS),
+                        choices=list(PREPARED_STATEMENTS))
+    parser.add_argument("--repeats", type=int, default=200, help="замеров на запрос и способ")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--sslmode", default="require")
+    parser.add_argument("--out", help="куда записать результаты в JSON")
+    args = parser.parse_args(argv)
+    if not args.dsn:
+        parser.error("нужен --dsn или DATABASE_URL")
+
+    conn = psycopg2.connect(args.dsn, sslmode=args.sslmode, connection_factory=PreparedConnection)
+    server_version = conn.server_version
+    try:
+        records = run_suite(conn, args.statements, args.repeats, args.warmup)
+    finally:
+        conn.close()
+    print_table(records)
+
+    if args.out:
+        payload = {
+            "meta": {
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "server": server_version,
+                "args": {k: v for k, v in vars(args).items() if k != "dsn"},
+            },
+            "results": records,
+        }
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False, indent=2)
+        print(f"💾 Результаты записаны в {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
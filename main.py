@@ -1,17 +1,22 @@
 import telebot
 import psycopg2
-from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import execute_values
 from telebot import types
 import time
 import os
 import json
+import select
 from datetime import datetime
 from flask import Flask, jsonify
-from threading import Thread, Lock, Timer
-import itertools
-# ▼▼▼ ДОБАВЛЕНО ДЛЯ /statshero ▼▼▼
-from collections import Counter
-# ▲▲▲ КОНЕЦ ▲▲▲
+from threading import Thread, Lock, Timer, Condition
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import multiprocessing
+import atexit
+import balancer
+from prepared_statements import PreparedConnection, execute_prepared
 
 # ========== НАСТРОЙКИ ==========
 
@@ -19,6 +24,40 @@ TOKEN = os.getenv('TOKEN')
 ADMIN_ID = int(os.getenv('ADMIN_ID', '0'))
 RATING_CHANGE = 25
 DATABASE_URL = os.getenv('DATABASE_URL')
+# Максимальное время (сек) на поиск баланса; дальше берется лучшее найденное
+# (результат помечается как приближенный)
+BALANCE_TIME_BUDGET = float(os.getenv('BALANCE_TIME_BUDGET', balancer.DEFAULT_TIME_BUDGET))
+# Сколько процессов считают баланс параллельно (вне потока polling)
+BALANCE_WORKERS = int(os.getenv('BALANCE_WORKERS', '2'))
+# Время (сек) на распределение игроков по нескольким лобби
+LOBBY_TIME_BUDGET = float(os.getenv('LOBBY_TIME_BUDGET', balancer.DEFAULT_LOBBY_TIME_BUDGET))
+# Режим балансировщика: bnb (по умолчанию) | numpy (нужен numpy) | brute
+BALANCE_MODE = os.getenv('BALANCE_MODE', 'bnb')
+# Сколько лучших разных составов держим для кнопки "Другой вариант"
+BALANCE_TOP_K = int(os.getenv('BALANCE_TOP_K', '5'))
+# Кэш профилей игроков (/player): сколько держим и сколько живет запись (сек)
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', '200'))
+PROFILE_CACHE_TTL = int(os.getenv('PROFILE_CACHE_TTL', '600'))
+# Канал LISTEN/NOTIFY: триггеры на players/player_role_stats шлют в него сигнал об изменениях
+PLAYER_CACHE_CHANNEL = 'player_cache'
+# Страховочное полное обновление кэша игроков (сек), если уведомление потерялось
+PLAYER_CACHE_SAFETY_INTERVAL = int(os.getenv('PLAYER_CACHE_SAFETY_INTERVAL', '1800'))
+# Журнал активности пишется пачками: раз в N секунд или при M накопленных событиях
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', '10'))
+ACTIVITY_FLUSH_EVENTS = int(os.getenv('ACTIVITY_FLUSH_EVENTS', '50'))
+# Сколько (сек) ждем последнюю запись журнала при остановке процесса
+ACTIVITY_SHUTDOWN_TIMEOUT = float(os.getenv('ACTIVITY_SHUTDOWN_TIMEOUT', '5'))
+# Пул соединений: размеры, сколько (сек) ждать свободное соединение,
+# через сколько (сек) пересоздавать соединение, лимит на один запрос (мс)
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '5'))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv('DB_POOL_ACQUIRE_TIMEOUT', '10'))
+DB_POOL_MAX_AGE = float(os.getenv('DB_POOL_MAX_AGE', '1800'))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '15000'))
+# Процесс пула балансировщика (forkserver) при локальном запуске (python main.py)
+# импортирует этот файл заново под именем __mp_main__. Ему нужен только
+# balancer.py: ни пула БД, ни кэшей, ни polling в нем не поднимаем.
+IS_BALANCE_WORKER = __name__ == "__mp_main__"
 
 if not all([TOKEN, ADMIN_ID, DATABASE_URL]):
     print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
@@ -39,17 +78,150 @@ def ping():
 
 @app.route('/status', methods=['GET'])
 def status():
-    return jsonify({"server": "online", "bot": "active", "db": "connected"}), 200
+    return jsonify({
+        "server": "online", "bot": "active", "db": "connected",
+        "balance_cache": balance_cache.stats(),
+        "profile_cache": profile_cache.stats(),
+        "stats_snapshot_cache": stats_snapshot_cache.stats(),
+        "activity_log": activity_log.stats(),
+        "db_pool": db_pool.stats() if db_pool else None
+    }), 200
 
 # ===== НОВЫЙ ПУЛ СОЕДИНЕНИЙ (ПОТОКОБЕЗОПАСНЫЙ) =====
-try:
-    db_pool = ThreadedConnectionPool( 
-        1, 5, dsn=DATABASE_URL, sslmode='require' 
-    )
-    print("✅ [DB POOL] Потокобезопасный пул соединений (Threaded) успешно создан.")
-except Exception as e:
-    print(f"🔥🔥🔥 [DB POOL] НЕ УДАЛОСЬ СОЗДАТЬ ПУЛ СОЕДИНЕНИЙ: {e}")
-    db_pool = None
+# Свой пул вместо голого ThreadedConnectionPool: когда все соединения заняты,
+# getconn ждет (не дольше acquire_timeout), а не падает; мертвые после
+# переключения БД соединения отсеиваются при выдаче, старые пересоздаются.
+
+class DBPool:
+    # Соединение, пролежавшее без дела дольше этого (сек), перед выдачей проверяем SELECT 1
+    CHECK_IDLE_AFTER = 30
+
+    def __init__(self, dsn, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT,
+                 max_age=DB_POOL_MAX_AGE, statement_timeout_ms=DB_STATEMENT_TIMEOUT_MS):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.max_age = max_age
+        self.statement_timeout_ms = statement_timeout_ms
+        self.cond = Condition()
+        self.idle = [] # (conn, вернули в пул в) - берем с конца, самое "теплое"
+        self.born = {} # id(conn) -> когда создано
+        self.total = 0 # Созданные (и создаваемые прямо сейчас) соединения
+        self.counters = {"acquired": 0, "waits": 0, "timeouts": 0, "created": 0,
+                         "recycled": 0, "dead": 0, "wait_ms_total": 0.0}
+        for _ in range(min_size):
+            with self.cond:
+                self.total += 1
+            conn = self._connect()
+            with self.cond:
+                self.idle.append((conn, time.time()))
+
+    def _connect(self):
+        """Новое соединение; statement_timeout ставится на всю сессию.
+        Место под него (total) резервирует вызывающий, здесь оно только освобождается при неудаче."""
+        try:
+            # PreparedConnection помнит свои подготовленные запросы (см. prepared_statements.py)
+            conn = psycopg2.connect(self.dsn, sslmode='require', connection_factory=PreparedConnection,
+                                    options=f'-c statement_timeout={self.statement_timeout_ms}')
+        except Exception:
+            with self.cond:
+                self.total -= 1
+                self.cond.notify()
+            raise
+        with self.cond:
+            self.born[id(conn)] = time.time()
+            self.counters["created"] += 1
+        return conn
+
+    def _discard(self, conn, reason):
+        with self.cond:
+            self.born.pop(id(conn), None)
+            self.total -= 1
+            self.counters[reason] += 1
+            self.cond.notify()
+        try: conn.close()
+        except Exception: pass
+
+    def _usable(self, conn, idle_since):
+        """Проверка при выдаче: не закрыто, не слишком старое, живое (если долго лежало)."""
+        if conn.closed:
+            self._discard(conn, "dead")
+            return False
+        if time.time() - self.born.get(id(conn), 0) > self.max_age:
+            self._discard(conn, "recycled")
+            return False
+        if time.time() - idle_since > self.CHECK_IDLE_AFTER:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+                conn.rollback()
+            except Exception:
+                self._discard(conn, "dead")
+                return False
+        return True
+
+    def getconn(self, timeout=None):
+        """Свободное соединение; ждет не дольше timeout. None, если не дождались."""
+        timeout = self.acquire_timeout if timeout is None else timeout
+        started = time.time()
+        waited = False
+        while True:
+            with self.cond:
+                while not self.idle and self.total >= self.max_size:
+                    remaining = timeout - (time.time() - started)
+                    if remaining <= 0:
+                        self.counters["timeouts"] += 1
+                        return None
+                    if not waited:
+                        self.counters["waits"] += 1
+                        waited = True
+                    self.cond.wait(remaining)
+                entry = self.idle.pop() if self.idle else None
+                if entry is None:
+                    self.total += 1 # Резервируем место под новое соединение, пока держим блокировку
+            if entry is None:
+                conn = self._connect() # Место есть: создаем новое (вне блокировки)
+            elif not self._usable(*entry):
+                continue
+            else:
+                conn = entry[0]
+            with self.cond:
+                self.counters["acquired"] += 1
+                if waited: self.counters["wait_ms_total"] += (time.time() - started) * 1000
+            return conn
+
+    def putconn(self, conn):
+        """Возвращает соединение; сломанное или старое закрывается, а не кладется обратно."""
+        if conn.closed:
+            self._discard(conn, "dead")
+            return
+        if time.time() - self.born.get(id(conn), 0) > self.max_age:
+            self._discard(conn, "recycled")
+            return
+        try:
+            # Незакрытая транзакция (ошибка в обработчике без with conn) не должна уехать к следующему
+            if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except Exception:
+            self._discard(conn, "dead")
+            return
+        with self.cond:
+            self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    def stats(self):
+        with self.cond:
+            return dict(self.counters, wait_ms_total=round(self.counters["wait_ms_total"], 1),
+                        total=self.total, idle=len(self.idle), in_use=self.total - len(self.idle),
+                        max_size=self.max_size)
+
+db_pool = None
+if not IS_BALANCE_WORKER:
+    try:
+        db_pool = DBPool(DATABASE_URL)
+        print(f"✅ [DB POOL] Пул соединений создан (до {DB_POOL_MAX}, ожидание до {DB_POOL_ACQUIRE_TIMEOUT} сек).")
+    except Exception as e:
+        print(f"🔥🔥🔥 [DB POOL] НЕ УДАЛОСЬ СОЗДАТЬ ПУЛ СОЕДИНЕНИЙ: {e}")
 
 # ===== TELEGRAM БОТ =====
 bot = telebot.TeleBot(TOKEN, parse_mode='HTML', disable_web_page_preview=True)
@@ -57,12 +229,15 @@ bot = telebot.TeleBot(TOKEN, parse_mode='HTML', disable_web_page_preview=True)
 # ===== УПРАВЛЕНИЕ БАЗОЙ ДАННЫХ (ПУЛ) =====
 
 def get_db_conn():
-    """Берет соединение из пула."""
+    """Берет соединение из пула (ждет свободное до DB_POOL_ACQUIRE_TIMEOUT сек)."""
     if not db_pool:
         print("❌ [DB POOL] Пул не инициализирован.")
         return None
     try:
-        return db_pool.getconn()
+        conn = db_pool.getconn()
+        if conn is None:
+            print(f"❌ [DB POOL] Нет свободного соединения за {DB_POOL_ACQUIRE_TIMEOUT} сек.")
+        return conn
     except Exception as e:
         print(f"❌ [DB POOL] Не удалось получить соединение из пула: {e}")
         return None
@@ -75,6 +250,18 @@ def put_db_conn(conn):
         except Exception as e:
             print(f"❌ [DB POOL] Не удалось вернуть соединение в пул: {e}")
 
+@contextmanager
+def db_connection():
+    """
+    with db_connection() as conn: ... - то же, что get_db_conn/put_db_conn,
+    но соединение вернется в пул при любом выходе. conn может быть None.
+    """
+    conn = get_db_conn()
+    try:
+        yield conn
+    finally:
+        put_db_conn(conn)
+
 # ===== СЛОВАРЬ ПОЗИЦИЙ (Глобальный) =====
 POSITIONS = {
     1: "Carry", 2: "Mid", 3: "Offlane",
@@ -93,15 +280,88 @@ def get_player_positions_str(positions_list):
 # =========================================================================
 
 class PlayerCache:
-    def __init__(self, refresh_interval=30):
-        self.players = []  # Сам кэш
+    # Пауза перед переподключением слушателя LISTEN (сек), растет до максимума
+    LISTEN_RETRY_MIN = 5
+    LISTEN_RETRY_MAX = 300
+    # Инвалидации, пришедшие в течение этой паузы (сек), склеиваются в одно обновление
+    DEBOUNCE_SECONDS = 0.5
+    # Повтор обновления после ошибки БД (сек)
+    RETRY_SECONDS = 5
+    # Сколько максимум ждет читатель с wait_fresh=True (сек)
+    FRESH_WAIT_TIMEOUT = 5
+
+    def __init__(self, refresh_interval=PLAYER_CACHE_SAFETY_INTERVAL):
+        self.players = []  # Сам кэш (отсортирован по нику)
+        self.by_nick = {}  # Индекс: nickname -> запись кэша
         self.lock = Lock() # Для потокобезопасности
         self.refresh_interval = refresh_interval
         self.last_updated = 0
+        # xmin снимка последнего чтения (None = нужно полное). Все транзакции
+        # старше него уже были видны; строки, записанные транзакциями не старше
+        # него, дельта перечитывает - это не зависит от времени коммита
+        self.delta_marker = None
+        # Инвалидация без блокировки: dirty_version растет на каждую запись,
+        # fresh_version - до какой записи кэш уже обновлен
+        self.dirty_version = 0
+        self.fresh_version = 0
+        self.fresh_cond = Condition(self.lock) # Будит читателей с wait_fresh=True
+        self.refresh_lock = Lock() # Обновления идут строго по одному
+        self.refresh_timer = None # Отложенное (debounce) обновление, если запланировано
+        # Версия содержимого (растет, только если список реально изменился)
+        # и готовые кнопки клавиатур под эту версию
+        self.version = 0
+        self.picker_rows = None
+        self.action_rows = {}
         self._update_cache() # Первоначальное заполнение
-        self._start_timer() # Запуск авто-обновления
+        self._start_timer() # Страховочное авто-обновление (редкое)
+        self._start_listener() # Основной путь: обновление по NOTIFY
         print("✅ [CACHE] Кэш игроков инициализирован.")
 
+    def _start_listener(self):
+        """Запускает фоновый поток, который слушает канал PLAYER_CACHE_CHANNEL."""
+        self.listener = Thread(target=self._listen_loop, daemon=True)
+        self.listener.start()
+
+    def _listen_loop(self):
+        """
+        Держит ОТДЕЛЬНОЕ соединение (не из пула: LISTEN занимает его навсегда)
+        и обновляет кэш только когда пришло уведомление. Пачку уведомлений,
+        пришедших разом, обрабатываем одним обновлением. После обрыва
+        переподключаемся и сразу обновляем кэш (уведомления могли потеряться).
+        """
+        retry = self.LISTEN_RETRY_MIN
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(DATABASE_URL, sslmode='require')
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN {PLAYER_CACHE_CHANNEL}')
+                print(f"✅ [CACHE] Слушаем канал '{PLAYER_CACHE_CHANNEL}' (LISTEN/NOTIFY).")
+                if retry > self.LISTEN_RETRY_MIN:
+                    self._update_cache(full=True)
+                retry = self.LISTEN_RETRY_MIN
+                while True:
+                    # Ждем данных на сокете; таймаут нужен, чтобы замечать мертвое соединение
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        with conn.cursor() as cur:
+                            cur.execute('SELECT 1')
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        tables = sorted({n.payload for n in conn.notifies})
+                        conn.notifies.clear()
+                        print(f"CACHE: [Notify] Изменения в {', '.join(tables)}, обновляем кэш...")
+                        self.invalidate()
+            except Exception as e:
+                print(f"CACHE: [ERROR] Слушатель LISTEN упал: {e}. Повтор через {retry} с.")
+                time.sleep(retry)
+                retry = min(retry * 2, self.LISTEN_RETRY_MAX)
+            finally:
+                if conn:
+                    try: conn.close()
+                    except Exception: pass
+
     def _start_timer(self):
         """Запускает таймер, который вызовет _auto_refresh."""
         self.timer = Timer(self.refresh_interval, self._auto_refresh)
@@ -109,369 +369,1065 @@ class PlayerCache:
         self.timer.start()
 
     def _auto_refresh(self):
-        """Метод, вызываемый таймером для обновления кэша."""
-        print("CACHE: [Auto-Refresh] Обновление кэша игроков...")
-        self._update_cache()
+        """Страховочное ПОЛНОЕ обновление по таймеру (на случай потерянного уведомления)."""
+        print("CACHE: [Auto-Refresh] Страховочное обновление кэша игроков...")
+        self._update_cache(full=True)
         self._start_timer() # Сразу же планируем *следующее* обновление
 
     # ▼▼▼ ЗДЕСЬ БЫЛА ОШИБКА ОТСТУПА, ТЕПЕРЬ ИСПРАВЛЕНО ▼▼▼
+    @staticmethod
+    def _make_entry(nickname, wins, losses, real_roles):
+        """Запись кэша для одного игрока (то, что нужно кнопкам выбора)."""
+        total = wins + losses
+        wr = round((wins / total * 100), 1) if total > 0 else 0
+        return {
+            'nickname': nickname,
+            'wr_str': f"{wr}%",
+            'pos_str': get_player_positions_str(real_roles) 
+        }
+
+    @staticmethod
+    def _group_roles(role_rows):
+        """[(nick, role_pos), ...] -> {nick: [role_pos, ...]}"""
+        player_real_roles = {}
+        for nick, role_pos in role_rows:
+            player_real_roles.setdefault(nick, []).append(role_pos)
+        return player_real_roles
+
     def _fetch_from_db(self):
         """
-        Единственная функция, которая реально обращается к БД за 
-        ПОЛНЫМ списком игроков.
+        ПОЛНОЕ чтение: все игроки и все их реальные роли.
+        Возвращает (записи, метка времени БД) или None при ошибке.
         """
-        conn = get_db_conn()
-        if not conn:
-            print("CACHE: [ERROR] Не удалось подключиться к БД для обновления кэша.")
-            return None # Оставляем старые данные в кэше
+        with db_connection() as conn:
+            if not conn:
+                print("CACHE: [ERROR] Не удалось подключиться к БД для обновления кэша.")
+                return None # Оставляем старые данные в кэше
 
-        players_list = []
-        try:
-            with conn:
-                with conn.cursor() as cur:
-                    # 1. Получаем основные данные игроков
-                    cur.execute('SELECT nickname, wins, losses, positions FROM players ORDER BY nickname')
-                    players = cur.fetchall()
-                    
-                    # 2. Получаем РЕАЛЬНЫЕ роли (ТОЛЬКО ГДЕ ЕСТЬ ИГРЫ)
-                    cur.execute('SELECT player_nickname, role_position FROM player_role_stats WHERE (wins + losses) > 0')
-                    role_rows = cur.fetchall()
+            try:
+                with conn:
+                    with conn.cursor() as cur:
+                        marker = self._snapshot_marker(cur)
+                        # 1. Получаем основные данные игроков
+                        cur.execute('SELECT nickname, wins, losses FROM players')
+                        players = cur.fetchall()
                     
-                    # Группируем реальные роли
-                    player_real_roles = {}
-                    for nick, role_pos in role_rows:
-                        if nick not in player_real_roles:
-                            player_real_roles[nick] = []
-                        player_real_roles[nick].append(role_pos)
-
-                    # 3. Собираем итоговый список для кэша
-                    for nickname, wins, losses, positions_json in players:
-                        total = wins + losses
-                        wr = round((wins / total * 100), 1) if total > 0 else 0
-                        
-                        # Берем роли из словаря реальных ролей
-                        real_roles = player_real_roles.get(nickname, [])
-                        
-                        players_list.append({
-                            'nickname': nickname,
-                            'wr_str': f"{wr}%",
-                            'pos_str': get_player_positions_str(real_roles) 
-                        })
-            return players_list
-        except Exception as e:
-            print(f"CACHE: [ERROR] Ошибка при чтении из БД: {e}")
-            return None 
-        finally:
-            put_db_conn(conn)
+                        # 2. Получаем РЕАЛЬНЫЕ роли (ТОЛЬКО ГДЕ ЕСТЬ ИГРЫ)
+                        cur.execute('SELECT player_nickname, role_position FROM player_role_stats WHERE (wins + losses) > 0')
+                        player_real_roles = self._group_roles(cur.fetchall())
+
+                entries = [self._make_entry(nickname, wins, losses, player_real_roles.get(nickname, []))
+                           for nickname, wins, losses in players]
+                return entries, marker
+            except Exception as e:
+                print(f"CACHE: [ERROR] Ошибка при чтении из БД: {e}")
+                return None 
+
+    @staticmethod
+    def _snapshot_marker(cur):
+        """xmin текущего снимка (32-битный xid, как у системной колонки xmin)."""
+        cur.execute('SELECT mod(txid_snapshot_xmin(txid_current_snapshot()), 4294967296)')
+        return cur.fetchone()[0]
+
+    def _fetch_delta(self, since):
+        """
+        Только строки, записанные транзакциями не старше xmin снимка `since`:
+        измененные игроки (изменение роли тоже переписывает строку игрока),
+        их роли и удаленные ники. age() сравнивает xid с учетом переполнения.
+        Возвращает (записи, удаленные ники, метка) или None.
+        """
+        with db_connection() as conn:
+            if not conn:
+                print("CACHE: [ERROR] Не удалось подключиться к БД для обновления кэша.")
+                return None
 
-    def _update_cache(self):
-        """Потокобезопасно обновляет внутренний список игроков."""
-        new_players = self._fetch_from_db()
-        if new_players is not None:
+            try:
+                with conn:
+                    with conn.cursor() as cur:
+                        marker = self._snapshot_marker(cur)
+                        cur.execute(
+                            "SELECT nickname, wins, losses FROM players "
+                            "WHERE age(xmin) <= age(%s::text::xid)", (since,))
+                        players = cur.fetchall()
+                        player_real_roles = {}
+                        if players:
+                            cur.execute(
+                                'SELECT player_nickname, role_position FROM player_role_stats '
+                                'WHERE player_nickname = ANY(%s) AND (wins + losses) > 0',
+                                ([row[0] for row in players],))
+                            player_real_roles = self._group_roles(cur.fetchall())
+                        cur.execute(
+                            "SELECT nickname FROM player_deletions "
+                            "WHERE age(xmin) <= age(%s::text::xid)", (since,))
+                        deleted = {row[0] for row in cur.fetchall()}
+
+                entries = [self._make_entry(nickname, wins, losses, player_real_roles.get(nickname, []))
+                           for nickname, wins, losses in players]
+                # Ник, который удалили и снова добавили, есть среди измененных - его не удаляем
+                deleted -= {entry['nickname'] for entry in entries}
+                return entries, deleted, marker
+            except Exception as e:
+                print(f"CACHE: [ERROR] Ошибка при чтении изменений из БД: {e}")
+                return None
+
+    def _update_cache(self, full=False):
+        """
+        Потокобезопасно обновляет кэш. По умолчанию - дельта: из БД читаются
+        только измененные с прошлого раза строки и вливаются в индекс по нику.
+        Полное чтение - при первом запуске и по страховочному таймеру.
+        Возвращает True, если кэш обновлен.
+        """
+        with self.refresh_lock:
             with self.lock:
-                self.players = new_players
-                self.last_updated = time.time()
-            print(f"CACHE: [Success] Кэш обновлен. {len(self.players)} игроков.")
-
-    def get_players(self):
-        """Потокобезопасно получает список игроков из кэша."""
+                # Все инвалидации до этого момента будут учтены этим чтением
+                target_version = self.dirty_version
+            updated = self._refresh(full)
+            if updated:
+                with self.lock:
+                    self.fresh_version = max(self.fresh_version, target_version)
+                    self.fresh_cond.notify_all()
+                    behind = self.fresh_version < self.dirty_version
+                if behind:
+                    # Запись, о которой сообщили во время чтения, могла в него не попасть
+                    self._schedule_refresh(self.DEBOUNCE_SECONDS)
+            return updated
+
+    def _refresh(self, full):
+        """(Под self.refresh_lock) Само чтение из БД и слияние в индекс."""
+        with self.lock:
+            since = self.delta_marker
+        if full or since is None:
+            fetched = self._fetch_from_db()
+            if fetched is None: return False
+            entries, marker = fetched
+            with self.lock:
+                self.by_nick = {entry['nickname']: entry for entry in entries}
+                self._apply(marker)
+            print(f"CACHE: [Success] Кэш обновлен полностью. {len(self.players)} игроков.")
+            return True
+
+        fetched = self._fetch_delta(since)
+        if fetched is None: return False
+        entries, deleted, marker = fetched
         with self.lock:
+            for entry in entries:
+                self.by_nick[entry['nickname']] = entry
+            for nickname in deleted:
+                self.by_nick.pop(nickname, None)
+            self._apply(marker)
+        print(f"CACHE: [Success] Дельта: изменено {len(entries)}, удалено {len(deleted)}. "
+              f"Всего {len(self.players)} игроков.")
+        return True
+
+    def _apply(self, marker):
+        """(Под self.lock) Пересобирает отсортированный список из индекса."""
+        # Порядок как у прежнего ORDER BY nickname (без учета регистра)
+        new_players = [self.by_nick[nick] for nick in sorted(self.by_nick, key=lambda n: (n.lower(), n))]
+        if new_players != self.players:
+            self.version += 1
+        self.players = new_players
+        self.delta_marker = marker
+        self.last_updated = time.time()
+
+    def get_players(self, wait_fresh=False, timeout=None):
+        """
+        Потокобезопасно получает список игроков из кэша.
+        wait_fresh=True: если были записи, которые кэш еще не учел, ждем
+        фонового обновления (не дольше timeout, по умолчанию FRESH_WAIT_TIMEOUT),
+        чтобы увидеть свои же изменения. Иначе отдаем сразу то, что есть.
+        """
+        with self.lock:
+            if wait_fresh:
+                target_version = self.dirty_version
+                if not self.fresh_cond.wait_for(lambda: self.fresh_version >= target_version,
+                                                timeout or self.FRESH_WAIT_TIMEOUT):
+                    print("CACHE: [WARN] Не дождались свежего кэша, отдаем текущий.")
             # Возвращаем копию, чтобы ее нельзя было случайно изменить извне
             return self.players.copy() 
 
+    def get_picker_rows(self):
+        """
+        Готовые строки клавиатуры выбора игроков (/creategame) для текущей
+        версии кэша: (version, {nickname: номер строки}, [(строка, строка с ✅), ...]).
+        Собираются один раз на версию; строки - списки кнопок, их можно
+        напрямую класть в InlineKeyboardMarkup(keyboard=...).
+        """
+        with self.lock:
+            if self.picker_rows is None or self.picker_rows[0] != self.version:
+                index, rows = {}, []
+                for player in self.players:
+                    # (player['pos_str']) ТЕПЕРЬ ПОКАЗЫВАЕТ РЕАЛЬНЫЕ РОЛИ
+                    label = f"{player['nickname']} ({player['pos_str']}) | WR: {player['wr_str']}"
+                    callback_data = f"select_player_{player['nickname']}"
+                    index[player['nickname']] = len(rows)
+                    rows.append((
+                        [types.InlineKeyboardButton(label, callback_data=callback_data)],
+                        [types.InlineKeyboardButton(f"✅ {label}", callback_data=callback_data)]
+                    ))
+                self.picker_rows = (self.version, index, rows)
+            return self.picker_rows
+
+    def get_action_rows(self, action_prefix):
+        """Готовые строки "👤 ник" (по две кнопки) для админских списков; кэш на (версия, префикс)."""
+        with self.lock:
+            cached = self.action_rows.get(action_prefix)
+            if cached is None or cached[0] != self.version:
+                buttons = [types.InlineKeyboardButton(f"👤 {player['nickname']}",
+                                                      callback_data=f"{action_prefix}_{player['nickname']}")
+                           for player in self.players]
+                rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+                self.action_rows[action_prefix] = cached = (self.version, rows)
+            return cached[1]
+
     def invalidate(self):
         """
-        Принудительно и немедленно обновляет кэш.
-        Вызывается после добавления/удаления игрока.
+        Помечает кэш устаревшим и планирует ОДНО фоновое обновление через
+        DEBOUNCE_SECONDS. Не ходит в БД и не блокирует обработчик: серия
+        записей подряд (например, правка ролей) дает одно обновление.
+        Вызывается после любой записи в players/player_role_stats и по NOTIFY.
+        Обновление планируем всегда, даже при активном LISTEN: таймер один на
+        серию, а без него запись обработчика могла бы так и не получить
+        обновления (уведомление потерялось или уже было учтено раньше).
         """
-        print("CACHE: [Invalidate] Принудительное обновление кэша...")
-        # (Не нужен таймер, обновляем прямо сейчас)
-        self._update_cache()
+        with self.lock:
+            self.dirty_version += 1
+        self._schedule_refresh(self.DEBOUNCE_SECONDS)
+
+    def _schedule_refresh(self, delay):
+        """Запускает таймер обновления, если он еще не запланирован."""
+        with self.lock:
+            if self.refresh_timer is not None:
+                return
+            self.refresh_timer = Timer(delay, self._scheduled_refresh)
+            self.refresh_timer.daemon = True
+            self.refresh_timer.start()
+
+    def _scheduled_refresh(self):
+        """Срабатывание отложенного обновления."""
+        with self.lock:
+            self.refresh_timer = None
+        if not self._update_cache():
+            # БД недоступна: кэш остается "грязным", пробуем позже
+            self._schedule_refresh(self.RETRY_SECONDS)
 
 # --- Глобально создаем ОДИН объект кэша ---
-player_cache = PlayerCache(refresh_interval=30) # Обновление каждые 30 сек
+# Обновление по NOTIFY + страховка раз в PLAYER_CACHE_SAFETY_INTERVAL
+player_cache = PlayerCache() if not IS_BALANCE_WORKER else None
 
 # =========================================================================
 # ========== КОНЕЦ БЛОКА: НОВЫЙ КЭШ ИГРОКОВ (PlayerCache) ==========
 # =========================================================================
 
 
-# ===== СОЗДАНИЕ ТАБЛИЦ (ГАРАНТИРУЕМ, ЧТО ОНИ ЕСТЬ) =====
-def create_tables():
-    """Создает все таблицы, если они еще не существуют."""
-    conn = get_db_conn()
-    if not conn:
-        print("❌ [DB INIT] Не могу создать таблицы. Нет подключения к БД.")
-        return
-        
+# ===== ВЕРСИЯ СТАТИСТИКИ =====
+# Растет после каждой записи в статистику игроков (игры, откаты, герои,
+# MMR, роли...). Кэши, зависящие от статистики, добавляют ее в ключ.
+stats_version = 0
+stats_version_lock = Lock()
+
+def get_stats_version():
+    return stats_version
+
+def bump_stats_version():
+    """Вызывается после каждой успешной записи в статистику."""
+    global stats_version
+    with stats_version_lock:
+        stats_version += 1
+        return stats_version
+
+# ===== ВИТРИНЫ СТАТИСТИКИ (MATERIALIZED VIEW) =====
+# GROUP BY по player_heroes/player_role_stats на каждый запрос заменен
+# готовыми витринами. Их пересчитывает фоновый stats_view_refresher после
+# записей в эти таблицы (игра, откат, ручные правки героев и ролей).
+# CONCURRENTLY не блокирует читателей, но требует уникальный индекс.
+# Определения витрин живут в миграциях (1 - базовая схема, 7 - mv_role_stats);
+# менять витрину - только новой миграцией. Здесь лишь список для REFRESH.
+STATS_VIEWS = ('mv_league_hero_stats', 'mv_role_stats', 'mv_player_hero_rankings')
+
+def refresh_stats_views(conn):
+    """
+    REFRESH MATERIALIZED VIEW CONCURRENTLY для всех витрин.
+    Вызывается из StatsViewRefresher ДО bump_stats_version, иначе кэш отчетов
+    успеет закэшировать старую витрину под новой версией. Возвращает False
+    при ошибке (витрины догонят данные при повторе).
+    """
+    started = time.time()
     try:
-        with conn: # Авто-commit или rollback
+        with conn:
             with conn.cursor() as cur:
-                cur.execute('''
-                    CREATE TABLE IF NOT EXISTS players (
-                        id SERIAL PRIMARY KEY, nickname TEXT UNIQUE NOT NULL, rating INTEGER DEFAULT 0,
-                        wins INTEGER DEFAULT 0, losses INTEGER DEFAULT 0, mmr INTEGER DEFAULT 0,
-                        positions TEXT DEFAULT '[]', total_kills INTEGER DEFAULT 0,
-                        total_deaths INTEGER DEFAULT 0, total_assists INTEGER DEFAULT 0
-                    )
-                ''')
-                cur.execute('''
-                    CREATE TABLE IF NOT EXISTS games (
-                        id SERIAL PRIMARY KEY, screenshot_file_id TEXT, radiant_players TEXT,
-                        dire_players TEXT, result TEXT, date TEXT, time TEXT, description TEXT
-                    )
-                ''')
-                cur.execute('''
-                    CREATE TABLE IF NOT EXISTS player_game_stats (
-                        id SERIAL PRIMARY KEY, game_id INTEGER, player_nickname TEXT, hero TEXT,
-                        kills INTEGER, deaths INTEGER, assists INTEGER, team TEXT, position INTEGER DEFAULT 0,
-                        rating_delta INTEGER DEFAULT 0,
-                        FOREIGN KEY (game_id) REFERENCES games(id) ON DELETE CASCADE
-                    )
-                ''')
-                cur.execute("""
-                    ALTER TABLE player_game_stats
-                    ADD COLUMN IF NOT EXISTS rating_delta INTEGER DEFAULT 0
-                """)
-                cur.execute('''
-                    CREATE TABLE IF NOT EXISTS player_heroes (
-                        id SERIAL PRIMARY KEY, player_nickname TEXT, hero_name TEXT,
-                        wins INTEGER DEFAULT 0, losses INTEGER DEFAULT 0, total_kills INTEGER DEFAULT 0,
-                        total_deaths INTEGER DEFAULT 0, total_assists INTEGER DEFAULT 0,
-                        UNIQUE(player_nickname, hero_name),
-                        FOREIGN KEY (player_nickname) REFERENCES players(nickname) ON DELETE CASCADE
-                    )
-                ''')
-                cur.execute('''
-                    CREATE TABLE IF NOT EXISTS player_role_stats (
-                        id SERIAL PRIMARY KEY, player_nickname TEXT, role_position INTEGER,
-                        wins INTEGER DEFAULT 0, losses INTEGER DEFAULT 0,
-                        UNIQUE(player_nickname, role_position),
-                        FOREIGN KEY (player_nickname) REFERENCES players(nickname) ON DELETE CASCADE
-                    )
-                ''')
-                cur.execute('''
-                    CREATE TABLE IF NOT EXISTS user_activity (
-                        id SERIAL PRIMARY KEY, user_id BIGINT UNIQUE NOT NULL, username TEXT,
-                        first_name TEXT, last_name TEXT, first_visit TEXT, last_visit TEXT,
-                        total_commands INTEGER DEFAULT 0
-                    )
-                ''')
-        print("✅ [DB INIT] Таблицы успешно проверены/созданы в PostgreSQL.")
+                for view in STATS_VIEWS:
+                    cur.execute(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {view}')
+        print(f"📊 [VIEWS] Витрины обновлены за {(time.time() - started) * 1000:.0f} мс")
+        return True
     except Exception as e:
-        print(f"🔥🔥🔥 [DB INIT] Ошибка при создании таблиц: {e}")
-    finally:
-        put_db_conn(conn)
+        print(f"❌ [VIEWS] Ошибка обновления витрин: {e}")
+        return False
 
-user_state = {}
+class StatsViewRefresher:
+    """
+    Пересчет витрин вне обработчиков: запись только планирует его, серия
+    записей подряд (правка ролей, несколько игр) дает один REFRESH через
+    DEBOUNCE_SECONDS. После пересчета еще раз растет версия статистики и
+    сбрасываются профили затронутых игроков - до этого отчеты по витринам
+    отдают данные до записи (как и раньше, пока шел REFRESH).
+    """
+    DEBOUNCE_SECONDS = 2
+    # Повтор после ошибки БД (сек)
+    RETRY_SECONDS = 30
 
-def log_user_activity(user_id, message):
-    conn = get_db_conn()
-    if not conn: return
+    def __init__(self):
+        self.lock = Lock()
+        self.pending = set() # Ники, чьи профили сбросить после пересчета
+        self.dirty = False
+        self.timer = None
+
+    def schedule(self, nicknames):
+        with self.lock:
+            self.pending.update(nicknames)
+            self.dirty = True
+        self._schedule(self.DEBOUNCE_SECONDS)
+
+    def _schedule(self, delay):
+        """Запускает таймер, если он еще не запланирован."""
+        with self.lock:
+            if self.timer is not None:
+                return
+            self.timer = Timer(delay, self._run)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _run(self):
+        with self.lock:
+            self.timer = None
+            if not self.dirty:
+                return
+            nicknames, self.pending, self.dirty = self.pending, set(), False
+        refreshed = False
+        with db_connection() as conn:
+            if conn:
+                refreshed = refresh_stats_views(conn)
+        if not refreshed:
+            # Запись новее витрин осталась: вернем ники и попробуем позже
+            with self.lock:
+                self.pending.update(nicknames)
+                self.dirty = True
+            self._schedule(self.RETRY_SECONDS)
+            return
+        bump_stats_version()
+        profile_cache.invalidate(nicknames)
+
+stats_view_refresher = StatsViewRefresher()
+
+def stats_changed(nicknames, views=False):
+    """
+    Вызывается сразу после коммита записи в статистику, ДО ответа в чат:
+    версия статистики, кэши профилей и игроков; views=True (запись трогала
+    героев/роли) - еще и фоновый пересчет витрин. Ответ бота может упасть
+    (сообщение удалено, сеть), а кэши должны сброситься в любом случае.
+    """
+    nicknames = list(nicknames)
+    bump_stats_version()
+    profile_cache.invalidate(nicknames)
+    player_cache.invalidate()
+    if views:
+        stats_view_refresher.schedule(nicknames)
+
+def reply_safely(send, *args, **kwargs):
+    """Ответ после уже закоммиченной записи: его ошибка не должна выглядеть как ошибка записи."""
+    try:
+        return send(*args, **kwargs)
+    except Exception as e:
+        print(f"⚠️ Запись сохранена, но ответ не отправлен: {e}")
+
+# ===== МИГРАЦИИ СХЕМЫ =====
+# Схема меняется только миграциями. Применённые версии лежат в schema_version,
+# при старте выполняются лишь новые. Каждая миграция - своя транзакция:
+# упала - откатилась целиком, следующие не запускаются до перезапуска.
+# Правило: уже выпущенные миграции не редактируем, только добавляем новые.
+
+def migrate_baseline(cur):
+    """Схема до появления миграций (идемпотентна: на старых базах ничего не ломает)."""
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS players (
+            id SERIAL PRIMARY KEY, nickname TEXT UNIQUE NOT NULL, rating INTEGER DEFAULT 0,
+            wins INTEGER DEFAULT 0, losses INTEGER DEFAULT 0, mmr INTEGER DEFAULT 0,
+            positions TEXT DEFAULT '[]', total_kills INTEGER DEFAULT 0,
+            total_deaths INTEGER DEFAULT 0, total_assists INTEGER DEFAULT 0
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS games (
+            id SERIAL PRIMARY KEY, screenshot_file_id TEXT, radiant_players TEXT,
+            dire_players TEXT, result TEXT, date TEXT, time TEXT, description TEXT
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS player_game_stats (
+            id SERIAL PRIMARY KEY, game_id INTEGER, player_nickname TEXT, hero TEXT,
+            kills INTEGER, deaths INTEGER, assists INTEGER, team TEXT, position INTEGER DEFAULT 0,
+            rating_delta INTEGER DEFAULT 0,
+            FOREIGN KEY (game_id) REFERENCES games(id) ON DELETE CASCADE
+        )
+    ''')
+    cur.execute("""
+        ALTER TABLE player_game_stats
+        ADD COLUMN IF NOT EXISTS rating_delta INTEGER DEFAULT 0
+    """)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS player_heroes (
+            id SERIAL PRIMARY KEY, player_nickname TEXT, hero_name TEXT,
+            wins INTEGER DEFAULT 0, losses INTEGER DEFAULT 0, total_kills INTEGER DEFAULT 0,
+            total_deaths INTEGER DEFAULT 0, total_assists INTEGER DEFAULT 0,
+            UNIQUE(player_nickname, hero_name),
+            FOREIGN KEY (player_nickname) REFERENCES players(nickname) ON DELETE CASCADE
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS player_role_stats (
+            id SERIAL PRIMARY KEY, player_nickname TEXT, role_position INTEGER,
+            wins INTEGER DEFAULT 0, losses INTEGER DEFAULT 0,
+            UNIQUE(player_nickname, role_position),
+            FOREIGN KEY (player_nickname) REFERENCES players(nickname) ON DELETE CASCADE
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS user_activity (
+            id SERIAL PRIMARY KEY, user_id BIGINT UNIQUE NOT NULL, username TEXT,
+            first_name TEXT, last_name TEXT, first_visit TEXT, last_visit TEXT,
+            total_commands INTEGER DEFAULT 0
+        )
+    ''')
+    # Уведомления для PlayerCache: один NOTIFY на оператор (и на транзакцию,
+    # Postgres склеивает одинаковые), payload - имя таблицы
+    cur.execute('''
+        CREATE OR REPLACE FUNCTION notify_player_cache() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{channel}', TG_TABLE_NAME);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    '''.format(channel=PLAYER_CACHE_CHANNEL))
+    for table in ('players', 'player_role_stats'):
+        cur.execute(f'DROP TRIGGER IF EXISTS {table}_notify_cache ON {table}')
+        cur.execute(f'''
+            CREATE TRIGGER {table}_notify_cache
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE PROCEDURE notify_player_cache()
+        ''')
+    # Метки изменений для дельта-обновления PlayerCache:
+    # players.updated_at ставит триггер (код бота его не трогает),
+    # изменения ролей "трогают" строку игрока, удаления пишутся в player_deletions
+    cur.execute('ALTER TABLE players ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now()')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_players_updated_at ON players (updated_at)')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS player_deletions (
+            nickname TEXT PRIMARY KEY, deleted_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_player_deletions_deleted_at ON player_deletions (deleted_at)')
+    cur.execute('''
+        CREATE OR REPLACE FUNCTION touch_player_updated_at() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at := now();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    cur.execute('''
+        CREATE OR REPLACE FUNCTION touch_player_from_role() RETURNS trigger AS $$
+        DECLARE
+            nick TEXT;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN nick := OLD.player_nickname; ELSE nick := NEW.player_nickname; END IF;
+            UPDATE players SET updated_at = now() WHERE nickname = nick;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    cur.execute('''
+        CREATE OR REPLACE FUNCTION log_player_deletion() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO player_deletions (nickname, deleted_at) VALUES (OLD.nickname, now())
+            ON CONFLICT (nickname) DO UPDATE SET deleted_at = EXCLUDED.deleted_at;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    for trigger, ddl in (
+        ('players_touch_updated_at', 'BEFORE UPDATE ON players FOR EACH ROW EXECUTE PROCEDURE touch_player_updated_at()'),
+        ('player_role_stats_touch_player', 'AFTER INSERT OR UPDATE OR DELETE ON player_role_stats '
+                                           'FOR EACH ROW EXECUTE PROCEDURE touch_player_from_role()'),
+        ('players_log_deletion', 'AFTER DELETE ON players FOR EACH ROW EXECUTE PROCEDURE log_player_deletion()'),
+    ):
+        table = ddl.split(' ON ')[1].split()[0]
+        cur.execute(f'DROP TRIGGER IF EXISTS {trigger} ON {table}')
+        cur.execute(f'CREATE TRIGGER {trigger} {ddl}')
+    # Витрины агрегатов по героям и ролям (см. refresh_stats_views)
+    # Герои лиги: популярность, WR и KDA по всем игрокам
+    cur.execute('''
+        CREATE MATERIALIZED VIEW IF NOT EXISTS mv_league_hero_stats AS
+            SELECT 
+                hero_name,
+                SUM(wins + losses) AS total_games,
+                SUM(wins) AS wins,
+                SUM(losses) AS losses,
+                (SUM(CAST(wins AS FLOAT)) / SUM(wins + losses)) * 100 AS winrate,
+                (CASE 
+                    WHEN SUM(total_deaths) = 0 THEN (SUM(total_kills + total_assists))
+                    ELSE (SUM(CAST(total_kills AS FLOAT) + total_assists)) / SUM(total_deaths)
+                END) AS kda
+            FROM player_heroes
+            WHERE (wins + losses) > 0
+            GROUP BY hero_name
+    ''')
+    # Роли игроков с WR и местом игрока среди всех на этой роли
+    cur.execute('''
+        CREATE MATERIALIZED VIEW IF NOT EXISTS mv_role_stats AS
+            SELECT 
+                player_nickname, role_position, wins, losses,
+                (wins + losses) AS games,
+                (CASE WHEN (wins + losses) = 0 THEN 0 ELSE (CAST(wins AS FLOAT) / (wins + losses)) * 100 END) AS wr,
+                RANK() OVER (
+                    PARTITION BY role_position
+                    ORDER BY (CASE WHEN (wins + losses) = 0 THEN 0 ELSE CAST(wins AS FLOAT) / (wins + losses) END) DESC
+                ) AS role_place
+            FROM player_role_stats
+    ''')
+    # Герои каждого игрока: место в его личном топе (по WR) уже посчитано
+    cur.execute('''
+        CREATE MATERIALIZED VIEW IF NOT EXISTS mv_player_hero_rankings AS
+            SELECT 
+                player_nickname, hero_name, wins, losses, total_kills, total_deaths, total_assists,
+                (wins + losses) AS games,
+                (CAST(wins AS FLOAT) / (wins + losses)) * 100 AS wr,
+                (CASE 
+                    WHEN total_deaths = 0 THEN (total_kills + total_assists)
+                    ELSE (CAST(total_kills AS FLOAT) + total_assists) / total_deaths
+                END) AS kda,
+                ROW_NUMBER() OVER (
+                    PARTITION BY player_nickname
+                    ORDER BY (CAST(wins AS FLOAT) / (wins + losses)) DESC, hero_name
+                ) AS hero_rank
+            FROM player_heroes
+            WHERE (wins + losses) > 0
+    ''')
+    for index_ddl in (
+        # Уникальные индексы нужны для REFRESH ... CONCURRENTLY
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_league_hero_stats_hero ON mv_league_hero_stats (hero_name)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_role_stats_player_role ON mv_role_stats (player_nickname, role_position)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_player_hero_rankings_player_hero ON mv_player_hero_rankings (player_nickname, hero_name)',
+        # Под чтение: топ героев лиги, топ героев игрока, лучший игрок на герое
+        'CREATE INDEX IF NOT EXISTS idx_mv_league_hero_stats_games ON mv_league_hero_stats (total_games DESC, hero_name)',
+        'CREATE INDEX IF NOT EXISTS idx_mv_player_hero_rankings_rank ON mv_player_hero_rankings (player_nickname, hero_rank)',
+        'CREATE INDEX IF NOT EXISTS idx_mv_player_hero_rankings_best ON mv_player_hero_rankings (hero_name, kda DESC, wr DESC, wins DESC)',
+    ):
+        cur.execute(index_ddl)
+
+MIGRATIONS = [
+    (1, "базовая схема", migrate_baseline),
+    # Индексы под горячие запросы, которые раньше читали таблицы целиком.
+    # player_role_stats WHERE player_nickname отдельного индекса не требует:
+    # его уже обслуживает UNIQUE(player_nickname, role_position)
+    (2, "индекс player_game_stats.game_id (откат игры, каскадное удаление)", [
+        'CREATE INDEX IF NOT EXISTS idx_player_game_stats_game_id ON player_game_stats (game_id)',
+    ]),
+    (3, "индекс player_heroes.hero_name (статистика героев лиги)", [
+        'CREATE INDEX IF NOT EXISTS idx_player_heroes_hero_name ON player_heroes (hero_name)',
+    ]),
+    (4, "индекс games (date, time) для /games", [
+        'CREATE INDEX IF NOT EXISTS idx_games_date_time ON games (date, time)',
+    ]),
+    # Настоящее время игры вместо двух TEXT-полей: /games листается по
+    # (played_at, id) ключом, а не OFFSET. date/time остаются для отображения.
+    # Нераспознанные строки (руками правленные) уходят в начало истории.
+    (5, "games.played_at (timestamptz) + индекс для постраничного /games", [
+        'ALTER TABLE games ADD COLUMN IF NOT EXISTS played_at TIMESTAMPTZ',
+        '''
+            UPDATE games SET played_at = CASE
+                WHEN date ~ '^\\d{4}-\\d{2}-\\d{2}$' AND time ~ '^\\d{1,2}:\\d{2}$'
+                    THEN to_timestamp(date || ' ' || time, 'YYYY-MM-DD HH24:MI')
+                WHEN date ~ '^\\d{4}-\\d{2}-\\d{2}$'
+                    THEN to_timestamp(date, 'YYYY-MM-DD')
+                ELSE to_timestamp(0)
+            END
+            WHERE played_at IS NULL
+        ''',
+        'ALTER TABLE games ALTER COLUMN played_at SET DEFAULT now()',
+        'ALTER TABLE games ALTER COLUMN played_at SET NOT NULL',
+        'CREATE INDEX IF NOT EXISTS idx_games_played_at_id ON games (played_at, id)',
+        # Сортировка по date/time больше нигде не используется
+        'DROP INDEX IF EXISTS idx_games_date_time',
+    ]),
+    # До пакетной записи игры rating_delta не заполнялся и везде лежит 0 по умолчанию.
+    # NULL отличает такие строки от настоящего 0 (проигрыш на рейтинге 0):
+    # их откат идет по правилу прежнего отката (см. undo_games).
+    # record_game всегда пишет дельту, и у победителей она +RATING_CHANGE, поэтому
+    # игра без записанной дельты - та, где у ВСЕХ строк 0. Нули в остальных играх настоящие.
+    (6, "player_game_stats.rating_delta: NULL для игр без записанной дельты", [
+        'ALTER TABLE player_game_stats ALTER COLUMN rating_delta DROP DEFAULT',
+        '''
+            UPDATE player_game_stats SET rating_delta = NULL
+            WHERE game_id IN (
+                SELECT game_id FROM player_game_stats
+                GROUP BY game_id
+                HAVING bool_and(rating_delta = 0)
+            )
+        ''',
+    ]),
+    # Место игрока на роли (role_place) нигде не читалось, а RANK() по всем
+    # ролям пересчитывался на каждом REFRESH
+    (7, "mv_role_stats без role_place", [
+        'DROP MATERIALIZED VIEW IF EXISTS mv_role_stats',
+        '''
+            CREATE MATERIALIZED VIEW mv_role_stats AS
+                SELECT 
+                    player_nickname, role_position, wins, losses,
+                    (wins + losses) AS games,
+                    (CASE WHEN (wins + losses) = 0 THEN 0 ELSE (CAST(wins AS FLOAT) / (wins + losses)) * 100 END) AS wr
+                FROM player_role_stats
+        ''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_role_stats_player_role ON mv_role_stats (player_nickname, role_position)',
+    ]),
+    # Строчный триггер на player_role_stats делал UPDATE players (и NOTIFY) на
+    # каждую строку ролей - запись игры давала по UPDATE на игрока. Теперь один
+    # UPDATE на оператор по таблице переходов. Дельта PlayerCache читает xmin,
+    # а не updated_at, поэтому индекс по updated_at больше не нужен
+    (8, "player_role_stats: триггер уровня оператора вместо строчного", [
+        '''
+            CREATE OR REPLACE FUNCTION touch_players_from_roles() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    UPDATE players SET updated_at = now()
+                    WHERE nickname IN (SELECT player_nickname FROM changed_old_roles);
+                ELSE
+                    UPDATE players SET updated_at = now()
+                    WHERE nickname IN (SELECT player_nickname FROM changed_new_roles);
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        ''',
+        'DROP TRIGGER IF EXISTS player_role_stats_touch_player ON player_role_stats',
+        'DROP FUNCTION IF EXISTS touch_player_from_role()',
+        # Таблицы переходов разрешены только у триггеров на одно событие
+        'CREATE TRIGGER player_role_stats_touch_players_insert AFTER INSERT ON player_role_stats '
+        'REFERENCING NEW TABLE AS changed_new_roles FOR EACH STATEMENT EXECUTE PROCEDURE touch_players_from_roles()',
+        'CREATE TRIGGER player_role_stats_touch_players_update AFTER UPDATE ON player_role_stats '
+        'REFERENCING NEW TABLE AS changed_new_roles FOR EACH STATEMENT EXECUTE PROCEDURE touch_players_from_roles()',
+        'CREATE TRIGGER player_role_stats_touch_players_delete AFTER DELETE ON player_role_stats '
+        'REFERENCING OLD TABLE AS changed_old_roles FOR EACH STATEMENT EXECUTE PROCEDURE touch_players_from_roles()',
+        'DROP INDEX IF EXISTS idx_players_updated_at',
+    ]),
+]
+
+# Ключ pg_advisory_lock: два процесса (gunicorn + локальный запуск) не мигрируют одновременно
+MIGRATIONS_LOCK_KEY = 4242001
+
+def apply_migration(cur, migration):
+    """migration - функция(cur) или список SQL-команд."""
+    if callable(migration):
+        migration(cur)
+    else:
+        for sql in migration:
+            cur.execute(sql)
+
+def run_migrations(conn):
+    """Применяет новые миграции по порядку. Возвращает число примененных."""
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY, name TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            ''')
+            cur.execute('SET LOCAL statement_timeout = 0')
+            cur.execute('SELECT pg_advisory_lock(%s)', (MIGRATIONS_LOCK_KEY,))
+    applied_count = 0
     try:
         with conn:
             with conn.cursor() as cur:
-                username = message.from_user.username or "no_username"
-                first_name = message.from_user.first_name or "Unknown"
-                last_name = message.from_user.last_name or ""
-                now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                cur.execute('SELECT total_commands FROM user_activity WHERE user_id=%s', (user_id,))
-                row = cur.fetchone()
-                if row:
-                    total_commands = row[0] + 1
-                    cur.execute(
-                        '''UPDATE user_activity SET last_visit=%s, total_commands=%s WHERE user_id=%s''',
-                        (now, total_commands, user_id)
-                    )
-                else:
-                    cur.execute(
-                        '''INSERT INTO user_activity (user_id, username, first_name, last_name, first_visit, last_visit, total_commands)
-                           VALUES (%s, %s, %s, %s, %s, %s, %s)''',
-                        (user_id, username, first_name, last_name, now, now, 1)
-                    )
-    except Exception as e:
-        print(f"Ошибка логирования: {e}")
+                cur.execute('SELECT version FROM schema_version')
+                applied = {row[0] for row in cur.fetchall()}
+        for version, name, migration in MIGRATIONS:
+            if version in applied: continue
+            started = time.time()
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute('SET LOCAL statement_timeout = 0')
+                    apply_migration(cur, migration)
+                    cur.execute('INSERT INTO schema_version (version, name) VALUES (%s, %s)', (version, name))
+            applied_count += 1
+            print(f"🧱 [MIGRATIONS] {version}: {name} ({(time.time() - started) * 1000:.0f} мс)")
     finally:
-        put_db_conn(conn)
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute('SELECT pg_advisory_unlock(%s)', (MIGRATIONS_LOCK_KEY,))
+    return applied_count
+
+# ===== СОЗДАНИЕ ТАБЛИЦ (ГАРАНТИРУЕМ, ЧТО ОНИ ЕСТЬ) =====
+def create_tables():
+    """Доводит схему до последней версии (см. MIGRATIONS)."""
+    with db_connection() as conn:
+        if not conn:
+            print("❌ [DB INIT] Не могу создать таблицы. Нет подключения к БД.")
+            return
+        
+        try:
+            applied_count = run_migrations(conn)
+            print(f"✅ [DB INIT] Схема актуальна (версия {MIGRATIONS[-1][0]}, применено миграций: {applied_count}).")
+        except Exception as e:
+            print(f"🔥🔥🔥 [DB INIT] Ошибка при миграции схемы: {e}")
+
+user_state = {}
+
+# ===== ЖУРНАЛ АКТИВНОСТИ (ОТЛОЖЕННАЯ ЗАПИСЬ) =====
+# Команда больше не ходит в БД ради журнала: событие копится в памяти
+# (по одной записи на пользователя, счетчики складываются), а фоновый
+# поток пишет всё разом одним INSERT ... ON CONFLICT DO UPDATE.
+
+class ActivityLog:
+    def __init__(self, flush_interval=ACTIVITY_FLUSH_INTERVAL, flush_events=ACTIVITY_FLUSH_EVENTS):
+        self.pending = {} # user_id -> [username, first_name, last_name, first_visit, last_visit, commands]
+        self.pending_events = 0
+        self.flush_interval = flush_interval
+        self.flush_events = flush_events
+        self.cond = Condition()
+        self.flush_lock = Lock() # Фоновый сброс и сброс по запросу не пишут одновременно
+        self.stopping = False
+        self.flushed_events = 0
+        self.flushes = 0
+        self.failures = 0
+        self.writer = Thread(target=self._writer_loop, daemon=True)
+        self.writer.start()
+
+    def record(self, user_id, username, first_name, last_name):
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.cond:
+            entry = self.pending.get(user_id)
+            if entry is None:
+                self.pending[user_id] = [username, first_name, last_name, now, now, 1]
+            else:
+                entry[4] = now
+                entry[5] += 1
+            self.pending_events += 1
+            if self.pending_events >= self.flush_events:
+                self.cond.notify()
+
+    def _take(self):
+        with self.cond:
+            batch, self.pending = self.pending, {}
+            events, self.pending_events = self.pending_events, 0
+            return batch, events
+
+    def _put_back(self, batch, events):
+        """Пачка не записалась: возвращаем ее, склеивая с тем, что пришло за это время."""
+        with self.cond:
+            for user_id, (username, first_name, last_name, first_visit, last_visit, commands) in batch.items():
+                entry = self.pending.get(user_id)
+                if entry is None:
+                    self.pending[user_id] = [username, first_name, last_name, first_visit, last_visit, commands]
+                else:
+                    entry[3] = first_visit
+                    entry[5] += commands
+            self.pending_events += events
+
+    def flush(self):
+        """Пишет всё накопленное одним запросом. True, если записали (или нечего писать)."""
+        with self.flush_lock:
+            batch, events = self._take()
+            if not batch: return True
+            with db_connection() as conn:
+                if not conn:
+                    self._put_back(batch, events)
+                    self.failures += 1
+                    return False
+                try:
+                    with conn:
+                        with conn.cursor() as cur:
+                            # Пачка уходит столбцами (7 массивов): запрос один и тот же при любом размере
+                            rows = [(user_id, *entry) for user_id, entry in sorted(batch.items())]
+                            execute_prepared(cur, "activity_upsert", [list(column) for column in zip(*rows)])
+                    self.flushes += 1
+                    self.flushed_events += events
+                    return True
+                except Exception as e:
+                    print(f"Ошибка логирования: {e}")
+                    self._put_back(batch, events)
+                    self.failures += 1
+                    return False
+
+    def _writer_loop(self):
+        while True:
+            with self.cond:
+                if not self.stopping and self.pending_events < self.flush_events:
+                    self.cond.wait(self.flush_interval)
+                stopping = self.stopping
+            self.flush()
+            if stopping: return
+
+    def shutdown(self, timeout=ACTIVITY_SHUTDOWN_TIMEOUT):
+        """Последний сброс при остановке; ждем не дольше timeout, чтобы не вешать выход."""
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.writer.join(timeout)
+        if self.writer.is_alive():
+            print(f"⚠️ [ACTIVITY] Журнал не успел записаться за {timeout} сек, событий потеряно: {self.pending_events}")
+
+    def stats(self):
+        with self.cond:
+            return {
+                "pending_users": len(self.pending), "pending_events": self.pending_events,
+                "flushed_events": self.flushed_events, "flushes": self.flushes, "failures": self.failures,
+                "flush_interval": self.flush_interval, "flush_events": self.flush_events
+            }
+
+activity_log = ActivityLog() if not IS_BALANCE_WORKER else None
+if activity_log:
+    atexit.register(activity_log.shutdown)
+
+def log_user_activity(user_id, message):
+    """Ставит команду пользователя в журнал; в БД она попадет со следующей пачкой."""
+    activity_log.record(
+        user_id,
+        message.from_user.username or "no_username",
+        message.from_user.first_name or "Unknown",
+        message.from_user.last_name or ""
+    )
 
 
 def is_admin(user_id):
     return user_id == ADMIN_ID
 
 
-def get_leaderboard_text():
-    conn = get_db_conn()
-    if not conn: return "Ошибка подключения к БД."
-    rows = []
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                query = '''
-                    SELECT 
-                        nickname, rating, wins, losses, 
-                        total_kills, total_deaths, total_assists,
-                        (CASE 
-                            WHEN (wins + losses) = 0 THEN 0 
-                            ELSE (CAST(wins AS FLOAT) / (wins + losses)) * 100 
-                        END) AS wr,
-                        (CASE 
-                            WHEN total_deaths = 0 THEN (total_kills + total_assists) 
-                            ELSE (CAST(total_kills AS FLOAT) + total_assists) / total_deaths 
-                        END) AS kda
-                    FROM players 
-                    ORDER BY 
-                        rating DESC, 
-                        kda DESC, 
-                        wr DESC
-                '''
-                cur.execute(query)
-                rows = cur.fetchall()
-    except Exception as e:
-        print(f"Ошибка get_leaderboard_text: {e}")
-        return "Ошибка выполнения запроса к БД."
-    finally:
-        put_db_conn(conn)
-    
+# ===== КЭШ ОТЧЕТОВ ПО СТАТИСТИКЕ =====
+# Лидерборд и подобные отчеты меняются только после записи в статистику,
+# поэтому готовый результат хранится вместе с версией статистики, при
+# которой он был посчитан. Пока версия та же - в БД не ходим вообще.
+
+class StatsSnapshotCache:
+    def __init__(self):
+        self.entries = {} # ключ отчета -> (версия статистики, результат)
+        self.lock = Lock()
+        self.build_lock = Lock() # Одновременные промахи не строят отчет дважды
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(self, key, build):
+        """
+        Результат для key при текущей версии статистики. build() вызывается
+        только при промахе; None (ошибка БД) в кэш не кладется.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == get_stats_version():
+                self.hits += 1
+                return entry[1]
+        with self.build_lock:
+            # Пока ждали, отчет мог построить другой поток
+            version = get_stats_version()
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] == version:
+                    self.hits += 1
+                    return entry[1]
+                self.misses += 1
+            # Версию берем ДО запроса: если запись успеет пройти во время
+            # чтения, снимок сохранится со старой версией и следующий вызов его перечитает
+            value = build()
+            if value is not None:
+                with self.lock:
+                    # Снимки старых версий больше никогда не совпадут - выбрасываем
+                    for stale_key in [k for k, (v, _) in self.entries.items() if v != version]:
+                        del self.entries[stale_key]
+                    self.entries[key] = (version, value)
+            return value
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.entries), "version": get_stats_version(),
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0
+            }
+
+stats_snapshot_cache = StatsSnapshotCache()
+
+LEADERBOARD_MEDALS = ["🥇", "🥈", "🥉", "🏅", "🏅"] # Список медалей для топ-5
+
+def fetch_leaderboard_rows():
+    """Один запрос: все игроки уже в порядке лидерборда. None при ошибке БД."""
+    with db_connection() as conn:
+        if not conn: return None
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    execute_prepared(cur, "leaderboard_rows")
+                    return cur.fetchall()
+        except Exception as e:
+            print(f"Ошибка get_leaderboard_text: {e}")
+            return None
+
+def build_leaderboard_snapshot():
+    """Текст и кнопки лидерборда из одного и того же набора строк."""
+    rows = fetch_leaderboard_rows()
+    if rows is None: return None
+    markup = types.InlineKeyboardMarkup()
     if not rows:
-        return "📭 Лидерборд пуст."
-    
+        return {"text": "📭 Лидерборд пуст.", "markup": markup}
+
     text = "🏆 ЛИДЕРБОРД\n" + "=" * 50 + "\n"
-    
-    # Список медалей для топ-5
-    medals = ["🥇", "🥈", "🥉", "🏅", "🏅"] 
-    
-    for idx, (nickname, rating, wins, losses, total_kills, total_deaths, total_assists, wr, kda) in enumerate(rows, 1):
-        
+    for idx, (nickname, rating, wins, losses, wr, kda) in enumerate(rows, 1):
         if idx <= 5:
             # Места 1-5 (как и было)
-            medal = medals[idx - 1]
+            medal = LEADERBOARD_MEDALS[idx - 1]
         elif idx <= 10:
             # Места 6-10 (клоуны)
             medal = f"🤡 {idx}."
         else:
             # Все, кто ниже 10-го (коляски)
             medal = f"♿ {idx}."
+        text += f"{medal} {nickname} - Рейтинг: {rating} | W/L: {wins}/{losses} | WR: {wr:.1f}% | KDA: {kda:.2f}\n"
+        markup.add(types.InlineKeyboardButton(f"👤 {nickname}", callback_data=f"player_{nickname}"))
+    return {"text": text, "markup": markup}
 
-        wr_str = f"{wr:.1f}"
-        kda_str = f"{kda:.2f}"
-        text += f"{medal} {nickname} - Рейтинг: {rating} | W/L: {wins}/{losses} | WR: {wr_str}% | KDA: {kda_str}\n"
-    
-    return text
+def get_leaderboard_snapshot():
+    """Готовый лидерборд {"text", "markup"}; пересчитывается только после записи в статистику."""
+    return stats_snapshot_cache.get_or_build("leaderboard", build_leaderboard_snapshot)
+
+def get_leaderboard_text():
+    snapshot = get_leaderboard_snapshot()
+    if snapshot is None: return "Ошибка выполнения запроса к БД."
+    return snapshot["text"]
+
+# ----- ФОРМАТИРОВАНИЕ (БЕЗ БД) -----
+
+def format_top_heroes(rows):
+    """rows: (hero_name, wins, losses, kills, deaths, assists), уже отсортированы."""
+    if not rows: return "Нет данных"
+    heroes_text = ""
+    for idx, (hero_name, wins, losses, kills, deaths, assists) in enumerate(rows, 1):
+        total = wins + losses
+        wr = round((wins / total * 100), 1) if total > 0 else 0
+        kda = round((kills + assists) / deaths, 2) if deaths > 0 else (kills + assists)
+        heroes_text += f"{idx}. {hero_name} - W/L: {wins}/{losses} | WR: {wr}% | KDA: {kda}\n"
+    return heroes_text
+
+def format_role_stats(rows):
+    """rows: (role_position, wins, losses), отсортированы по role_position."""
+    if not rows: return "Нет данных по ролям"
+    role_stats_text = ""
+    for role_pos, wins, losses in rows:
+        total = wins + losses
+        if total == 0: continue # Пропускаем пустые роли
+        wr = round((wins / total * 100), 1) if total > 0 else 0 
+        role_name = POSITIONS.get(role_pos, "Неизвестная")
+        role_stats_text += f"    {role_name}: W/L {wins}/{losses} | WR {wr}%\n"
+    return role_stats_text if role_stats_text else "Нет активных ролей"
 
 # ----- УЛУЧШЕННЫЕ ФУНКЦИИ (ПРИНИМАЮТ `cur` ОБЪЕКТ) -----
 
 def get_top_heroes(cur, nickname, limit=3):
     try:
-        cur.execute('''
-            SELECT hero_name, wins, losses, total_kills, total_deaths, total_assists 
-            FROM player_heroes 
-            WHERE player_nickname=%s AND (wins + losses) > 0
-            ORDER BY (CAST(wins AS FLOAT) / (wins + losses)) DESC
-            LIMIT %s
-        ''', (nickname, limit))
-        rows = cur.fetchall()
-        heroes_text = ""
-        if not rows: return "Нет данных"
-        for idx, (hero_name, wins, losses, kills, deaths, assists) in enumerate(rows, 1):
-            total = wins + losses
-            wr = round((wins / total * 100), 1) if total > 0 else 0
-            kda = round((kills + assists) / deaths, 2) if deaths > 0 else (kills + assists)
-            heroes_text += f"{idx}. {hero_name} - W/L: {wins}/{losses} | WR: {wr}% | KDA: {kda}\n"
-        return heroes_text
+        execute_prepared(cur, "top_heroes", (nickname, limit))
+        return format_top_heroes(cur.fetchall())
     except Exception as e:
         print(f"Ошибка get_top_heroes: {e}")
         return "Ошибка БД"
 
 def get_role_stats(cur, nickname):
     try:
-        cur.execute('''
-            SELECT role_position, wins, losses 
-            FROM player_role_stats 
-            WHERE player_nickname=%s
-            ORDER BY role_position
-        ''', (nickname,))
-        rows = cur.fetchall()
-        if not rows: return "Нет данных по ролям"
-        role_stats_text = ""
-        for role_pos, wins, losses in rows:
-            total = wins + losses
-            
-            # ▼▼▼ ДОБАВИТЬ ЭТУ ПРОВЕРКУ ▼▼▼
-            if total == 0: continue # Пропускаем пустые роли
-            # ▲▲▲ ------------------- ▲▲▲
-            
-            wr = round((wins / total * 100), 1) if total > 0 else 0 
-            role_name = POSITIONS.get(role_pos, "Неизвестная")
-            role_stats_text += f"    {role_name}: W/L {wins}/{losses} | WR {wr}%\n"
-        return role_stats_text if role_stats_text else "Нет активных ролей"
+        execute_prepared(cur, "role_stats", (nickname,))
+        return format_role_stats(cur.fetchall())
     except Exception as e:
         print(f"Ошибка get_role_stats: {e}")
         return "Ошибка БД"
 
+# ----- ПАКЕТНАЯ ЗАГРУЗКА СТАТИСТИКИ (1 СОЕДИНЕНИЕ, 3 ЗАПРОСА НА ВСЕХ) -----
+
+def build_player_stats(nickname, player_row, role_rows, hero_rows):
+    """
+    Собирает словарь статистики игрока из уже загруженных строк.
+    player_row: (rating, wins, losses, mmr, positions, total_kills, total_deaths, total_assists)
+    role_rows: (role_position, wins, losses) по role_position
+    hero_rows: топ героев в формате format_top_heroes
+    """
+    rating, wins, losses, mmr, positions_json, total_kills, total_deaths, total_assists = player_row
+
+    # "Реальные" роли: только где есть игры, самые сыгранные первыми
+    played_roles = [(role_pos, w + l) for role_pos, w, l in role_rows if (w + l) > 0]
+    played_roles.sort(key=lambda item: item[1], reverse=True)
+    actual_roles_list = [role_pos for role_pos, _ in played_roles]
+
+    total_games = wins + losses
+    wr = round((wins / total_games * 100), 1) if total_games > 0 else 0
+    avg_kda = round((total_kills + total_assists) / total_deaths, 2) if total_deaths > 0 else (
+            total_kills + total_assists)
+    return {
+        "nickname": nickname, "rating": rating, "wins": wins, "losses": losses,
+        "total_games": total_games, "wr": wr, "mmr": mmr, 
+        
+        # "positions" (для балансировщика) - берем РЕАЛЬНЫЕ роли
+        "positions": actual_roles_list, 
+        
+        # "positions_str" (для отображения) - берем РЕАЛЬНЫЕ роли
+        # Команда /admin_set_positions теперь не влияет на отображение
+        "positions_str": get_player_positions_str(actual_roles_list),
+        
+        "avg_kda": avg_kda,
+        "total_kda": f"{total_kills}/{total_deaths}/{total_assists}",
+        "top_heroes": format_top_heroes(hero_rows), 
+        "role_stats": format_role_stats(role_rows),
+        # Победы/поражения по сыгранным ролям (для расстановки по позициям)
+        "role_records": {role_pos: (w, l) for role_pos, w, l in role_rows if (w + l) > 0}
+    }
+
+def get_players_stats(nicknames, top_heroes_limit=3):
+    """
+    Загружает статистику сразу для списка игроков: одно соединение из пула
+    и 3 подготовленных запроса (players, player_role_stats, топ героев из mv_player_hero_rankings),
+    сколько бы игроков ни было. Возвращает {nickname: stats}; кого нет в БД,
+    того нет и в словаре.
+    """
+    nicknames = list(dict.fromkeys(nicknames))
+    if not nicknames: return {}
+    with db_connection() as conn:
+        if not conn: return {}
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    # 1. Основные данные всех игроков
+                    execute_prepared(cur, "player_rows", (nicknames,))
+                    player_rows = {row[0]: row[1:] for row in cur.fetchall()}
+                    if not player_rows: return {}
+
+                    # 2. Все роли этих игроков (и для "реальных" ролей, и для текста)
+                    execute_prepared(cur, "player_role_rows", (nicknames,))
+                    role_rows = {}
+                    for nick, role_pos, wins, losses in cur.fetchall():
+                        role_rows.setdefault(nick, []).append((role_pos, wins, losses))
+
+                    # 3. Топ героев каждого игрока одним запросом
+                    execute_prepared(cur, "player_top_heroes", (nicknames, top_heroes_limit))
+                    hero_rows = {}
+                    for nick, *hero_row in cur.fetchall():
+                        hero_rows.setdefault(nick, []).append(tuple(hero_row))
+
+            return {
+                nick: build_player_stats(nick, player_rows[nick], role_rows.get(nick, []), hero_rows.get(nick, []))
+                for nick in nicknames if nick in player_rows
+            }
+        except Exception as e:
+            print(f"Ошибка get_players_stats: {e}")
+            return {}
+
 # ----- ГЛАВНАЯ ФУНКЦИЯ СТАТИСТИКИ (ИСПОЛЬЗУЕТ 1 СОЕДИНЕНИЕ) -----
 
 def get_player_stats(nickname):
-    conn = get_db_conn()
-    if not conn: return None
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                # 1. Получаем основные данные
-                cur.execute(
-                    'SELECT rating, wins, losses, mmr, positions, total_kills, total_deaths, total_assists '
-                    'FROM players WHERE nickname=%s',
-                    (nickname,)
-                )
-                row = cur.fetchone()
-                if not row: return None
-                rating, wins, losses, mmr, positions_json, total_kills, total_deaths, total_assists = row
-                
-                # 2. Получаем "предпочитаемые" позиции (оставляем как есть)
-                try:
-                    preferred_positions_list = json.loads(positions_json) if positions_json else []
-                except Exception:
-                    preferred_positions_list = []
-                
-                cur.execute(
-                    'SELECT role_position FROM player_role_stats WHERE player_nickname=%s AND (wins + losses) > 0 ORDER BY (wins+losses) DESC', 
-                    (nickname,)
-                )
-                roles_rows = cur.fetchall()
-                actual_roles_list = [row[0] for row in roles_rows]
-
-                # 4. Собираем остальную статистику
-                total_games = wins + losses
-                wr = round((wins / total_games * 100), 1) if total_games > 0 else 0
-                avg_kda = round((total_kills + total_assists) / total_deaths, 2) if total_deaths > 0 else (
-                        total_kills + total_assists)
-                top_heroes_text = get_top_heroes(cur, nickname)
-                role_stats_text = get_role_stats(cur, nickname)
-
-        # 5. Возвращаем результат
-        return {
-            "nickname": nickname, "rating": rating, "wins": wins, "losses": losses,
-            "total_games": total_games, "wr": wr, "mmr": mmr, 
-            
-            # "positions" (для балансировщика) - берем РЕАЛЬНЫЕ роли
-            "positions": actual_roles_list, 
-            
-            # "positions_str" (для отображения) - берем РЕАЛЬНЫЕ роли
-            # Команда /admin_set_positions теперь не влияет на отображение
-            "positions_str": get_player_positions_str(actual_roles_list),
-            
-            # (Если хочешь вернуть старую логику, раскомментируй строку ниже и закомментируй "positions_str" выше)
-            # "positions_str": get_player_positions_str(preferred_positions_list), 
-            
-            "avg_kda": avg_kda,
-            "total_kda": f"{total_kills}/{total_deaths}/{total_assists}",
-            "top_heroes": top_heroes_text, 
-            "role_stats": role_stats_text
-        }
-    except Exception as e:
-        print(f"Ошибка get_player_stats: {e}")
-        return None
-    finally:
-        put_db_conn(conn)
+    """Статистика одного игрока (обертка над пакетной get_players_stats)."""
+    return get_players_stats([nickname]).get(nickname)
 
 # ------------------------------------------------------------------
 
@@ -491,36 +1447,167 @@ def get_player_stats_text(data):
     text += data['top_heroes']
     return text
 
-def get_all_games(limit=20):
-    conn = get_db_conn()
-    if not conn: return []
-    rows = []
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    'SELECT id, screenshot_file_id, radiant_players, dire_players, result, date, time, description '
-                    'FROM games ORDER BY date DESC, time DESC LIMIT %s',
-                    (limit,))
-                rows = cur.fetchall()
-    except Exception as e:
-        print(f"Ошибка get_all_games: {e}")
-    finally:
-        put_db_conn(conn)
-    return rows
+# ===== КЭШ ПРОФИЛЕЙ ИГРОКОВ =====
+# /player и кнопки лидерборда показывают один и тот же профиль много раз
+# подряд, а меняется он только после записи про этого игрока. Поэтому
+# держим готовые stats + текст; каждая запись сбрасывает только свои ники.
+
+class ProfileCache:
+    def __init__(self, max_size=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL):
+        self.entries = OrderedDict() # nickname -> (истекает, stats, текст)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = Lock()
+        # Счетчик сбросов: профиль, прочитанный до сброса своего ника, в кэш не кладем
+        self.epoch = 0
+        self.invalidated_at = {} # nickname -> epoch последнего сброса
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, nickname):
+        """(stats, текст) или None, если нет или истек TTL."""
+        with self.lock:
+            entry = self.entries.get(nickname)
+            if entry is None or entry[0] < time.time():
+                if entry is not None: del self.entries[nickname]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(nickname)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def current_epoch(self):
+        """Запоминается ДО чтения из БД и передается в put."""
+        with self.lock:
+            return self.epoch
+
+    def put(self, nickname, data, text, epoch):
+        with self.lock:
+            if self.invalidated_at.get(nickname, -1) > epoch:
+                return # Пока читали, игрока успели изменить - такой профиль уже устарел
+            self.entries[nickname] = (time.time() + self.ttl, data, text)
+            self.entries.move_to_end(nickname)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, nicknames):
+        """Сбрасывает профили только указанных игроков."""
+        with self.lock:
+            self.epoch += 1
+            for nickname in nicknames:
+                self.entries.pop(nickname, None)
+                self.invalidated_at[nickname] = self.epoch
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.entries), "max_size": self.max_size, "ttl": self.ttl,
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0
+            }
+
+profile_cache = ProfileCache()
+
+def get_player_profile(nickname):
+    """Профиль игрока (stats, текст) из кэша или из БД. None, если игрока нет."""
+    cached = profile_cache.get(nickname)
+    if cached: return cached
+    epoch = profile_cache.current_epoch()
+    data = get_player_stats(nickname)
+    if not data: return None
+    text = get_player_stats_text(data)
+    profile_cache.put(nickname, data, text, epoch)
+    return data, text
+
+GAMES_PAGE_SIZE = 10
+
+def get_games_page(older_than=None, newer_than=None, limit=GAMES_PAGE_SIZE):
+    """
+    Страница истории игр, новые сверху. Курсор - (played_at, id) крайней игры
+    соседней страницы, поэтому любая страница - короткий проход по индексу
+    idx_games_played_at_id, а не OFFSET по всей таблице.
+    Возвращает (rows, has_more): has_more - есть ли еще игры дальше в ту же сторону.
+    """
+    with db_connection() as conn:
+        if not conn: return [], False
+        columns = 'id, screenshot_file_id, radiant_players, dire_players, result, date, time, description, played_at'
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    if newer_than:
+                        cur.execute(
+                            f'SELECT {columns} FROM games WHERE (played_at, id) > (%s::timestamptz, %s) '
+                            'ORDER BY played_at, id LIMIT %s',
+                            (newer_than[0], newer_than[1], limit + 1))
+                        rows = cur.fetchall()
+                        return list(reversed(rows[:limit])), len(rows) > limit
+                    if older_than:
+                        cur.execute(
+                            f'SELECT {columns} FROM games WHERE (played_at, id) < (%s::timestamptz, %s) '
+                            'ORDER BY played_at DESC, id DESC LIMIT %s',
+                            (older_than[0], older_than[1], limit + 1))
+                    else:
+                        cur.execute(f'SELECT {columns} FROM games ORDER BY played_at DESC, id DESC LIMIT %s', (limit + 1,))
+                    rows = cur.fetchall()
+                    return rows[:limit], len(rows) > limit
+        except Exception as e:
+            print(f"Ошибка get_games_page: {e}")
+            return [], False
 
-# ▼▼▼ "УМНЫЙ" БАЛАНСИРОВЩИК v3 (Уже использует 'positions' из get_player_stats) ▼▼▼
-# ▼▼▼ "УМНЫЙ" БАЛАНСИРОВЩИК v4 (Фикс композиции и весов) ▼▼▼
 # ▼▼▼ "УМНЫЙ" БАЛАНСИРОВЩИК v5 (Критический лимит ролей) ▼▼▼
-def balance_teams(selected_players):
+# ▼▼▼ v6: ветви и границы вместо полного перебора (см. balancer.py) ▼▼▼
+# ===== ПУЛ ПРОЦЕССОВ ДЛЯ БАЛАНСИРОВЩИКА =====
+# Поиск баланса — чистый CPU, поэтому считается в отдельных процессах
+# и не блокирует ни polling, ни другие обработчики (GIL).
+# Контекст "forkserver", а не "fork": к моменту первого поиска у бота уже
+# есть потоки (polling, кэши, журнал) и открытые соединения с БД, а fork
+# копирует их в дочерний процесс вместе с захваченными блокировками.
+# Процессы пула порождает чистый сервер, в который заранее загружен только
+# balancer.py (main.py при python main.py импортируется, но см. IS_BALANCE_WORKER).
+# Там, где forkserver недоступен (Windows), считаем в пуле потоков.
+def _make_balance_executor():
+    try:
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["balancer"])
+        return ProcessPoolExecutor(max_workers=BALANCE_WORKERS, mp_context=context)
+    except ValueError:
+        print("⚠️ [BALANCE] forkserver недоступен, балансировщик работает в пуле потоков.")
+        return ThreadPoolExecutor(max_workers=BALANCE_WORKERS)
+
+balance_executor = _make_balance_executor()
+
+# Запас (сек) сверх бюджета поиска на очередь в пуле и передачу результата
+BALANCE_DEADLINE_GRACE = 1.0
+
+def run_balance_job(player_data, top_k=BALANCE_TOP_K):
     """
-    УМНЫЙ БАЛАНС v5: Вводит жесткий лимит на количество игроков, 
-    которые могут играть на одной позиции (максимум 3 из 5), 
-    и сохраняет приоритет покрытия всех 5 слотов.
+    Отдает поиск в пул процессов и ждет не дольше BALANCE_TIME_BUDGET + запас.
+    Внутри бюджета балансировщик сам возвращает лучшее найденное (exact=False).
+    Если пул занят и ответа нет даже к дедлайну, берем мгновенный
+    приближенный вариант balancer.quick_split.
     """
+    future = balance_executor.submit(balancer.find_best_split, player_data,
+                                     BALANCE_TIME_BUDGET, BALANCE_MODE, top_k)
+    try:
+        return future.result(timeout=BALANCE_TIME_BUDGET + BALANCE_DEADLINE_GRACE)
+    except FutureTimeoutError:
+        # cancel() снимает только задачу, которая еще ждет в очереди; уже
+        # идущий поиск (в любом режиме) сам остановится на BALANCE_TIME_BUDGET
+        future.cancel()
+        print(f"⚠️ [BALANCE] Пул не ответил за {BALANCE_TIME_BUDGET + BALANCE_DEADLINE_GRACE} с, "
+              f"берем быстрый приближенный вариант.")
+        return balancer.quick_split(player_data, top_k)
+    except Exception as e:
+        print(f"❌ [BALANCE] Ошибка в пуле балансировщика: {e}")
+        return balancer.quick_split(player_data, top_k)
+
+def load_balance_player_data(selected_players):
+    """player_data для balancer.py: одна пачка запросов, порядок выбора сохраняется."""
+    stats_by_nick = get_players_stats(selected_players)
     player_data = []
     for player in selected_players:
-        data = get_player_stats(player)
+        data = stats_by_nick.get(player)
         if data:
             player_data.append({
                 'nickname': data['nickname'], 
@@ -528,97 +1615,117 @@ def balance_teams(selected_players):
                 'wr': data['wr'],
                 'rating': data['rating'], 
                 'pos_str': data['positions_str'],
-                'positions': data['positions']  # Список реальных ролей [1, 2, 3]
+                'positions': data['positions'],  # Список реальных ролей [1, 2, 3]
+                'role_records': data['role_records']  # {роль: (wins, losses)} для расстановки
             })
-    
+    return player_data
+
+def balance_lineups(selected_players, top_k=BALANCE_TOP_K):
+    """
+    УМНЫЙ БАЛАНС v5: жесткий лимит на количество игроков одной позиции
+    (максимум 3 из 5) и приоритет покрытия всех 5 слотов.
+    v7: для каждого кандидата точная расстановка по позициям 1-5 (DP по WR
+    игроков на ролях), игроки в ответе с полем 'assigned_pos'.
+    Сам поиск живет в balancer.py: точный ответ тот же, что у полного
+    перебора, но 20-30 игроков считаются за доли секунды.
+    Возвращает {"lineups": [(radiant, dire), ...] (до top_k вариантов,
+    лучший первым), "exact": False, если время поиска истекло}.
+    """
+    player_data = load_balance_player_data(selected_players)
     if len(player_data) < 2: 
-        return [], []
+        return {"lineups": [([], [])], "exact": True}
 
-    team_size = len(player_data) // 2
-    
-    # --- 1. Рассчитываем общие и целевые показатели ---
-    total_mmr = sum(p['mmr'] for p in player_data)
-    total_wr = sum(p['wr'] for p in player_data)
-    
-    target_mmr = total_mmr / 2.0
-    target_wr = total_wr / 2.0
-    
-    best_combination = None
-    min_total_score = float('inf')
+    result = run_balance_job(player_data, top_k)
+    if not result["exact"]:
+        print(f"⚠️ [BALANCE] Бюджет {BALANCE_TIME_BUDGET} с исчерпан, взято лучшее найденное разбиение "
+              f"(score={result['score']:.2f}, игроков: {len(player_data)}).")
+    return {
+        "lineups": [(option["radiant"], option["dire"]) for option in result["alternatives"]],
+        "exact": result["exact"]
+    }
 
-    # --- Веса для очков (Новая настройка) ---
-    MAX_ROLE_PLAYERS = 3                # Максимум 3 игрока могут иметь одну позицию как реальную
-    
-    COMPOSITION_DEFICIT_WEIGHT = 1000.0 # Штраф за отсутствие 1/2/3/4/5
-    ROLE_SATURATION_WEIGHT = 5000.0     # NEW: Критический штраф за переизбыток (> 3)
-    MMR_WR_WEIGHT = 200.0               # Вес MMR/WR
-    ROLE_CONFLICT_WEIGHT = 5.0          # Штраф за минимальный конфликт (2 или 3 игрока)
-    REQUIRED_ROLES = {1, 2, 3, 4, 5}
-
-    # --- 2. Перебираем все комбинации ---
-    for team1_players in itertools.combinations(player_data, team_size):
-        
-        # --- 3. Считаем MMR/WR score ---
-        team1_mmr_sum = sum(p['mmr'] for p in team1_players)
-        team1_wr_sum = sum(p['wr'] for p in team1_players)
-        
-        mmr_diff = abs(team1_mmr_sum - target_mmr)
-        wr_diff = abs(team1_wr_sum - target_wr)
-        
-        mmr_norm_diff = (mmr_diff / target_mmr) if target_mmr > 0 else 0
-        wr_norm_diff = (wr_diff / target_wr) if target_wr > 0 else 0
-        
-        mmr_wr_score = (mmr_norm_diff + wr_norm_diff) if target_mmr > 0 and target_wr > 0 else (mmr_norm_diff or wr_norm_diff)
-        
-        # --- 4. Считаем Role Conflict score & Saturation Penalty ---
-        all_roles = []
-        for p in team1_players:
-            player_roles = p['positions']
-            if player_roles:
-                all_roles.extend(player_roles)
-
-        role_counts = Counter(all_roles)
-        role_conflict_score = 0
-        saturation_penalty = 0 # Новый, критичный штраф
-
-        for role_id, role_count in role_counts.items():
-            if role_count > MAX_ROLE_PLAYERS:
-                # 🔴 КРИТИЧЕСКИЙ ШТРАФ: Если у нас 4 или 5 саппортов, это сразу делает команду неоптимальной
-                saturation_penalty += (role_count - MAX_ROLE_PLAYERS) 
-            
-            if role_count > 1 and role_count <= MAX_ROLE_PLAYERS:
-                 # Небольшой штраф за 2-3 игрока (это не идеальный состав, но допустимый)
-                 role_conflict_score += (role_count - 1) 
+def balance_teams(selected_players):
+    """Лучший вариант состава: (radiant, dire)."""
+    return balance_lineups(selected_players, top_k=1)["lineups"][0]
 
-        # --- 4.5. Считаем Composition Coverage score (ШТРАФ ЗА ОТСУТСТВИЕ СЛОТОВ) ---
-        covered_roles = set(role_counts.keys()) 
-        composition_coverage_penalty = len(REQUIRED_ROLES - covered_roles)
-        
-        # --- 5. Считаем итоговый score (Применяем веса) ---
-        # SATURATION_WEIGHT > COMPOSITION_DEFICIT_WEIGHT > MMR/WR WEIGHT
-        total_score = (ROLE_SATURATION_WEIGHT * saturation_penalty) + \
-                      (COMPOSITION_DEFICIT_WEIGHT * composition_coverage_penalty) + \
-                      (ROLE_CONFLICT_WEIGHT * role_conflict_score) + \
-                      (MMR_WR_WEIGHT * mmr_wr_score)
-
-        # --- 6. Ищем комбинацию с наименьшим "штрафом" ---
-        if total_score < min_total_score:
-            min_total_score = total_score
-            best_combination = team1_players
-
-    # --- 7. Формируем команды ---
-    if best_combination is None:
-        # Аварийный случай: делим пополам
-        return player_data[:team_size], player_data[team_size:]
-
-    radiant = list(best_combination)
-    radiant_nicknames = {p['nickname'] for p in radiant}
-    dire = [p for p in player_data if p['nickname'] not in radiant_nicknames]
-    
-    return radiant, dire
-# ▲▲▲ КОНЕЦ v5 ▲▲▲
-# ▲▲▲ КОНЕЦ v4 ▲▲▲
-# ▲▲▲ КОНЕЦ v3 ▲▲▲
+def balance_lobbies(selected_players):
+    """
+    Несколько матчей 5 на 5 сразу (balancer.split_lobbies) в пуле процессов.
+    Если пул не ответил к дедлайну, берем "змейку" с точной доводкой без отжига.
+    """
+    player_data = load_balance_player_data(selected_players)
+    future = balance_executor.submit(balancer.split_lobbies, player_data, LOBBY_TIME_BUDGET)
+    try:
+        return future.result(timeout=LOBBY_TIME_BUDGET + BALANCE_DEADLINE_GRACE)
+    except FutureTimeoutError:
+        future.cancel()
+        print(f"⚠️ [BALANCE] Пул не ответил за {LOBBY_TIME_BUDGET + BALANCE_DEADLINE_GRACE} с, лобби без отжига.")
+    except Exception as e:
+        print(f"❌ [BALANCE] Ошибка в пуле балансировщика (лобби): {e}")
+    return balancer.split_lobbies(player_data, time_budget=0)
+# ▲▲▲ КОНЕЦ v6 ▲▲▲
+
+# ===== КЭШ РЕЗУЛЬТАТОВ БАЛАНСА (+ КНОПКА "ДРУГОЙ ВАРИАНТ") =====
+# Ключ: (frozenset ников, версия статистики). Повторный выбор тех же игроков
+# (частый мис-тап) не пересчитывает баланс, а перелистывание вариантов
+# не трогает ни БД, ни CPU. Любая запись в статистику меняет версию,
+# поэтому старые результаты просто перестают находиться и вытесняются LRU.
+LINEUP_CACHE_SIZE = 50
+
+class BalanceCache:
+    def __init__(self, max_size=LINEUP_CACHE_SIZE):
+        self.entries = OrderedDict() # (frozenset, version) -> {"lineups": [...], "exact": bool}
+        self.max_size = max_size
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Достает варианты и считает hit/miss. Приближенный результат (exact=False:
+        поиск не уложился в бюджет или пул был занят) попаданием не считается -
+        тот же выбор игроков пересчитается; перелистывание (peek) его видит.
+        """
+        with self.lock:
+            lineups = self.entries.get(key)
+            if lineups is None or not lineups["exact"]:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return lineups
+
+    def peek(self, key):
+        """Достает варианты без учета в статистике (для перелистывания)."""
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, key, lineups):
+        with self.lock:
+            self.entries[key] = lineups
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.entries), "max_size": self.max_size,
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0
+            }
+
+balance_cache = BalanceCache()
+match_messages = OrderedDict() # (chat_id, message_id) -> {"key": ключ balance_cache, "index": int}
+match_messages_lock = Lock()
+
+def remember_match_message(chat_id, message_id, selection_key):
+    """Запоминает, какие варианты показывает сообщение с матчем."""
+    with match_messages_lock:
+        match_messages[(chat_id, message_id)] = {"key": selection_key, "index": 0}
+        while len(match_messages) > LINEUP_CACHE_SIZE * 4:
+            match_messages.popitem(last=False)
 
 # ===== КОМАНДЫ БОТА =====
 
@@ -637,33 +1744,19 @@ def help_command(message):
     text += "/player nickname - статистика игрока 📊\n"
     text += "/games - все игры 🎮\n"
     text += "/creategame - создать игру 🎯\n"
-    text += "/statshero - статистика по героям 🦸\n"
+    text += "/statshero [мин. игр] [героев] - статистика по героям 🦸\n"
     try: bot.reply_to(message, text)
     except Exception as e: print(f"Ошибка help: {e}")
 
 @bot.message_handler(commands=['leaderboard'])
 def leaderboard(message):
     log_user_activity(message.from_user.id, message)
-    text = get_leaderboard_text()
-    conn = get_db_conn()
-    if not conn:
+    snapshot = get_leaderboard_snapshot()
+    if snapshot is None:
         bot.reply_to(message, "Ошибка БД.")
         return
-    rows = []
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute('SELECT nickname FROM players ORDER BY rating DESC, (CASE WHEN total_deaths = 0 THEN (total_kills + total_assists) ELSE (CAST(total_kills AS FLOAT) + total_assists) / total_deaths END) DESC, (CASE WHEN (wins + losses) = 0 THEN 0 ELSE (CAST(wins AS FLOAT) / (wins + losses)) END) DESC')
-                rows = cur.fetchall()
-    except Exception as e:
-        print(f"Ошибка leaderboard (получение кнопок): {e}")
-    finally:
-        put_db_conn(conn)
-    markup = types.InlineKeyboardMarkup()
-    for (nickname,) in rows:
-        markup.add(types.InlineKeyboardButton(f"👤 {nickname}", callback_data=f"player_{nickname}"))
     try:
-        bot.reply_to(message, text, reply_markup=markup)
+        bot.reply_to(message, snapshot["text"], reply_markup=snapshot["markup"])
     except Exception as e:
         print(f"Ошибка leaderboard: {e}")
 
@@ -675,139 +1768,206 @@ def player_stats(message):
         bot.reply_to(message, "Использование: /player nickname")
         return
     nickname = " ".join(parts[1:])
-    data = get_player_stats(nickname)
-    if not data:
+    profile = get_player_profile(nickname)
+    if not profile:
         bot.reply_to(message, "❌ Игрок не найден.")
         return
-    text = get_player_stats_text(data)
+    text = profile[1]
     try:
         bot.reply_to(message, text)
     except Exception as e:
         print(f"Ошибка player: {e}")
 
-@bot.message_handler(commands=['games'])
-def show_all_games(message):
-    log_user_activity(message.from_user.id, message)
-    games = get_all_games(limit=20)
-    if not games:
-        bot.reply_to(message, "❌ Нет игр в базе")
-        return
-    text = f"🎮 ПОСЛЕДНИЕ ИГРЫ\n" + "=" * 50 + "\n"
-    text += f"Всего: {len(games)} игр\n\n"
-   for idx, (game_id, sfid, r_pl, d_pl, result, date, time_str, desc) in enumerate(games, 1):
+def games_cursor(row):
+    """Курсор страницы для callback_data: played_at в ISO (точность до мкс) и id."""
+    return f"{row[8].isoformat()}_{row[0]}"
+
+def parse_games_cursor(data):
+    played_at, game_id = data.rsplit("_", 1)
+    return played_at, int(game_id)
+
+def build_games_page(rows, has_newer, has_older):
+    """Текст страницы и кнопки: скриншоты игр и листание старее/новее."""
+    text = "🎮 ИГРЫ\n" + "=" * 50 + "\n"
+    for game_id, sfid, r_pl, d_pl, result, date, time_str, desc, played_at in rows:
         r_emoji = "🟢" if result == "radiant" else "🔴"
-        text += f"{idx}. {r_emoji} {result.upper()} WIN\n"
+        text += f"#{game_id}. {r_emoji} {result.upper()} WIN\n"
         text += f"    🟢 Radiant: {r_pl}\n"
         text += f"    🔴 Dire: {d_pl}\n"
         text += f"    📅 {date} ⏰ {time_str}\n"
         if desc and desc.strip():
             text += f"    📝 {desc.strip()}\n"
         text += "\n"
+    markup = types.InlineKeyboardMarkup(row_width=5)
+    shots = [types.InlineKeyboardButton(f"🖼 #{row[0]}", callback_data=f"game_shot_{row[0]}") for row in rows if row[1]]
+    if shots: markup.add(*shots)
+    nav = []
+    if has_newer: nav.append(types.InlineKeyboardButton("⬅️ Новее", callback_data=f"games_newer_{games_cursor(rows[0])}"))
+    if has_older: nav.append(types.InlineKeyboardButton("Старее ➡️", callback_data=f"games_older_{games_cursor(rows[-1])}"))
+    if nav: markup.row(*nav)
+    return text, markup
+
+@bot.message_handler(commands=['games'])
+def show_all_games(message):
+    log_user_activity(message.from_user.id, message)
+    games, has_older = get_games_page()
+    if not games:
+        bot.reply_to(message, "❌ Нет игр в базе")
+        return
+    text, markup = build_games_page(games, has_newer=False, has_older=has_older)
     try:
-        bot.reply_to(message, text)
-        for game_id, sfid, r_pl, d_pl, result, date, time_str, desc in games:
-            if sfid:
-                try: bot.send_photo(message.chat.id, sfid)
-                except Exception: pass
+        bot.reply_to(message, text, reply_markup=markup)
     except Exception as e:
         print(f"Ошибка games: {e}")
 
+@bot.callback_query_handler(func=lambda call: call.data.startswith("games_"))
+def page_games(call):
+    """Листание /games: редактирует то же сообщение соседней страницей."""
+    try: bot.answer_callback_query(call.id)
+    except Exception: pass
+    direction, cursor = call.data[len("games_"):].split("_", 1)
+    cursor = parse_games_cursor(cursor)
+    if direction == "older":
+        games, has_older = get_games_page(older_than=cursor)
+        has_newer = True
+    else:
+        games, has_newer = get_games_page(newer_than=cursor)
+        has_older = True
+    if not games:
+        # Край истории (например, игры откатили): начинаем с самых новых
+        games, has_older = get_games_page()
+        has_newer = False
+    if not games:
+        text, markup = "❌ Нет игр в базе", None
+    else:
+        text, markup = build_games_page(games, has_newer, has_older)
+    try:
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    except Exception as e:
+        print(f"Ошибка games (листание): {e}")
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("game_shot_"))
+def show_game_screenshot(call):
+    try: bot.answer_callback_query(call.id)
+    except Exception: pass
+    game_id = int(call.data.replace("game_shot_", ""))
+    with db_connection() as conn:
+        if not conn: return
+        row = None
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT screenshot_file_id FROM games WHERE id=%s', (game_id,))
+                    row = cur.fetchone()
+        except Exception as e:
+            print(f"Ошибка game_shot: {e}")
+    try:
+        if row and row[0]:
+            bot.send_photo(call.message.chat.id, row[0], caption=f"🎮 Игра #{game_id}")
+        else:
+            bot.send_message(call.message.chat.id, f"❌ Скриншот игры #{game_id} не найден")
+    except Exception as e:
+        print(f"Ошибка game_shot: {e}")
+
 @bot.message_handler(commands=['creategame'])
 def create_game(message):
     log_user_activity(message.from_user.id, message)
     
     # --- ИСПОЛЬЗУЕМ КЭШ ---
-    players_from_cache = player_cache.get_players()
+    players_from_cache = player_cache.get_players(wait_fresh=True) # Свежие WR после только что записанной игры
     if not players_from_cache:
         bot.reply_to(message, "❌ Нет игроков в системе. Сначала добавьте игроков (через /admin).")
         return
     # ---------------------
         
     user_id = message.from_user.id
-    user_state[user_id] = {"action": "selecting_players", "selected": []}
-
-    markup = types.InlineKeyboardMarkup()
-    for player in players_from_cache:
-        # Берем готовые данные из кэша
-        markup.add(
-            types.InlineKeyboardButton(
-                # (player['pos_str']) ТЕПЕРЬ ПОКАЗЫВАЕТ РЕАЛЬНЫЕ РОЛИ
-                f"{player['nickname']} ({player['pos_str']}) | WR: {player['wr_str']}",
-                callback_data=f"select_player_{player['nickname']}"
-            )
-        )
-    markup.add(types.InlineKeyboardButton("✅ Готово - Создать матч", callback_data="create_match"))
-    markup.add(types.InlineKeyboardButton("❌ Отмена", callback_data="cancel_create"))
+    state = {"action": "selecting_players", "selected": set()}
+    user_state[user_id] = state
+    build_picker_rows(state)
 
     try:
         bot.send_message(
             message.chat.id,
             "🎯 Выберите игроков которые ПРИСУТСТВУЮТ:\n(Нажимайте на игроков)",
-            reply_markup=markup
+            reply_markup=get_picker_markup(state)
         )
     except Exception as e:
         print(f"Ошибка create_game: {e}")
 
+# Нижние кнопки клавиатуры выбора (одни и те же для всех)
+PICKER_FOOTER_ROWS = [
+    [types.InlineKeyboardButton("✅ Готово - Создать матч", callback_data="create_match")],
+    [types.InlineKeyboardButton("🏟️ Несколько лобби (5v5 + запас)", callback_data="create_lobbies")],
+    [types.InlineKeyboardButton("❌ Отмена", callback_data="cancel_create")],
+]
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("select_player_"))
-def select_player_for_game(call):
-    user_id = call.from_user.id
-    chat_id = call.message.chat.id
-    try: bot.answer_callback_query(call.id)
-    except Exception: pass
-    if user_id not in user_state: return
-    nickname = call.data.replace("select_player_", "")
-    state = user_state[user_id]
-    if nickname in state["selected"]:
-        state["selected"].remove(nickname)
-    else:
-        state["selected"].append(nickname)
+def build_picker_rows(state):
+    """
+    (Пере)собирает строки клавиатуры выбора из готовых кнопок кэша.
+    Нужна только при создании и когда версия кэша поменялась.
+    """
+    version, index, rows = player_cache.get_picker_rows()
+    selected = state["selected"]
+    state["rows"] = [rows[i][1] if nickname in selected else rows[i][0] for nickname, i in index.items()]
+    state["rows_version"] = version
 
-    # --- ИСПОЛЬЗУЕМ КЭШ ---
-    players_from_cache = player_cache.get_players()
-    # ---------------------
-    
-    markup = types.InlineKeyboardMarkup()
-    for player in players_from_cache:
-        prefix = "✅ " if player['nickname'] in state["selected"] else ""
-        markup.add(
-            types.InlineKeyboardButton(
-                f"{prefix}{player['nickname']} ({player['pos_str']}) | WR: {player['wr_str']}",
-                callback_data=f"select_player_{player['nickname']}"
-            )
-        )
-    markup.add(types.InlineKeyboardButton("✅ Готово - Создать матч", callback_data="create_match"))
-    markup.add(types.InlineKeyboardButton("❌ Отмена", callback_data="cancel_create"))
-    try:
-        bot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=markup)
-    except Exception: pass
+def get_picker_markup(state):
+    """Клавиатура выбора: строки игроков из state + общие нижние кнопки."""
+    return types.InlineKeyboardMarkup(keyboard=state["rows"] + PICKER_FOOTER_ROWS)
 
-@bot.callback_query_handler(func=lambda call: call.data == "create_match")
-def create_match(call):
+@bot.callback_query_handler(func=lambda call: call.data.startswith("select_player_"))
+def select_player_for_game(call):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
     try: bot.answer_callback_query(call.id)
     except Exception: pass
     if user_id not in user_state: return
+    nickname = call.data.replace("select_player_", "")
     state = user_state[user_id]
-    selected_players = state["selected"]
-    if len(selected_players) < 2:
-        try: bot.send_message(chat_id, "❌ Нужно выбрать минимум 2 игроков!")
-        except Exception: pass
-        return
-    if len(selected_players) % 2 != 0:
-        try: bot.send_message(chat_id, "❌ Количество игроков должно быть четным!")
-        except Exception: pass
-        return
-    radiant, dire = balance_teams(selected_players) 
-    
-    text = "⚔️ СБАЛАНСИРОВАННЫЙ МАТЧ (по Ролям, MMR и WR)\n\n"
-    text += "🟢 RADIANT:\n"
+    selected = state["selected"]
+    if nickname in selected:
+        selected.discard(nickname)
+    else:
+        selected.add(nickname)
+
+    # --- ИСПОЛЬЗУЕМ КЭШ: меняем только строку нажатого игрока ---
+    version, index, rows = player_cache.get_picker_rows()
+    if state.get("rows_version") != version:
+        build_picker_rows(state) # Кэш обновился (новый игрок, WR) - собираем заново
+    elif nickname in index:
+        i = index[nickname]
+        state["rows"][i] = rows[i][1] if nickname in selected else rows[i][0]
+    # ---------------------
+    try:
+        bot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=get_picker_markup(state))
+    except Exception: pass
+
+def sort_by_assigned_position(team):
+    """Игроки команды по назначенной позиции 1-5, запасные в конце."""
+    return sorted(team, key=lambda p: p.get('assigned_pos') or len(POSITIONS) + 1)
+
+def format_assigned_position(player):
+    """'1 Carry' для назначенной позиции, 'Запас' для лишнего игрока."""
+    pos = player.get('assigned_pos')
+    if not pos:
+        return "Запас"
+    return f"{pos} {POSITIONS.get(pos, '?')}"
+
+def format_match_text(radiant, dire, option_index=0, options_total=1, approximate=False):
+    """Текст сбалансированного матча (без БД)."""
+    text = "⚔️ СБАЛАНСИРОВАННЫЙ МАТЧ (по Ролям, MMR и WR)\n"
+    if approximate:
+        text += "⏱️ Приближенный результат: время поиска истекло, показан лучший найденный вариант\n"
+    if options_total > 1:
+        text += f"🔄 Вариант {option_index + 1} из {options_total}\n"
+    text += "\n🟢 RADIANT:\n"
+    radiant = sort_by_assigned_position(radiant)
+    dire = sort_by_assigned_position(dire)
     radiant_total_wr = 0
     radiant_total_mmr = 0
     for p in radiant:
-        # p['pos_str'] теперь тоже берется из РЕАЛЬНЫХ ролей
-        text += f"    • {p['nickname']} ({p['pos_str']}) | WR: {p['wr']}% | MMR: {p['mmr']}\n"
+        # p['pos_str'] теперь тоже берется из РЕАЛЬНЫХ ролей, слева - назначенная позиция
+        text += f"    • {format_assigned_position(p)}: {p['nickname']} ({p['pos_str']}) | WR: {p['wr']}% | MMR: {p['mmr']}\n"
         radiant_total_wr += p['wr']
         radiant_total_mmr += p['mmr']
     
@@ -820,7 +1980,7 @@ def create_match(call):
     dire_total_mmr = 0
 
     for p in dire:
-        text += f"    • {p['nickname']} ({p['pos_str']}) | WR: {p['wr']}% | MMR: {p['mmr']}\n"
+        text += f"    • {format_assigned_position(p)}: {p['nickname']} ({p['pos_str']}) | WR: {p['wr']}% | MMR: {p['mmr']}\n"
         dire_total_wr += p['wr']
         dire_total_mmr += p['mmr']
 
@@ -832,12 +1992,154 @@ def create_match(call):
     text += f"📊 Баланс MMR: {'ИДЕАЛЬНО ✅' if abs(radiant_avg_mmr - dire_avg_mmr) < 50 else 'ХОРОШИЙ 👍'}\n"
     text += f"\n📈 WR Разница: {abs(radiant_avg_wr - dire_avg_wr):.1f}%\n"
     text += f"🎖️ MMR Разница: {int(abs(radiant_avg_mmr - dire_avg_mmr))}"
+    return text
+
+def get_match_markup(options_total):
+    """Кнопка "Другой вариант" (только если вариантов больше одного)."""
+    if options_total < 2: return None
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🔄 Другой вариант", callback_data="reroll_match"))
+    return markup
+
+@bot.callback_query_handler(func=lambda call: call.data == "create_match")
+def create_match(call):
+    user_id = call.from_user.id
+    chat_id = call.message.chat.id
+    try: bot.answer_callback_query(call.id)
+    except Exception: pass
+    if user_id not in user_state: return
+    state = user_state[user_id]
+    # Выбор хранится множеством; сортируем, чтобы порядок (и ответ при равных) не зависел от хэшей
+    selected_players = sorted(state["selected"])
+    if len(selected_players) < 2:
+        try: bot.send_message(chat_id, "❌ Нужно выбрать минимум 2 игроков!")
+        except Exception: pass
+        return
+    if len(selected_players) % 2 != 0:
+        try: bot.send_message(chat_id, "❌ Количество игроков должно быть четным!")
+        except Exception: pass
+        return
+    del user_state[user_id]
+
+    # Один проход балансировщика дает сразу K лучших вариантов
+    selection_key = (frozenset(selected_players), get_stats_version())
+    balanced = balance_cache.get(selection_key)
+    if balanced is not None:
+        show_match_result(chat_id, None, selection_key, balanced)
+        return
+
+    # Сразу отвечаем, а сам поиск идет в фоне и потом редактирует это сообщение
+    message_id = None
     try:
-        bot.send_message(chat_id, text)
+        message_id = bot.send_message(chat_id, f"⏳ Балансирую {len(selected_players)} игроков...").message_id
     except Exception as e:
         print(f"Ошибка create_match: {e}")
+    Thread(target=balance_in_background, args=(chat_id, message_id, selected_players, selection_key),
+           daemon=True).start()
+
+def balance_in_background(chat_id, message_id, selected_players, selection_key):
+    """Фоновая задача: грузит статистику, считает баланс в пуле процессов, показывает результат."""
+    try:
+        balanced = balance_lineups(selected_players)
+        balance_cache.put(selection_key, balanced)
+        show_match_result(chat_id, message_id, selection_key, balanced)
+    except Exception as e:
+        print(f"Ошибка balance_in_background: {e}")
+        try:
+            if message_id: bot.edit_message_text("❌ Ошибка при балансировке. Попробуйте еще раз.", chat_id, message_id)
+        except Exception: pass
+
+def show_match_result(chat_id, message_id, selection_key, balanced):
+    """Редактирует сообщение "Балансирую..." (или отправляет новое) первым вариантом."""
+    lineups = balanced["lineups"]
+    radiant, dire = lineups[0]
+    text = format_match_text(radiant, dire, 0, len(lineups), approximate=not balanced["exact"])
+    markup = get_match_markup(len(lineups))
+    try:
+        if message_id:
+            bot.edit_message_text(text, chat_id, message_id, reply_markup=markup)
+        else:
+            message_id = bot.send_message(chat_id, text, reply_markup=markup).message_id
+        remember_match_message(chat_id, message_id, selection_key)
+    except Exception as e:
+        print(f"Ошибка show_match_result: {e}")
+
+@bot.callback_query_handler(func=lambda call: call.data == "reroll_match")
+def reroll_match(call):
+    """Показывает следующий вариант из кэша (без БД и без нового поиска)."""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    with match_messages_lock:
+        entry = match_messages.get((chat_id, message_id))
+        balanced = balance_cache.peek(entry["key"]) if entry else None
+        if balanced:
+            entry["index"] = (entry["index"] + 1) % len(balanced["lineups"])
+            option_index = entry["index"]
+    if not balanced:
+        try: bot.answer_callback_query(call.id, "⌛ Варианты устарели, создайте матч заново (/creategame).", show_alert=True)
+        except Exception: pass
+        return
+    try: bot.answer_callback_query(call.id)
+    except Exception: pass
+    lineups = balanced["lineups"]
+    radiant, dire = lineups[option_index]
+    text = format_match_text(radiant, dire, option_index, len(lineups), approximate=not balanced["exact"])
+    try:
+        bot.edit_message_text(text, chat_id, message_id, reply_markup=get_match_markup(len(lineups)))
+    except Exception as e:
+        print(f"Ошибка reroll_match: {e}")
+
+def format_lobbies_text(result):
+    """Текст нескольких матчей 5 на 5 и запаса (без БД)."""
+    lobbies = result["lobbies"]
+    text = f"🏟️ {len(lobbies)} ЛОББИ ОДНОВРЕМЕННО (по Ролям, MMR и WR)\n"
+    for number, lobby in enumerate(lobbies, 1):
+        text += f"\n━━━ Лобби {number} ━━━\n"
+        for title, team in (("🟢 RADIANT", lobby["radiant"]), ("🔴 DIRE", lobby["dire"])):
+            avg_mmr = int(round(sum(p['mmr'] for p in team) / len(team), 0)) if team else 0
+            avg_wr = round(sum(p['wr'] for p in team) / len(team), 1) if team else 0
+            text += f"{title} (MMR {avg_mmr}, WR {avg_wr}%):\n"
+            for p in sort_by_assigned_position(team):
+                text += f"    • {format_assigned_position(p)}: {p['nickname']} | MMR: {p['mmr']}\n"
+    if result["bench"]:
+        text += f"\n🪑 Запас: {', '.join(p['nickname'] for p in result['bench'])}"
+    return text
+
+@bot.callback_query_handler(func=lambda call: call.data == "create_lobbies")
+def create_lobbies(call):
+    """Распределяет выбранных игроков по нескольким лобби 5 на 5 (лишние - в запас)."""
+    user_id = call.from_user.id
+    chat_id = call.message.chat.id
+    try: bot.answer_callback_query(call.id)
+    except Exception: pass
+    if user_id not in user_state: return
+    selected_players = sorted(user_state[user_id]["selected"])
+    if len(selected_players) < 2 * balancer.LOBBY_TEAM_SIZE:
+        try: bot.send_message(chat_id, f"❌ Для лобби нужно минимум {2 * balancer.LOBBY_TEAM_SIZE} игроков!")
+        except Exception: pass
+        return
     del user_state[user_id]
 
+    message_id = None
+    try:
+        message_id = bot.send_message(chat_id, f"⏳ Распределяю {len(selected_players)} игроков по лобби...").message_id
+    except Exception as e:
+        print(f"Ошибка create_lobbies: {e}")
+    Thread(target=lobbies_in_background, args=(chat_id, message_id, selected_players), daemon=True).start()
+
+def lobbies_in_background(chat_id, message_id, selected_players):
+    """Фоновая задача: считает лобби в пуле процессов и редактирует сообщение "Распределяю..."."""
+    try:
+        text = format_lobbies_text(balance_lobbies(selected_players))
+    except Exception as e:
+        print(f"Ошибка lobbies_in_background: {e}")
+        text = "❌ Ошибка при распределении по лобби. Попробуйте еще раз."
+    try:
+        if message_id: bot.edit_message_text(text, chat_id, message_id)
+        else: bot.send_message(chat_id, text)
+    except Exception as e:
+        print(f"Ошибка lobbies_in_background: {e}")
+
 @bot.callback_query_handler(func=lambda call: call.data == "cancel_create")
 def cancel_create(call):
     user_id = call.from_user.id
@@ -853,12 +2155,12 @@ def show_player_profile(call):
     try: bot.answer_callback_query(call.id)
     except Exception: pass
     nickname = call.data.replace("player_", "")
-    data = get_player_stats(nickname)
-    if not data:
+    profile = get_player_profile(nickname)
+    if not profile:
         try: bot.send_message(call.message.chat.id, "❌ Игрок не найден.")
         except Exception: pass
         return
-    text = get_player_stats_text(data)
+    text = profile[1]
     try:
         bot.send_message(call.message.chat.id, text)
     except Exception as e:
@@ -877,6 +2179,7 @@ def show_admin_panel(chat_id, user_id, message_id=None):
     markup.add(types.InlineKeyboardButton("➕ Добавить игрока", callback_data="admin_add_player"))
     markup.add(types.InlineKeyboardButton("🎮 Добавить игру", callback_data="admin_add_game"))
     markup.add(types.InlineKeyboardButton("↩️ Отменить последнюю игру", callback_data="admin_undo_game"))
+    markup.add(types.InlineKeyboardButton("⏪ Отменить игры по ID", callback_data="admin_undo_games_by_id"))
     markup.add(types.InlineKeyboardButton("⚔️ Добавить героя игроку", callback_data="admin_add_hero"))
     markup.add(types.InlineKeyboardButton("📊 Управление ролями", callback_data="admin_manage_roles"))
     markup.add(types.InlineKeyboardButton("📝 Изменить рейтинг", callback_data="admin_set_rating"))
@@ -936,35 +2239,34 @@ def show_user_stats(call):
         return
     try: bot.answer_callback_query(call.id)
     except Exception: pass
-    conn = get_db_conn()
-    if not conn:
-        bot.send_message(call.message.chat.id, "❌ Ошибка БД")
-        return
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute('''SELECT user_id, username, first_name, last_name, first_visit, last_visit, total_commands 
-                                FROM user_activity ORDER BY last_visit DESC''')
-                rows = cur.fetchall()
-        text = "👥 СТАТИСТИКА ПОЛЬЗОВАТЕЛЕЙ БОТА\n" + "=" * 50 + "\n\n"
-        if not rows:
-            text += "❌ Нет активности\n"
-        else:
-            text += f"📊 Всего уникальных пользователей: {len(rows)}\n\n"
-            for idx, (user_id, username, first_name, last_name, first_visit, last_visit, total_commands) in enumerate(rows, 1):
-                full_name = f"{first_name} {last_name}".strip()
-                username_str = f"@{username}" if username else "нет username"
-                text += f"{idx}. {full_name} ({username_str})\n"
-                text += f"    ID: {user_id}\n"
-                text += f"    Первый визит: {first_visit}\n"
-                text += f"    Последний визит: {last_visit}\n"
-                text += f"    Команд использовано: {total_commands}\n\n"
-        bot.send_message(call.message.chat.id, text)
-    except Exception as e:
-        print(f"Ошибка show_user_stats: {e}")
-        bot.send_message(call.message.chat.id, f"❌ Ошибка: {str(e)}")
-    finally:
-        put_db_conn(conn)
+    activity_log.flush() # Чтобы админ видел и последние, еще не записанные команды
+    with db_connection() as conn:
+        if not conn:
+            bot.send_message(call.message.chat.id, "❌ Ошибка БД")
+            return
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute('''SELECT user_id, username, first_name, last_name, first_visit, last_visit, total_commands 
+                                    FROM user_activity ORDER BY last_visit DESC''')
+                    rows = cur.fetchall()
+            text = "👥 СТАТИСТИКА ПОЛЬЗОВАТЕЛЕЙ БОТА\n" + "=" * 50 + "\n\n"
+            if not rows:
+                text += "❌ Нет активности\n"
+            else:
+                text += f"📊 Всего уникальных пользователей: {len(rows)}\n\n"
+                for idx, (user_id, username, first_name, last_name, first_visit, last_visit, total_commands) in enumerate(rows, 1):
+                    full_name = f"{first_name} {last_name}".strip()
+                    username_str = f"@{username}" if username else "нет username"
+                    text += f"{idx}. {full_name} ({username_str})\n"
+                    text += f"    ID: {user_id}\n"
+                    text += f"    Первый визит: {first_visit}\n"
+                    text += f"    Последний визит: {last_visit}\n"
+                    text += f"    Команд использовано: {total_commands}\n\n"
+            bot.send_message(call.message.chat.id, text)
+        except Exception as e:
+            print(f"Ошибка show_user_stats: {e}")
+            bot.send_message(call.message.chat.id, f"❌ Ошибка: {str(e)}")
 
 # =========================================================================
 # ========== ИСПРАВЛЕННЫЙ БЛОК: УПРАВЛЕНИЕ СОЕДИНЕНИЯМИ ==========
@@ -976,25 +2278,18 @@ def show_player_list_for_action(chat_id, user_id, action_prefix, text_prompt):
     Эта функция теперь использует КЭШ и НЕ использует БД.
     """
     try:
-        # --- ИСПОЛЬЗУЕМ КЭШ ---
-        players_from_cache = player_cache.get_players()
+        # --- ИСПОЛЬЗУЕМ КЭШ (админ только что мог добавить/удалить игрока) ---
+        players_from_cache = player_cache.get_players(wait_fresh=True)
         # ---------------------
         
         if not players_from_cache:
             bot.send_message(chat_id, "❌ Нет игроков в системе. Сначала добавьте игроков.")
             return
         
-        markup = types.InlineKeyboardMarkup()
-        row = []
-        for player in players_from_cache:
-            row.append(types.InlineKeyboardButton(f"👤 {player['nickname']}", callback_data=f"{action_prefix}_{player['nickname']}"))
-            if len(row) == 2:
-                markup.add(*row)
-                row = []
-        if row: markup.add(*row)
-        
+        # Готовые строки кнопок из кэша (собираются один раз на версию кэша)
+        rows = player_cache.get_action_rows(action_prefix)
         # ▼▼▼ ИСПРАВЛЕНИЕ 3.4: ЗАМЕНА КНОПКИ "ОТМЕНА" ▼▼▼
-        markup.add(types.InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin_panel"))
+        markup = types.InlineKeyboardMarkup(keyboard=rows + [[types.InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin_panel")]])
         # ▲▲▲ КОНЕЦ ИСПРАВЛЕНИЯ 3.4 ▲▲▲
         bot.send_message(chat_id, text_prompt, reply_markup=markup)
     
@@ -1058,79 +2353,71 @@ def admin_buttons(call):
 
     # --- 3. Операции, которым НУЖНА БД или STATE (в try-finally) ---
     
-    conn = get_db_conn()
-    if not conn:
-        bot.send_message(chat_id, "❌ Ошибка БД")
-        return
+    with db_connection() as conn:
+        if not conn:
+            bot.send_message(chat_id, "❌ Ошибка БД")
+            return
     
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                if call.data == "admin_add_player":
-                    user_state[user_id] = {"action": "waiting_add_player"}
-                    bot.send_message(chat_id, "Введите nickname игрока:\nПример: PlayerName")
-                
-                elif call.data == "admin_add_game":
-                    user_state[user_id] = {"action": "waiting_add_game_screenshot"}
-                    bot.send_message(chat_id, "Отправьте скриншот игры:")
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    if call.data == "admin_add_player":
+                        user_state[user_id] = {"action": "waiting_add_player"}
+                        bot.send_message(chat_id, "Введите nickname игрока:\nПример: PlayerName")
                 
-                elif call.data == "admin_undo_game":
-                    cur.execute("SELECT id, radiant_players, dire_players, result, date FROM games ORDER BY id DESC LIMIT 1")
-                    last_game = cur.fetchone()
-                    if not last_game:
-                        bot.send_message(chat_id, "❌ Нет игр в базе данных для отмены.")
-                        return
-                    game_id, radiant, dire, result, date = last_game
-                    text = (f"⚠️ Вы уверены, что хотите отменить последнюю игру?\n\n"
-                            f"<b>ID Игры:</b> {game_id}\n"
-                            f"<b>Дата:</b> {date}\n"
-                            f"<b>Команды:</b> {radiant} (🟢) vs {dire} (🔴)\n"
-                            f"<b>Победитель:</b> {result.upper()}\n\n"
-                            f"Это действие необратимо и откатит весь рейтинг, KDA и W/L для 10 игроков.")
-                    markup = types.InlineKeyboardMarkup()
-                    markup.add(types.InlineKeyboardButton("✅ Да, отменить эту игру", callback_data=f"confirm_undo_{game_id}"))
-                    # ▼▼▼ ИСПРАВЛЕНИЕ 3.4: ЗАМЕНА КНОПКИ "ОТМЕНА" ▼▼▼
-                    markup.add(types.InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin_panel"))
-                    # ▲▲▲ КОНЕЦ ИСПРАВЛЕНИЯ 3.4 ▲▲▲
-                    bot.send_message(chat_id, text, reply_markup=markup)
+                    elif call.data == "admin_add_game":
+                        user_state[user_id] = {"action": "waiting_add_game_screenshot"}
+                        bot.send_message(chat_id, "Отправьте скриншот игры:")
                 
-                elif call.data == "admin_add_hero":
-                    user_state[user_id] = {"action": "waiting_add_hero_input"}
-                    text = "⚔️ <b>ДОБАВЛЕНИЕ ГЕРОЯ ИГРОКУ</b>\n\n"
-                    text += "Формат: <code>nickname hero position wins losses kills deaths assists</code>\n\n"
-                    text += "Позиции: 1=Carry, 2=Mid, 3=Offlane, 4=SoftSupport, 5=HardSupport\n\n"
-                    text += "Пример: <code>law Anti-Mage 1 5 3 45 12 67</code>"
-                    bot.send_message(chat_id, text)
+                    elif call.data == "admin_undo_game":
+                        cur.execute("SELECT id FROM games ORDER BY id DESC LIMIT 1")
+                        last_game = cur.fetchone()
+                        if not last_game:
+                            bot.send_message(chat_id, "❌ Нет игр в базе данных для отмены.")
+                            return
+                        text, markup = build_undo_preview(cur, last_game[0], last_game[0])
+                        bot.send_message(chat_id, text, reply_markup=markup)
+
+                    elif call.data == "admin_undo_games_by_id":
+                        user_state[user_id] = {"action": "waiting_undo_games_input"}
+                        bot.send_message(chat_id, "⏪ Введите ID игры или диапазон ID (до "
+                                                  f"{UNDO_MAX_GAMES} игр):\nПример: <code>42</code> или <code>40-45</code>")
                 
-                elif call.data == "admin_list":
-                    cur.execute('SELECT nickname, rating, wins, losses, mmr, positions FROM players ORDER BY rating DESC')
-                    rows = cur.fetchall()
-                    if not rows:
-                        bot.send_message(chat_id, "📭 Нет игроков в базе.")
-                    else:
-                        text = "📋 Список всех игроков:\n\n"
-                        for idx, (nickname, rating, wins, losses, mmr, positions_json) in enumerate(rows, 1):
-                            total = wins + losses
-                            wr = round((wins / total * 100), 1) if total > 0 else 0
-                            try:
-                                positions_list = json.loads(positions_json) if positions_json else []
-                            except Exception:
-                                positions_list = []
-                            pos_str = get_player_positions_str(positions_list)
-                            text += f"{idx}. {nickname}\n"
-                            text += f"    Рейтинг: {rating} | W/L: {wins}/{losses} | WR: {wr}% | MMR: {mmr}\n"
-                            text += f"    Позиции: {pos_str}\n\n"
+                    elif call.data == "admin_add_hero":
+                        user_state[user_id] = {"action": "waiting_add_hero_input"}
+                        text = "⚔️ <b>ДОБАВЛЕНИЕ ГЕРОЯ ИГРОКУ</b>\n\n"
+                        text += "Формат: <code>nickname hero position wins losses kills deaths assists</code>\n\n"
+                        text += "Позиции: 1=Carry, 2=Mid, 3=Offlane, 4=SoftSupport, 5=HardSupport\n\n"
+                        text += "Пример: <code>law Anti-Mage 1 5 3 45 12 67</code>"
                         bot.send_message(chat_id, text)
+                
+                    elif call.data == "admin_list":
+                        cur.execute('SELECT nickname, rating, wins, losses, mmr, positions FROM players ORDER BY rating DESC')
+                        rows = cur.fetchall()
+                        if not rows:
+                            bot.send_message(chat_id, "📭 Нет игроков в базе.")
+                        else:
+                            text = "📋 Список всех игроков:\n\n"
+                            for idx, (nickname, rating, wins, losses, mmr, positions_json) in enumerate(rows, 1):
+                                total = wins + losses
+                                wr = round((wins / total * 100), 1) if total > 0 else 0
+                                try:
+                                    positions_list = json.loads(positions_json) if positions_json else []
+                                except Exception:
+                                    positions_list = []
+                                pos_str = get_player_positions_str(positions_list)
+                                text += f"{idx}. {nickname}\n"
+                                text += f"    Рейтинг: {rating} | W/L: {wins}/{losses} | WR: {wr}% | MMR: {mmr}\n"
+                                text += f"    Позиции: {pos_str}\n\n"
+                            bot.send_message(chat_id, text)
     
-    except Exception as e:
-        print(f"Ошибка в admin_buttons: {e}")
-        try: 
-            bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
-        except Exception: 
-            pass
+        except Exception as e:
+            print(f"Ошибка в admin_buttons: {e}")
+            try: 
+                bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
+            except Exception: 
+                pass
     
-    finally:
-        put_db_conn(conn)
 
 # =========================================================================
 # ========== КОНЕЦ ИСПРАВЛЕННОГО БЛОКА: УПРАВЛЕНИЕ СОЕДИНЕНИЯМИ ==========
@@ -1144,26 +2431,24 @@ def handle_add_player(message):
     user_id = message.from_user.id
     chat_id = message.chat.id
     nickname = message.text.strip()
-    conn = get_db_conn()
-    if not conn:
-        bot.send_message(chat_id, "❌ Ошибка БД")
-        return
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    'INSERT INTO players (nickname, rating, wins, losses, mmr, positions, total_kills, total_deaths, total_assists) '
-                    'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (nickname) DO NOTHING',
-                    (nickname, 1000, 0, 0, 0, '[]', 0, 0, 0)
-                )
-        bot.send_message(chat_id, f"✅ Игрок {nickname} добавлен с начальным рейтингом 1000")
-        del user_state[user_id]
-        player_cache.invalidate() # <-- ОБНОВЛЯЕМ КЭШ
-    except Exception as e:
-        bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
-        if user_id in user_state: del user_state[user_id]
-    finally:
-        put_db_conn(conn)
+    with db_connection() as conn:
+        if not conn:
+            bot.send_message(chat_id, "❌ Ошибка БД")
+            return
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        'INSERT INTO players (nickname, rating, wins, losses, mmr, positions, total_kills, total_deaths, total_assists) '
+                        'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (nickname) DO NOTHING',
+                        (nickname, 1000, 0, 0, 0, '[]', 0, 0, 0)
+                    )
+            stats_changed([nickname])
+            del user_state[user_id]
+            reply_safely(bot.send_message, chat_id, f"✅ Игрок {nickname} добавлен с начальным рейтингом 1000")
+        except Exception as e:
+            bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
+            if user_id in user_state: del user_state[user_id]
 
 
 @bot.message_handler(
@@ -1174,100 +2459,99 @@ def handle_add_hero_input(message):
     chat_id = message.chat.id
     text = message.text.strip()
     nickname = "" 
-    conn = get_db_conn()
-    if not conn:
-        bot.send_message(chat_id, "❌ Ошибка БД")
-        return
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                tokens = text.rsplit(maxsplit=6)
-                # Разбиваем строку только на ник и остальную часть, чтобы имя героя могло содержать пробелы
-                parts = text.split(maxsplit=1)
-                if len(parts) < 2:
-                    bot.send_message(chat_id, "❌ Неверный формат. Используйте:\n<code>nickname hero position wins losses kills deaths assists</code>")
-                    return
-                nickname, rest = parts[0], parts[1].strip()
-                # Отделяем имя героя слева и 6 числовых показателей справа
-                hero_and_stats = rest.rsplit(maxsplit=6)
-                if len(hero_and_stats) != 7:
-                    bot.send_message(chat_id, "❌ Неверный формат. Используйте:\n<code>nickname hero position wins losses kills deaths assists</code>")
-                    return
-                hero_name = hero_and_stats[0].strip()
-                if not hero_name:
-                    bot.send_message(chat_id, "❌ Укажите название героя после ника игрока.")
-                    return
-                try:
-                    position, wins, losses, kills, deaths, assists = map(int, hero_and_stats[1:])
-                except ValueError:
-                    bot.send_message(chat_id, "❌ Ошибка в числовых значениях. Используйте числа для позиции и статистики.")
-                    return
-                if position not in POSITIONS:
-                    bot.send_message(chat_id, f"❌ Неверная позиция {position}! Используйте 1-5.")
-                    return
-                if any(value < 0 for value in (wins, losses, kills, deaths, assists)):
-                    bot.send_message(chat_id, "❌ Статистика не может содержать отрицательные значения.")
-                    return
-                cur.execute('SELECT nickname FROM players WHERE nickname=%s', (nickname,))
-                if not cur.fetchone():
-                    bot.send_message(chat_id, f"❌ Игрок '{nickname}' не найден!")
-                    del user_state[user_id]
-                    return
-                cur.execute('''
-                    INSERT INTO player_heroes (player_nickname, hero_name, wins, losses, total_kills, total_deaths, total_assists)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT(player_nickname, hero_name) DO UPDATE SET
-                        wins = player_heroes.wins + %s,
-                        losses = player_heroes.losses + %s,
-                        total_kills = player_heroes.total_kills + %s,
-                        total_deaths = player_heroes.total_deaths + %s,
-                        total_assists = player_heroes.total_assists + %s
-                ''', (nickname, hero_name, wins, losses, kills, deaths, assists,
-                      wins, losses, kills, deaths, assists))
-                cur.execute('''
-                    INSERT INTO player_role_stats (player_nickname, role_position, wins, losses)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT(player_nickname, role_position) DO UPDATE SET
-                        wins = player_role_stats.wins + %s,
-                        losses = player_role_stats.losses + %s
-                ''', (nickname, position, wins, losses, wins, losses))
-                rating_change = (wins * RATING_CHANGE) - (losses * RATING_CHANGE)
-                cur.execute(
-                    '''UPDATE players SET 
-                            wins = wins + %s, losses = losses + %s, rating = rating + %s, 
-                            total_kills = total_kills + %s, total_deaths = total_deaths + %s, 
-                            total_assists = total_assists + %s
-                        WHERE nickname=%s''',
-                    (wins, losses, rating_change, kills, deaths, assists, nickname)
-                )
-        print("✅✅✅ ТРАНЗАКЦИЯ УСПЕШНО ЗАВЕРШЕНА (COMMIT)")
-        position_name = POSITIONS.get(position, "?")
-        total_games = wins + losses
-        wr = round((wins / total_games * 100), 1) if total_games > 0 else 0
-        if deaths > 0:
-            kda_value = round((kills + assists) / deaths, 2)
-            kda_str = f"{kda_value:.2f}"
-        else:
-            kda_str = "∞" if (kills + assists) > 0 else "0"
-        success_text = f"✅ <b>ГЕРОЙ ДОБАВЛЕН УСПЕШНО!</b>\n\n"
-        success_text += f"👤 Игрок: <b>{nickname}</b>\n"
-        success_text += f"⚔️ Герой: <b>{hero_name}</b>\n"
-        success_text += f"🎯 Позиция: <b>{position_name}</b>\n\n"
-        success_text += f"📊 W/L: <b>{wins}/{losses}</b> | WR: <b>{wr}%</b>\n"
-        success_text += f"📊 KDA: <b>{kills}/{deaths}/{assists}</b> = {kda_str}\n\n"
-        success_text += f"💰 Рейтинг: <b>{rating_change:+d}</b> | Роль: <b>+{wins}W +{losses}L</b>"
-        bot.send_message(chat_id, success_text)
-        player_cache.invalidate() # <-- ОБНОВЛЯЕМ КЭШ
-    except Exception as e:
-        print(f"❌❌❌ ОШИБКА ТРАНЗАКЦИИ: {e}")
-        import traceback
-        traceback.print_exc()
-        bot.send_message(chat_id, f"❌ КРИТИЧЕСКАЯ ОШИБКА:\n<code>{str(e)}</code>")
-    finally:
-        put_db_conn(conn)
-        if user_id in user_state:
-            del user_state[user_id]
-            print(f"Состояние для {user_id} очищено.")
+    with db_connection() as conn:
+        if not conn:
+            bot.send_message(chat_id, "❌ Ошибка БД")
+            return
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    tokens = text.rsplit(maxsplit=6)
+                    # Разбиваем строку только на ник и остальную часть, чтобы имя героя могло содержать пробелы
+                    parts = text.split(maxsplit=1)
+                    if len(parts) < 2:
+                        bot.send_message(chat_id, "❌ Неверный формат. Используйте:\n<code>nickname hero position wins losses kills deaths assists</code>")
+                        return
+                    nickname, rest = parts[0], parts[1].strip()
+                    # Отделяем имя героя слева и 6 числовых показателей справа
+                    hero_and_stats = rest.rsplit(maxsplit=6)
+                    if len(hero_and_stats) != 7:
+                        bot.send_message(chat_id, "❌ Неверный формат. Используйте:\n<code>nickname hero position wins losses kills deaths assists</code>")
+                        return
+                    hero_name = hero_and_stats[0].strip()
+                    if not hero_name:
+                        bot.send_message(chat_id, "❌ Укажите название героя после ника игрока.")
+                        return
+                    try:
+                        position, wins, losses, kills, deaths, assists = map(int, hero_and_stats[1:])
+                    except ValueError:
+                        bot.send_message(chat_id, "❌ Ошибка в числовых значениях. Используйте числа для позиции и статистики.")
+                        return
+                    if position not in POSITIONS:
+                        bot.send_message(chat_id, f"❌ Неверная позиция {position}! Используйте 1-5.")
+                        return
+                    if any(value < 0 for value in (wins, losses, kills, deaths, assists)):
+                        bot.send_message(chat_id, "❌ Статистика не может содержать отрицательные значения.")
+                        return
+                    cur.execute('SELECT nickname FROM players WHERE nickname=%s', (nickname,))
+                    if not cur.fetchone():
+                        bot.send_message(chat_id, f"❌ Игрок '{nickname}' не найден!")
+                        del user_state[user_id]
+                        return
+                    cur.execute('''
+                        INSERT INTO player_heroes (player_nickname, hero_name, wins, losses, total_kills, total_deaths, total_assists)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s)
+                        ON CONFLICT(player_nickname, hero_name) DO UPDATE SET
+                            wins = player_heroes.wins + %s,
+                            losses = player_heroes.losses + %s,
+                            total_kills = player_heroes.total_kills + %s,
+                            total_deaths = player_heroes.total_deaths + %s,
+                            total_assists = player_heroes.total_assists + %s
+                    ''', (nickname, hero_name, wins, losses, kills, deaths, assists,
+                          wins, losses, kills, deaths, assists))
+                    cur.execute('''
+                        INSERT INTO player_role_stats (player_nickname, role_position, wins, losses)
+                        VALUES (%s, %s, %s, %s)
+                        ON CONFLICT(player_nickname, role_position) DO UPDATE SET
+                            wins = player_role_stats.wins + %s,
+                            losses = player_role_stats.losses + %s
+                    ''', (nickname, position, wins, losses, wins, losses))
+                    rating_change = (wins * RATING_CHANGE) - (losses * RATING_CHANGE)
+                    cur.execute(
+                        '''UPDATE players SET 
+                                wins = wins + %s, losses = losses + %s, rating = rating + %s, 
+                                total_kills = total_kills + %s, total_deaths = total_deaths + %s, 
+                                total_assists = total_assists + %s
+                            WHERE nickname=%s''',
+                        (wins, losses, rating_change, kills, deaths, assists, nickname)
+                    )
+            print("✅✅✅ ТРАНЗАКЦИЯ УСПЕШНО ЗАВЕРШЕНА (COMMIT)")
+            stats_changed([nickname], views=True)
+            position_name = POSITIONS.get(position, "?")
+            total_games = wins + losses
+            wr = round((wins / total_games * 100), 1) if total_games > 0 else 0
+            if deaths > 0:
+                kda_value = round((kills + assists) / deaths, 2)
+                kda_str = f"{kda_value:.2f}"
+            else:
+                kda_str = "∞" if (kills + assists) > 0 else "0"
+            success_text = f"✅ <b>ГЕРОЙ ДОБАВЛЕН УСПЕШНО!</b>\n\n"
+            success_text += f"👤 Игрок: <b>{nickname}</b>\n"
+            success_text += f"⚔️ Герой: <b>{hero_name}</b>\n"
+            success_text += f"🎯 Позиция: <b>{position_name}</b>\n\n"
+            success_text += f"📊 W/L: <b>{wins}/{losses}</b> | WR: <b>{wr}%</b>\n"
+            success_text += f"📊 KDA: <b>{kills}/{deaths}/{assists}</b> = {kda_str}\n\n"
+            success_text += f"💰 Рейтинг: <b>{rating_change:+d}</b> | Роль: <b>+{wins}W +{losses}L</b>"
+            reply_safely(bot.send_message, chat_id, success_text)
+        except Exception as e:
+            print(f"❌❌❌ ОШИБКА ТРАНЗАКЦИИ: {e}")
+            import traceback
+            traceback.print_exc()
+            bot.send_message(chat_id, f"❌ КРИТИЧЕСКАЯ ОШИБКА:\n<code>{str(e)}</code>")
+        finally:
+            if user_id in user_state:
+                del user_state[user_id]
+                print(f"Состояние для {user_id} очищено.")
 
 
 # =========================================================================
@@ -1275,43 +2559,41 @@ def handle_add_hero_input(message):
 # =========================================================================
 
 def show_role_management_menu(user_id, chat_id, nickname, message_id=None, prefix_text=""):
-    conn = get_db_conn()
-    if not conn:
-        bot.send_message(chat_id, "❌ Ошибка БД")
-        return
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    'SELECT role_position, wins, losses FROM player_role_stats WHERE player_nickname=%s ORDER BY role_position',
-                    (nickname,))
-                roles = cur.fetchall()
-        user_state[user_id] = {"action": "waiting_manage_roles_action", "nickname": nickname, "roles": roles}
-        if not roles:
-            text = f"{prefix_text}❌ У {nickname} нет статистики по ролям. Вы можете добавить их."
-        else:
-            text = f"{prefix_text}📊 Роли {nickname}:\n\n"
-            for role_pos, wins, losses in roles:
-                total = wins + losses
-                wr = round((wins / total * 100), 1) if total > 0 else 0
-                role_name = POSITIONS.get(role_pos, "?")
-                text += f"{role_pos}. {role_name}: W/L {wins}/{losses} | WR {wr}%\n"
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("➕ Добавить роль", callback_data=f"add_role_for_{nickname}"))
-        markup.add(types.InlineKeyboardButton("✏️ Редактировать роль", callback_data=f"edit_role_{nickname}"))
-        markup.add(types.InlineKeyboardButton("🗑️ Удалить роль", callback_data=f"delete_role_{nickname}"))
-        # ▼▼▼ ИСПРАВЛЕНИЕ 3.4: ЗАМЕНА КНОПКИ "ОТМЕНА" ▼▼▼
-        markup.add(types.InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin_panel"))
-        # ▲▲▲ КОНЕЦ ИСПРАВЛЕНИЯ 3.4 ▲▲▲
-        if message_id:
-            bot.edit_message_text(text, chat_id, message_id, reply_markup=markup)
-        else:
-            bot.send_message(chat_id, text, reply_markup=markup)
-    except Exception as e:
-        bot.send_message(chat_id, f"❌ Ошибка в show_role_management_menu: {str(e)}")
-        if user_id in user_state: del user_state[user_id]
-    finally:
-        put_db_conn(conn)
+    with db_connection() as conn:
+        if not conn:
+            bot.send_message(chat_id, "❌ Ошибка БД")
+            return
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        'SELECT role_position, wins, losses FROM player_role_stats WHERE player_nickname=%s ORDER BY role_position',
+                        (nickname,))
+                    roles = cur.fetchall()
+            user_state[user_id] = {"action": "waiting_manage_roles_action", "nickname": nickname, "roles": roles}
+            if not roles:
+                text = f"{prefix_text}❌ У {nickname} нет статистики по ролям. Вы можете добавить их."
+            else:
+                text = f"{prefix_text}📊 Роли {nickname}:\n\n"
+                for role_pos, wins, losses in roles:
+                    total = wins + losses
+                    wr = round((wins / total * 100), 1) if total > 0 else 0
+                    role_name = POSITIONS.get(role_pos, "?")
+                    text += f"{role_pos}. {role_name}: W/L {wins}/{losses} | WR {wr}%\n"
+            markup = types.InlineKeyboardMarkup()
+            markup.add(types.InlineKeyboardButton("➕ Добавить роль", callback_data=f"add_role_for_{nickname}"))
+            markup.add(types.InlineKeyboardButton("✏️ Редактировать роль", callback_data=f"edit_role_{nickname}"))
+            markup.add(types.InlineKeyboardButton("🗑️ Удалить роль", callback_data=f"delete_role_{nickname}"))
+            # ▼▼▼ ИСПРАВЛЕНИЕ 3.4: ЗАМЕНА КНОПКИ "ОТМЕНА" ▼▼▼
+            markup.add(types.InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin_panel"))
+            # ▲▲▲ КОНЕЦ ИСПРАВЛЕНИЯ 3.4 ▲▲▲
+            if message_id:
+                bot.edit_message_text(text, chat_id, message_id, reply_markup=markup)
+            else:
+                bot.send_message(chat_id, text, reply_markup=markup)
+        except Exception as e:
+            bot.send_message(chat_id, f"❌ Ошибка в show_role_management_menu: {str(e)}")
+            if user_id in user_state: del user_state[user_id]
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("select_for_manage_roles_"))
 def handle_select_player_for_manage_roles(call):
@@ -1358,30 +2640,28 @@ def handle_add_role_confirm(call):
     try: bot.answer_callback_query(call.id)
     except Exception: pass
     if user_id not in user_state: return
-    conn = get_db_conn()
-    if not conn:
-        bot.send_message(chat_id, "❌ Ошибка БД")
-        return
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                role_pos = int(call.data.replace("confirm_add_role_", ""))
-                nickname = user_state[user_id]["nickname"]
-                cur.execute('''
-                    INSERT INTO player_role_stats (player_nickname, role_position, wins, losses)
-                    VALUES (%s, %s, 0, 0)
-                    ON CONFLICT(player_nickname, role_position) DO NOTHING
-                ''', (nickname, role_pos))
-        role_name = POSITIONS.get(role_pos, "?")
-        prefix_text = f"✅ Роль {role_name} (0/0) добавлена!\n\n"
-        # ▼▼▼ ИСПРАВЛЕНИЕ 4: ДОБАВЛЕН СБРОС КЭША ▼▼▼
-        player_cache.invalidate()
-        # ▲▲▲ КОНЕЦ ИСПРАВЛЕНИЯ 4 ▲▲▲
-        show_role_management_menu(user_id, chat_id, nickname, message_id=call.message.message_id, prefix_text=prefix_text)
-    except Exception as e:
-        bot.send_message(chat_id, f"❌ Ошибка при добавлении роли: {str(e)}")
-    finally:
-        put_db_conn(conn)
+    with db_connection() as conn:
+        if not conn:
+            bot.send_message(chat_id, "❌ Ошибка БД")
+            return
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    role_pos = int(call.data.replace("confirm_add_role_", ""))
+                    nickname = user_state[user_id]["nickname"]
+                    cur.execute('''
+                        INSERT INTO player_role_stats (player_nickname, role_position, wins, losses)
+                        VALUES (%s, %s, 0, 0)
+                        ON CONFLICT(player_nickname, role_position) DO NOTHING
+                    ''', (nickname, role_pos))
+            # ▼▼▼ ИСПРАВЛЕНИЕ 4: ДОБАВЛЕН СБРОС КЭША ▼▼▼
+            stats_changed([nickname], views=True)
+            # ▲▲▲ КОНЕЦ ИСПРАВЛЕНИЯ 4 ▲▲▲
+            role_name = POSITIONS.get(role_pos, "?")
+            prefix_text = f"✅ Роль {role_name} (0/0) добавлена!\n\n"
+            reply_safely(show_role_management_menu, user_id, chat_id, nickname, message_id=call.message.message_id, prefix_text=prefix_text)
+        except Exception as e:
+            bot.send_message(chat_id, f"❌ Ошибка при добавлении роли: {str(e)}")
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("edit_role_"))
 def edit_role(call):
@@ -1454,45 +2734,43 @@ def handle_edit_role_stats(message):
     if not is_admin(message.from_user.id): return
     user_id = message.from_user.id
     chat_id = message.chat.id
-    conn = get_db_conn()
-    if not conn:
-        bot.send_message(chat_id, "❌ Ошибка БД")
-        return
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                parts = message.text.strip().split()
-                if len(parts) != 2:
-                    bot.send_message(chat_id, "❌ Неверный формат. Используйте: wins losses\nПример: 10 5")
-                    return
-                wins = int(parts[0])
-                losses = int(parts[1])
-                state = user_state[user_id]
-                nickname = state["nickname"]
-                role_position = state["role_position"]
-                message_id = state.get("message_id")
-                cur.execute(
-                    '''UPDATE player_role_stats SET wins=%s, losses=%s WHERE player_nickname=%s AND role_position=%s''',
-                    (wins, losses, nickname, role_position)
-                )
-        try:
-            if message_id:
-                bot.delete_message(chat_id, message_id)
-        except Exception: pass
+    with db_connection() as conn:
+        if not conn:
+            bot.send_message(chat_id, "❌ Ошибка БД")
+            return
         try:
-            bot.delete_message(chat_id, message.message_id)
-        except Exception: pass
-        role_name = POSITIONS.get(role_position, "?")
-        prefix_text = f"✅ Статистика {role_name} обновлена!\n\n"
-        # ▼▼▼ ИСПРАВЛЕНИЕ 4: ДОБАВЛЕН СБРОС КЭША ▼▼▼
-        player_cache.invalidate()
-        # ▲▲▲ КОНЕЦ ИСПРАВЛЕНИЯ 4 ▲▲▲
-        show_role_management_menu(user_id, chat_id, nickname, prefix_text=prefix_text)
-    except Exception as e:
-        bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
-        if user_id in user_state: del user_state[user_id]
-    finally:
-        put_db_conn(conn)
+            with conn:
+                with conn.cursor() as cur:
+                    parts = message.text.strip().split()
+                    if len(parts) != 2:
+                        bot.send_message(chat_id, "❌ Неверный формат. Используйте: wins losses\nПример: 10 5")
+                        return
+                    wins = int(parts[0])
+                    losses = int(parts[1])
+                    state = user_state[user_id]
+                    nickname = state["nickname"]
+                    role_position = state["role_position"]
+                    message_id = state.get("message_id")
+                    cur.execute(
+                        '''UPDATE player_role_stats SET wins=%s, losses=%s WHERE player_nickname=%s AND role_position=%s''',
+                        (wins, losses, nickname, role_position)
+                    )
+            # ▼▼▼ ИСПРАВЛЕНИЕ 4: ДОБАВЛЕН СБРОС КЭША ▼▼▼
+            stats_changed([nickname], views=True)
+            # ▲▲▲ КОНЕЦ ИСПРАВЛЕНИЯ 4 ▲▲▲
+            try:
+                if message_id:
+                    bot.delete_message(chat_id, message_id)
+            except Exception: pass
+            try:
+                bot.delete_message(chat_id, message.message_id)
+            except Exception: pass
+            role_name = POSITIONS.get(role_position, "?")
+            prefix_text = f"✅ Статистика {role_name} обновлена!\n\n"
+            reply_safely(show_role_management_menu, user_id, chat_id, nickname, prefix_text=prefix_text)
+        except Exception as e:
+            bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
+            if user_id in user_state: del user_state[user_id]
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("delete_role_"))
 def delete_role(call):
@@ -1520,36 +2798,34 @@ def delete_role(call):
     markup.add(types.InlineKeyboardButton("❌ Назад", callback_data="back_to_role_menu"))
     bot.edit_message_text("Выберите роль для удаления:", chat_id, call.message.message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("confirm_delete_role_"))
-def confirm_delete_role(call):
-    if not is_admin(call.from_user.id): return
-    user_id = call.from_user.id
-    chat_id = call.message.chat.id
-    try: bot.answer_callback_query(call.id)
-    except Exception: pass
-    if user_id not in user_state: return
-    conn = get_db_conn()
-    if not conn:
-        bot.send_message(chat_id, "❌ Ошибка БД")
-        return
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                role_pos = int(call.data.replace("confirm_delete_role_", ""))
-                state = user_state[user_id]
-                nickname = state["nickname"]
-                cur.execute('DELETE FROM player_role_stats WHERE player_nickname=%s AND role_position=%s',
-                            (nickname, role_pos))
-        role_name = POSITIONS.get(role_pos, "?")
-        prefix_text = f"✅ Роль {role_name} удалена!\n\n"
-        # ▼▼▼ ИСПРАВЛЕНИЕ 4: ДОБАВЛЕН СБРОС КЭША ▼▼▼
-        player_cache.invalidate()
-        # ▲▲▲ КОНЕЦ ИСПРАВЛЕНИЯ 4 ▲▲▲
-        show_role_management_menu(user_id, chat_id, nickname, message_id=call.message.message_id, prefix_text=prefix_text)
-    except Exception as e:
-        bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
-    finally:
-        put_db_conn(conn)
+@bot.callback_query_handler(func=lambda call: call.data.startswith("confirm_delete_role_"))
+def confirm_delete_role(call):
+    if not is_admin(call.from_user.id): return
+    user_id = call.from_user.id
+    chat_id = call.message.chat.id
+    try: bot.answer_callback_query(call.id)
+    except Exception: pass
+    if user_id not in user_state: return
+    with db_connection() as conn:
+        if not conn:
+            bot.send_message(chat_id, "❌ Ошибка БД")
+            return
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    role_pos = int(call.data.replace("confirm_delete_role_", ""))
+                    state = user_state[user_id]
+                    nickname = state["nickname"]
+                    cur.execute('DELETE FROM player_role_stats WHERE player_nickname=%s AND role_position=%s',
+                                (nickname, role_pos))
+            # ▼▼▼ ИСПРАВЛЕНИЕ 4: ДОБАВЛЕН СБРОС КЭША ▼▼▼
+            stats_changed([nickname], views=True)
+            # ▲▲▲ КОНЕЦ ИСПРАВЛЕНИЯ 4 ▲▲▲
+            role_name = POSITIONS.get(role_pos, "?")
+            prefix_text = f"✅ Роль {role_name} удалена!\n\n"
+            reply_safely(show_role_management_menu, user_id, chat_id, nickname, message_id=call.message.message_id, prefix_text=prefix_text)
+        except Exception as e:
+            bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
 
 # ▼▼▼ ИСПРАВЛЕНИЕ 3.5: УДАЛЕНИЕ СТАРОЙ ФУНКЦИИ ОТМЕНЫ ▼▼▼
 # @bot.callback_query_handler(func=lambda call: call.data == "cancel_manage_roles")
@@ -1567,35 +2843,33 @@ def handle_add_game_screenshot(message):
     if not is_admin(message.from_user.id): return
     user_id = message.from_user.id
     chat_id = message.chat.id
-    conn = get_db_conn()
-    if not conn:
-        bot.send_message(chat_id, "❌ Ошибка БД")
-        return
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                photo = message.photo[-1]
-                screenshot_file_id = photo.file_id
-                cur.execute('SELECT nickname FROM players ORDER BY nickname')
-                players = [row[0] for row in cur.fetchall()]
-        if not players:
-            bot.send_message(chat_id, "❌ Нет игроков в системе. Сначала добавьте игроков.")
-            del user_state[user_id]
+    with db_connection() as conn:
+        if not conn:
+            bot.send_message(chat_id, "❌ Ошибка БД")
             return
-        user_state[user_id] = {
-            "action": "waiting_radiant_players", "screenshot_file_id": screenshot_file_id,
-            "players": players, "radiant_selected": [], "dire_selected": [], "player_stats": {}
-        }
-        markup = types.InlineKeyboardMarkup()
-        for player in players:
-            markup.add(types.InlineKeyboardButton(f"{player}", callback_data=f"select_radiant_{player}"))
-        markup.add(types.InlineKeyboardButton("✅ Готово с Radiant", callback_data="done_radiant"))
-        bot.send_message(chat_id, "🟢 Выберите игроков за RADIANT:", reply_markup=markup)
-    except Exception as e:
-        bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
-        if user_id in user_state: del user_state[user_id]
-    finally:
-        put_db_conn(conn)
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    photo = message.photo[-1]
+                    screenshot_file_id = photo.file_id
+                    cur.execute('SELECT nickname FROM players ORDER BY nickname')
+                    players = [row[0] for row in cur.fetchall()]
+            if not players:
+                bot.send_message(chat_id, "❌ Нет игроков в системе. Сначала добавьте игроков.")
+                del user_state[user_id]
+                return
+            user_state[user_id] = {
+                "action": "waiting_radiant_players", "screenshot_file_id": screenshot_file_id,
+                "players": players, "radiant_selected": [], "dire_selected": [], "player_stats": {}
+            }
+            markup = types.InlineKeyboardMarkup()
+            for player in players:
+                markup.add(types.InlineKeyboardButton(f"{player}", callback_data=f"select_radiant_{player}"))
+            markup.add(types.InlineKeyboardButton("✅ Готово с Radiant", callback_data="done_radiant"))
+            bot.send_message(chat_id, "🟢 Выберите игроков за RADIANT:", reply_markup=markup)
+        except Exception as e:
+            bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
+            if user_id in user_state: del user_state[user_id]
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("select_radiant_"))
@@ -1745,54 +3019,52 @@ def handle_player_stats(message):
     chat_id = message.chat.id
     if user_id not in user_state: return
     state = user_state[user_id]
-    conn = get_db_conn()
-    if not conn:
-        bot.send_message(chat_id, "❌ Ошибка БД")
-        return
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                parts = message.text.strip().split()
-                if len(parts) < 4:
-                    bot.send_message(chat_id, "❌ Неверный формат...")
-                    return
-                hero = " ".join(parts[:-3])
-                kills = int(parts[-3])
-                deaths = int(parts[-2])
-                assists = int(parts[-1])
-                current_player = state["current_player"]
-                state["temp_stats"] = {
-                    "hero": hero, "kills": kills, "deaths": deaths,
-                    "assists": assists, "team": state["current_team"]
-                }
-                state["action"] = "selecting_player_role"
+    with db_connection() as conn:
+        if not conn:
+            bot.send_message(chat_id, "❌ Ошибка БД")
+            return
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    parts = message.text.strip().split()
+                    if len(parts) < 4:
+                        bot.send_message(chat_id, "❌ Неверный формат...")
+                        return
+                    hero = " ".join(parts[:-3])
+                    kills = int(parts[-3])
+                    deaths = int(parts[-2])
+                    assists = int(parts[-1])
+                    current_player = state["current_player"]
+                    state["temp_stats"] = {
+                        "hero": hero, "kills": kills, "deaths": deaths,
+                        "assists": assists, "team": state["current_team"]
+                    }
+                    state["action"] = "selecting_player_role"
                 
-                # ▼▼▼ ИСПРАВЛЕНИЕ 2: ЧИНИМ ЛОГИКУ ВЫБОРА РОЛЕЙ ▼▼▼
-                cur.execute('SELECT role_position FROM player_role_stats WHERE player_nickname=%s ORDER BY role_position', (current_player,))
-                rows = cur.fetchall()
-                player_positions_from_stats = [row[0] for row in rows]
-
-                # Если у игрока нет ВООБЩЕ никаких ролей, показываем все 5
-                if not player_positions_from_stats:
-                    player_positions_to_show = list(POSITIONS.keys())
-                else:
-                    player_positions_to_show = player_positions_from_stats
-                # ▲▲▲ КОНЕЦ ИСПРАВЛЕНИЯ 2 ▲▲▲
+                    # ▼▼▼ ИСПРАВЛЕНИЕ 2: ЧИНИМ ЛОГИКУ ВЫБОРА РОЛЕЙ ▼▼▼
+                    cur.execute('SELECT role_position FROM player_role_stats WHERE player_nickname=%s ORDER BY role_position', (current_player,))
+                    rows = cur.fetchall()
+                    player_positions_from_stats = [row[0] for row in rows]
+
+                    # Если у игрока нет ВООБЩЕ никаких ролей, показываем все 5
+                    if not player_positions_from_stats:
+                        player_positions_to_show = list(POSITIONS.keys())
+                    else:
+                        player_positions_to_show = player_positions_from_stats
+                    # ▲▲▲ КОНЕЦ ИСПРАВЛЕНИЯ 2 ▲▲▲
         
-        # Этот try/except блок был ошибочно внутри with conn:
-        try:
-            markup = types.InlineKeyboardMarkup()
-            for pos in player_positions_to_show: # <--- Используем новую переменную
-                pos_name = POSITIONS.get(pos, "Неизвестная")
-                markup.add(types.InlineKeyboardButton(f"{pos}. {pos_name}", callback_data=f"set_game_role_{pos}"))
-            bot.send_message(chat_id, f"Выберите роль для {current_player} в этой игре:", reply_markup=markup)
+            # Этот try/except блок был ошибочно внутри with conn:
+            try:
+                markup = types.InlineKeyboardMarkup()
+                for pos in player_positions_to_show: # <--- Используем новую переменную
+                    pos_name = POSITIONS.get(pos, "Неизвестная")
+                    markup.add(types.InlineKeyboardButton(f"{pos}. {pos_name}", callback_data=f"set_game_role_{pos}"))
+                bot.send_message(chat_id, f"Выберите роль для {current_player} в этой игре:", reply_markup=markup)
+            except Exception as e:
+                bot.send_message(chat_id, f"❌ Ошибка: {str(e)}...")
+            
         except Exception as e:
             bot.send_message(chat_id, f"❌ Ошибка: {str(e)}...")
-            
-    except Exception as e:
-        bot.send_message(chat_id, f"❌ Ошибка: {str(e)}...")
-    finally:
-        put_db_conn(conn)
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("set_game_role_"))
@@ -1824,10 +3096,7 @@ def handle_game_role_selection(call):
                     f"✅ Роль выбрана!\n\n🟢 Введите данные для {current_player} (Radiant)\n\n"
                     "Формат: Герой Убийства Смерти Ассисты"
                 )
-                bot.edit_message_text(message_text, chat_id=chat_id, message_id=call.message.message_id),
-                    chat_id=chat_id,
-                    message_id=call.message.message_id
-                )
+                bot.edit_message_text(message_text, chat_id=chat_id, message_id=call.message.message_id)
             else:
                 state["current_team"] = "dire"
                 state["current_player_index"] = 0
@@ -1854,23 +3123,6 @@ def handle_game_role_selection(call):
             else:
                 bot.edit_message_text("✅ Роль выбрана!", chat_id=chat_id, message_id=call.message.message_id)
                 show_result_selection(chat_id, state)
-        else:
-            if state["current_player_index"] < len(state["dire_selected"]):
-                current_player = state["dire_selected"][state["current_player_index"]]
-                state["current_player"] = current_player
-                bot.edit_message_text(
-                    f"✅ Роль выбрана!\n\n🔴 Введите данные для {current_player} (Dire)\n\n"
-                    f"Формат: Герой Убийства Смерти Ассисты",
-                    chat_id=chat_id,
-                    message_id=call.message.message_id
-                )
-            else:
-                bot.edit_message_text(
-                    "✅ Роль выбрана!",
-                    chat_id=chat_id,
-                    message_id=call.message.message_id
-                )
-                show_result_selection(chat_id, state)
     except Exception as e:
         bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
 
@@ -1885,6 +3137,92 @@ def show_result_selection(chat_id, state):
     except Exception: pass
 
 
+# ===== ЗАПИСЬ ИГРЫ ПАКЕТОМ =====
+# Вся игра - 5 запросов независимо от размера лобби: игра, игроки (блокировка
+# + UPDATE ... FROM VALUES), player_game_stats, герои и роли многострочными
+# upsert'ами. Все строки идут в порядке ников, поэтому две одновременные
+# записи берут блокировки в одном порядке и не ловят deadlock.
+
+def record_game(cur, player_stats, winners, result, screenshot_file_id, radiant_str, dire_str):
+    """
+    Записывает игру внутри уже открытой транзакции.
+    player_stats: {nickname: {"hero", "kills", "deaths", "assists", "team", "position"}}
+    Возвращает (game_id, {nickname: (wins, losses, rating, rating_delta)}) -
+    только для игроков, которые есть в players.
+    """
+    now = datetime.now()
+    cur.execute('''INSERT INTO games 
+                    (screenshot_file_id, radiant_players, dire_players, result, date, time, description, played_at) 
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id''',
+                (screenshot_file_id, radiant_str, dire_str, result,
+                 now.strftime("%Y-%m-%d"), now.strftime("%H:%M"), "", now))
+    game_id = cur.fetchone()[0]
+
+    lineup = sorted(player_stats.items())
+    is_win = {player: 1 if player in winners else 0 for player, _ in lineup}
+
+    # 1. Игроки: FOR UPDATE по порядку ников, затем одно обновление всех сразу.
+    # Старый рейтинг берем из locked, чтобы вернуть точное изменение (с учетом пола 0)
+    outcome_rows = execute_values(cur, f'''
+        WITH game_input (nickname, is_win, kills, deaths, assists) AS (VALUES %s),
+        locked AS (
+            SELECT p.nickname, p.rating FROM players p
+            WHERE p.nickname IN (SELECT nickname FROM game_input)
+            ORDER BY p.nickname
+            FOR UPDATE
+        )
+        UPDATE players p SET
+            wins = p.wins + i.is_win,
+            losses = p.losses + (1 - i.is_win),
+            -- Пол 0 только у проигравших, как в прежней записи по строкам
+            rating = CASE WHEN i.is_win = 1 THEN p.rating + {RATING_CHANGE}
+                          ELSE GREATEST(0, p.rating - {RATING_CHANGE}) END,
+            total_kills = p.total_kills + i.kills,
+            total_deaths = p.total_deaths + i.deaths,
+            total_assists = p.total_assists + i.assists
+        FROM game_input i JOIN locked l ON l.nickname = i.nickname
+        WHERE p.nickname = i.nickname
+        RETURNING p.nickname, p.wins, p.losses, p.rating, p.rating - l.rating
+    ''',
+        [(player, is_win[player], stats["kills"], stats["deaths"], stats["assists"]) for player, stats in lineup],
+        template='(%s::text, %s::int, %s::int, %s::int, %s::int)', fetch=True)
+    outcomes = {nick: (wins, losses, rating, delta) for nick, wins, losses, rating, delta in outcome_rows}
+
+    # 2. Строки игры (для всех, как и раньше), вместе с изменением рейтинга для отката
+    execute_values(cur, '''
+        INSERT INTO player_game_stats 
+            (game_id, player_nickname, hero, kills, deaths, assists, team, position, rating_delta) 
+        VALUES %s
+    ''', [(game_id, player, stats["hero"], stats["kills"], stats["deaths"], stats["assists"],
+           stats["team"], stats.get("position", 0), outcomes[player][3] if player in outcomes else 0)
+          for player, stats in lineup])
+
+    # 3. Герои и роли - только существующим игрокам (внешний ключ на players)
+    present = [(player, stats) for player, stats in lineup if player in outcomes]
+    if present:
+        execute_values(cur, '''
+            INSERT INTO player_heroes (player_nickname, hero_name, wins, losses, total_kills, total_deaths, total_assists)
+            VALUES %s
+            ON CONFLICT(player_nickname, hero_name) DO UPDATE SET
+                wins = player_heroes.wins + EXCLUDED.wins,
+                losses = player_heroes.losses + EXCLUDED.losses,
+                total_kills = player_heroes.total_kills + EXCLUDED.total_kills,
+                total_deaths = player_heroes.total_deaths + EXCLUDED.total_deaths,
+                total_assists = player_heroes.total_assists + EXCLUDED.total_assists
+        ''', [(player, stats["hero"], is_win[player], 1 - is_win[player],
+               stats["kills"], stats["deaths"], stats["assists"]) for player, stats in present])
+    role_rows = [(player, stats["position"], is_win[player], 1 - is_win[player])
+                 for player, stats in present if stats.get("position", 0) > 0]
+    if role_rows:
+        execute_values(cur, '''
+            INSERT INTO player_role_stats (player_nickname, role_position, wins, losses)
+            VALUES %s
+            ON CONFLICT(player_nickname, role_position) DO UPDATE SET
+                wins = player_role_stats.wins + EXCLUDED.wins,
+                losses = player_role_stats.losses + EXCLUDED.losses
+        ''', role_rows)
+    return game_id, outcomes
+
 @bot.callback_query_handler(func=lambda call: call.data in ["result_radiant", "result_dire"])
 def set_game_result(call):
     if not is_admin(call.from_user.id): return
@@ -1898,188 +3236,141 @@ def set_game_result(call):
     winners = state["radiant_selected"] if result == "radiant" else state["dire_selected"]
     radiant_str = ", ".join(state["radiant_selected"])
     dire_str = ", ".join(state["dire_selected"])
-    conn = get_db_conn()
-    if not conn:
-        bot.send_message(chat_id, "❌ Ошибка БД")
-        return
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                now = datetime.now()
-                date_str = now.strftime("%Y-%m-%d")
-                time_str = now.strftime("%H:%M")
-                cur.execute('''INSERT INTO games 
-                                (screenshot_file_id, radiant_players, dire_players, result, date, time, description) 
-                                VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id''',
-                            (state['screenshot_file_id'], radiant_str, dire_str, result, date_str, time_str, ""))
-                game_id = cur.fetchone()[0]
-                text_report = f"✅ Игра {game_id} добавлена!\n🏆 Победители: {result.upper()}\n\n"
-                team_reports = {"radiant": "🟢 RADIANT:\n", "dire": "🔴 DIRE:\n"}
-                for player, stats in state["player_stats"].items():
-                    hero_name = stats["hero"]
-                    kills = stats["kills"]
-                    deaths = stats["deaths"]
-                    assists = stats["assists"]
-                    position = stats.get("position", 0)
-                    team = stats["team"]
-                    cur.execute('''INSERT INTO player_game_stats 
-                                    (game_id, player_nickname, hero, kills, deaths, assists, team, position) 
-                                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)''',
-                                (game_id, player, hero_name, kills, deaths, assists, team, position))
-                    cur.execute(
-                        'SELECT wins, losses, rating, total_kills, total_deaths, total_assists '
-                        'FROM players WHERE nickname=%s FOR UPDATE', (player,))
-                    row = cur.fetchone()
-                    if row:
-                        wins, losses, rating, total_kills, total_deaths, total_assists = row
-                        is_winner = (player in winners)
-                        rating_change_val = 0 
-                        if is_winner:
-                            wins += 1
-                            rating += RATING_CHANGE
-                            rating_change_val = RATING_CHANGE
-                            rating_change_str = f"+{rating_change_val}"
-                        else:
-                            losses += 1
-                            rating_before_loss = rating
-                            rating = max(0, rating - RATING_CHANGE)
-                            rating_change_val = rating - rating_before_loss 
-                            rating_change_str = f"{rating_change_val}"
-                        total_kills += kills
-                        total_deaths += deaths
-                        total_assists += assists
-                        cur.execute(
-                            'UPDATE players SET wins=%s, losses=%s, rating=%s, total_kills=%s, total_deaths=%s, total_assists=%s '
-                            'WHERE nickname=%s',
-                            (wins, losses, rating, total_kills, total_deaths, total_assists, player)
-                        )
+    with db_connection() as conn:
+        if not conn:
+            bot.send_message(chat_id, "❌ Ошибка БД")
+            return
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    game_id, outcomes = record_game(
+                        cur, state["player_stats"], winners, result,
+                        state['screenshot_file_id'], radiant_str, dire_str
+                    )
+                    text_report = f"✅ Игра {game_id} добавлена!\n🏆 Победители: {result.upper()}\n\n"
+                    team_reports = {"radiant": "🟢 RADIANT:\n", "dire": "🔴 DIRE:\n"}
+                    for player, stats in state["player_stats"].items():
+                        outcome = outcomes.get(player)
+                        if not outcome: continue # Игрока удалили, пока заполняли игру
+                        wins, losses, rating, rating_change_val = outcome
+                        rating_change_str = f"+{rating_change_val}" if rating_change_val > 0 else f"{rating_change_val}"
                         new_wr = round((wins / (wins + losses) * 100), 1) if (wins + losses) > 0 else 0
-                        role_name = POSITIONS.get(position, "Не указано")
-                        team_reports[team] += (f"    {player} ({hero_name}) - Роль: {role_name}\n"
-                                               f"    KDA: {kills}/{deaths}/{assists}\n"
-                                               f"    Рейтинг: {rating} ({rating_change_str}) | WR: {new_wr}%\n\n")
-                        is_win = 1 if is_winner else 0
-                        cur.execute('''
-                            INSERT INTO player_heroes (player_nickname, hero_name, wins, losses, total_kills, total_deaths, total_assists)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s)
-                            ON CONFLICT(player_nickname, hero_name) DO UPDATE SET
-                                wins = player_heroes.wins + %s,
-                                losses = player_heroes.losses + %s,
-                                total_kills = player_heroes.total_kills + %s,
-                                total_deaths = player_heroes.total_deaths + %s,
-                                total_assists = player_heroes.total_assists + %s
-                        ''', (player, hero_name, is_win, 1 - is_win, kills, deaths, assists,
-                              is_win, 1 - is_win, kills, deaths, assists))
-                        if position > 0:
-                            cur.execute('''
-                                INSERT INTO player_role_stats (player_nickname, role_position, wins, losses)
-                                VALUES (%s, %s, %s, %s)
-                                ON CONFLICT(player_nickname, role_position) DO UPDATE SET
-                                    wins = player_role_stats.wins + %s,
-                                    losses = player_role_stats.losses + %s
-                            ''', (player, position, is_win, 1 - is_win, is_win, 1 - is_win))
+                        role_name = POSITIONS.get(stats.get("position", 0), "Не указано")
+                        team_reports[stats["team"]] += (f"    {player} ({stats['hero']}) - Роль: {role_name}\n"
+                                                        f"    KDA: {stats['kills']}/{stats['deaths']}/{stats['assists']}\n"
+                                                        f"    Рейтинг: {rating} ({rating_change_str}) | WR: {new_wr}%\n\n")
+            stats_changed(state["player_stats"].keys(), views=True) # <-- ОБНОВЛЯЕМ КЭШ ПОСЛЕ ИГРЫ
         
-        text_report += team_reports["radiant"] + team_reports["dire"]
-        bot.send_message(chat_id, text_report)
-        player_cache.invalidate() # <-- ОБНОВЛЯЕМ КЭШ ПОСЛЕ ИГРЫ
-    except Exception as e:
-        print(f"Ошибка set_game_result: {e}")
-        bot.send_message(chat_id, f"❌ Ошибка при сохранении игры: {str(e)}")
-    finally:
-        put_db_conn(conn)
-        if user_id in user_state:
-            del user_state[user_id]
+            text_report += team_reports["radiant"] + team_reports["dire"]
+            reply_safely(bot.send_message, chat_id, text_report)
+        except Exception as e:
+            print(f"Ошибка set_game_result: {e}")
+            bot.send_message(chat_id, f"❌ Ошибка при сохранении игры: {str(e)}")
+        finally:
+            if user_id in user_state:
+                del user_state[user_id]
 
 # ▼▼▼ НОВЫЕ ФУНКЦИИ ДЛЯ /statshero ▼▼▼
-def get_global_hero_stats_text(min_games=2):
+STATSHERO_DEFAULT_MIN_GAMES = 2
+STATSHERO_DEFAULT_LIMIT = 10
+STATSHERO_MAX_LIMIT = 25 # Больше не влезает в одно сообщение Telegram (4096 символов)
+
+def fetch_global_hero_stats(min_games, limit):
     """
-    Собирает статистику по топ-10 героям лиги и ищет лучших игроков.
-    min_games - порог для определения "Лучшего игрока".
+    Топ героев лиги и лучший игрок на каждом - одним запросом.
+    Лучший игрок: ROW_NUMBER по герою, порядок KDA -> WR -> победы.
+    None при ошибке БД.
     """
-    conn = get_db_conn()
-    if not conn: return "Ошибка подключения к БД."
-    
-    top_heroes = []
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                # 1. Получаем топ 10 популярных героев (здесь ничего не меняем)
-                cur.execute('''
-                    SELECT 
-                        hero_name,
-                        SUM(wins + losses) AS total_games,
-                        (SUM(CAST(wins AS FLOAT)) / SUM(wins + losses)) * 100 AS winrate,
-                        (CASE 
-                            WHEN SUM(total_deaths) = 0 THEN (SUM(total_kills + total_assists))
-                            ELSE (SUM(CAST(total_kills AS FLOAT) + total_assists)) / SUM(total_deaths)
-                        END) AS kda
-                    FROM player_heroes
-                    WHERE (wins + losses) > 0
-                    GROUP BY hero_name
-                    ORDER BY total_games DESC
-                    LIMIT 10
-                ''')
-                top_heroes = cur.fetchall()
-                
-                if not top_heroes:
-                    return "🦸 Статистика по героям пока пуста. Сыграйте больше игр!"
-                    
-                text = "🦸 <b>ТОП-10 ГЕРОЕВ ЛИГИ</b> 🦸\n" + "=" * 50 + "\n\n"
-                
-                for idx, (hero, games, wr, kda) in enumerate(top_heroes, 1):
-                    # 2. Для каждого героя ищем лучшего игрока
-                    
-                    # ▼▼▼ ИЗМЕНЕННЫЙ ЗАПРОС ▼▼▼
-                    # Теперь он также считает KDA для каждого игрока
-                    # и сортирует СНАЧАЛА по KDA, потом по WR.
+    with db_connection() as conn:
+        if not conn: return None
+        try:
+            with conn:
+                with conn.cursor() as cur:
                     cur.execute('''
+                        WITH top_heroes AS (
+                            SELECT hero_name, total_games, winrate, kda
+                            FROM mv_league_hero_stats
+                            ORDER BY total_games DESC, hero_name
+                            LIMIT %(limit)s
+                        ),
+                        best_players AS (
+                            SELECT 
+                                hero_name,
+                                player_nickname, 
+                                wins, 
+                                losses,
+                                wr AS player_wr,
+                                kda AS player_kda,
+                                ROW_NUMBER() OVER (
+                                    PARTITION BY hero_name
+                                    ORDER BY kda DESC, wr DESC, wins DESC, player_nickname
+                                ) AS place
+                            FROM mv_player_hero_rankings
+                            WHERE hero_name IN (SELECT hero_name FROM top_heroes)
+                              AND games >= %(min_games)s
+                        )
                         SELECT 
-                            player_nickname, 
-                            wins, 
-                            losses,
-                            (CAST(wins AS FLOAT) / (wins + losses)) * 100 AS player_wr,
-                            (CASE 
-                                WHEN total_deaths = 0 THEN (total_kills + total_assists)
-                                ELSE (CAST(total_kills AS FLOAT) + total_assists) / total_deaths
-                            END) AS player_kda
-                        FROM player_heroes
-                        WHERE hero_name = %s AND (wins + losses) >= %s
-                        ORDER BY
-                            player_kda DESC,
-                            player_wr DESC,
-                            wins DESC
-                        LIMIT 1
-                    ''', (hero, min_games))
-                    # ▲▲▲ КОНЕЦ ИЗМЕНЕНИЙ ▲▲▲
-                    
-                    best_player = cur.fetchone()
-                    
-                    text += f"<b>{idx}. {hero}</b>\n"
-                    text += f"    - <b>Игр:</b> {games} | <b>WR:</b> {wr:.1f}% | <b>KDA:</b> {kda:.2f}\n"
-                    
-                    # ▼▼▼ ИЗМЕНЕННЫЙ ВЫВОД ▼▼▼
-                    if best_player:
-                        # Теперь мы получаем 5 значений, включая p_kda
-                        p_nick, p_w, p_l, p_wr, p_kda = best_player 
-                        # Добавляем KDA в строку "Лучший игрок"
-                        text += f"    - <b>Лучший игрок:</b> {p_nick} ({p_w}W-{p_l}L, <b>KDA: {p_kda:.2f}</b>, {p_wr:.1f}% WR)\n\n"
-                    else:
-                        text += f"    - <b>Лучший игрок:</b> (Мало данных)\n\n"
-                    # ▲▲▲ КОНЕЦ ИЗМЕНЕНИЙ ▲▲▲
-                        
-                return text
+                            t.hero_name, t.total_games, t.winrate, t.kda,
+                            b.player_nickname, b.wins, b.losses, b.player_wr, b.player_kda
+                        FROM top_heroes t
+                        LEFT JOIN best_players b ON b.hero_name = t.hero_name AND b.place = 1
+                        ORDER BY t.total_games DESC, t.hero_name
+                    ''', {"min_games": min_games, "limit": limit})
+                    return cur.fetchall()
+        except Exception as e:
+            print(f"Ошибка get_global_hero_stats_text: {e}")
+            return None
 
-    except Exception as e:
-        print(f"Ошибка get_global_hero_stats_text: {e}")
-        return "Ошибка выполнения запроса к БД."
-    finally:
-        put_db_conn(conn)
+def build_global_hero_stats_text(min_games, limit):
+    rows = fetch_global_hero_stats(min_games, limit)
+    if rows is None: return None
+    if not rows:
+        return "🦸 Статистика по героям пока пуста. Сыграйте больше игр!"
+
+    text = f"🦸 <b>ТОП-{limit} ГЕРОЕВ ЛИГИ</b> 🦸\n" + "=" * 50 + "\n\n"
+    for idx, (hero, games, wr, kda, p_nick, p_w, p_l, p_wr, p_kda) in enumerate(rows, 1):
+        text += f"<b>{idx}. {hero}</b>\n"
+        text += f"    - <b>Игр:</b> {games} | <b>WR:</b> {wr:.1f}% | <b>KDA:</b> {kda:.2f}\n"
+        if p_nick is not None:
+            text += f"    - <b>Лучший игрок:</b> {p_nick} ({p_w}W-{p_l}L, <b>KDA: {p_kda:.2f}</b>, {p_wr:.1f}% WR)\n\n"
+        else:
+            text += f"    - <b>Лучший игрок:</b> (Мало данных)\n\n"
+    return text
+
+def get_global_hero_stats_text(min_games=STATSHERO_DEFAULT_MIN_GAMES, limit=STATSHERO_DEFAULT_LIMIT):
+    """
+    Статистика по топ героям лиги с лучшими игроками.
+    min_games - порог для определения "Лучшего игрока", limit - сколько героев.
+    Отчет кэшируется на пару (min_games, limit) до следующей записи в статистику.
+    """
+    text = stats_snapshot_cache.get_or_build(
+        ("statshero", min_games, limit),
+        lambda: build_global_hero_stats_text(min_games, limit)
+    )
+    return text if text is not None else "Ошибка выполнения запроса к БД."
+
+def parse_statshero_args(text):
+    """
+    /statshero [min_games] [limit] -> (min_games, limit) или None, если аргументы кривые.
+    """
+    args = text.split()[1:]
+    if len(args) > 2 or not all(arg.isdigit() for arg in args):
+        return None
+    min_games = int(args[0]) if len(args) > 0 else STATSHERO_DEFAULT_MIN_GAMES
+    limit = int(args[1]) if len(args) > 1 else STATSHERO_DEFAULT_LIMIT
+    if min_games < 1 or not 1 <= limit <= STATSHERO_MAX_LIMIT:
+        return None
+    return min_games, limit
 
 @bot.message_handler(commands=['statshero'])
 def show_global_hero_stats(message):
     log_user_activity(message.from_user.id, message)
-    # Ищем лучшего игрока с мин. 3 играми на герое
-    text = get_global_hero_stats_text(min_games=2) 
+    args = parse_statshero_args(message.text)
+    if args is None:
+        bot.reply_to(message, f"Использование: /statshero [мин. игр на герое] [героев, 1-{STATSHERO_MAX_LIMIT}]\nНапример: /statshero 3 15")
+        return
+    min_games, limit = args
+    text = get_global_hero_stats_text(min_games=min_games, limit=limit)
     try:
         bot.reply_to(message, text)
     except Exception as e:
@@ -2087,97 +3378,228 @@ def show_global_hero_stats(message):
 # ▲▲▲ КОНЕЦ НОВЫХ ФУНКЦИЙ ▲▲▲
 
 
+# ===== ОТКАТ ИГР ПАКЕТОМ =====
+# Откат любой игры или диапазона ID - несколько запросов на всё сразу:
+# разница по каждому игроку, герою и роли считается join'ом games с
+# player_game_stats, блокировки берутся в том же порядке ников, что и при
+# записи игры (record_game), игры удаляются последними (каскадом со статистикой).
+UNDO_MAX_GAMES = 50
+
+def parse_undo_range(text):
+    """'42' -> (42, 42), '40-45' / '40 45' -> (40, 45); None, если ввод кривой."""
+    parts = text.replace("-", " ").split()
+    if not 1 <= len(parts) <= 2 or not all(part.isdigit() for part in parts):
+        return None
+    first_id, last_id = int(parts[0]), int(parts[-1])
+    if first_id > last_id: first_id, last_id = last_id, first_id
+    return first_id, last_id
+
+def build_undo_preview(cur, first_id, last_id):
+    """Текст подтверждения и кнопки для отката игр first_id..last_id."""
+    cur.execute(
+        'SELECT id, radiant_players, dire_players, result, date FROM games WHERE id BETWEEN %s AND %s ORDER BY id',
+        (first_id, last_id))
+    games = cur.fetchall()
+    markup = types.InlineKeyboardMarkup()
+    if not games:
+        markup.add(types.InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin_panel"))
+        return f"❌ Игр с ID {first_id}-{last_id} нет в базе.", markup
+    if len(games) == 1:
+        game_id, radiant, dire, result, date = games[0]
+        text = (f"⚠️ Вы уверены, что хотите отменить игру?\n\n"
+                f"<b>ID Игры:</b> {game_id}\n"
+                f"<b>Дата:</b> {date}\n"
+                f"<b>Команды:</b> {radiant} (🟢) vs {dire} (🔴)\n"
+                f"<b>Победитель:</b> {result.upper()}\n\n"
+                f"Это действие необратимо и откатит весь рейтинг, KDA и W/L всех игроков этой игры.")
+    else:
+        text = f"⚠️ Вы уверены, что хотите отменить <b>{len(games)}</b> игр (ID {games[0][0]}-{games[-1][0]})?\n\n"
+        for game_id, radiant, dire, result, date in games:
+            text += f"<b>{game_id}</b> ({date}): победа {result.upper()}\n"
+        text += "\nЭто действие необратимо и откатит рейтинг, KDA и W/L всех участников одной транзакцией."
+    markup.add(types.InlineKeyboardButton("✅ Да, отменить", callback_data=f"confirm_undo_{games[0][0]}_{games[-1][0]}"))
+    # ▼▼▼ ИСПРАВЛЕНИЕ 3.4: ЗАМЕНА КНОПКИ "ОТМЕНА" ▼▼▼
+    markup.add(types.InlineKeyboardButton("⬅️ Назад", callback_data="back_to_admin_panel"))
+    # ▲▲▲ КОНЕЦ ИСПРАВЛЕНИЯ 3.4 ▲▲▲
+    return text, markup
+
+@bot.message_handler(
+    func=lambda message: user_state.get(message.from_user.id, {}).get("action") == "waiting_undo_games_input")
+def handle_undo_games_input(message):
+    if not is_admin(message.from_user.id): return
+    user_id = message.from_user.id
+    chat_id = message.chat.id
+    undo_range = parse_undo_range(message.text or "")
+    if not undo_range:
+        bot.send_message(chat_id, "❌ Нужен ID или диапазон, например <code>42</code> или <code>40-45</code>")
+        return
+    first_id, last_id = undo_range
+    if last_id - first_id + 1 > UNDO_MAX_GAMES:
+        bot.send_message(chat_id, f"❌ За раз можно отменить не больше {UNDO_MAX_GAMES} игр")
+        return
+    del user_state[user_id]
+    with db_connection() as conn:
+        if not conn:
+            bot.send_message(chat_id, "❌ Ошибка БД")
+            return
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    text, markup = build_undo_preview(cur, first_id, last_id)
+            bot.send_message(chat_id, text, reply_markup=markup)
+        except Exception as e:
+            bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
+
+def undo_games(cur, first_id, last_id):
+    """
+    Откатывает игры first_id..last_id внутри уже открытой транзакции.
+    Возвращает (id откаченных игр, разница по игрокам): разница -
+    (nickname, wins, losses, рейтинг до, рейтинг после, kills, deaths, assists),
+    где wins/losses/kills/... - сколько снято.
+    """
+    # 1. Сами игры: блокируем, чтобы параллельный откат тех же ID ждал нас
+    cur.execute('SELECT id FROM games WHERE id BETWEEN %s AND %s ORDER BY id FOR UPDATE', (first_id, last_id))
+    game_ids = [row[0] for row in cur.fetchall()]
+    if not game_ids: return [], []
+
+    # 2. Игроки: суммы по всем откатываемым играм, одно обновление на всех.
+    # Записанная дельта рейтинга откатывается как есть. Для старых игр (NULL) -
+    # правило прежнего отката: победа снимает RATING_CHANGE, поражение возвращает
+    # RATING_CHANGE, но игроку с рейтингом 0 не возвращает ничего (его могло
+    # обрезать полом 0, и сколько он на самом деле потерял, неизвестно)
+    cur.execute(f'''
+        WITH undo AS (
+            SELECT 
+                s.player_nickname AS nickname,
+                SUM(CASE WHEN s.team = g.result THEN 1 ELSE 0 END) AS wins,
+                SUM(CASE WHEN s.team = g.result THEN 0 ELSE 1 END) AS losses,
+                SUM(s.kills) AS kills, SUM(s.deaths) AS deaths, SUM(s.assists) AS assists,
+                COALESCE(SUM(s.rating_delta), 0) AS rating_delta,
+                SUM(CASE WHEN s.rating_delta IS NULL AND s.team = g.result THEN 1 ELSE 0 END) AS legacy_wins,
+                SUM(CASE WHEN s.rating_delta IS NULL AND s.team = g.result THEN 0
+                         WHEN s.rating_delta IS NULL THEN 1 ELSE 0 END) AS legacy_losses
+            FROM player_game_stats s JOIN games g ON g.id = s.game_id
+            WHERE g.id = ANY(%(game_ids)s)
+            GROUP BY s.player_nickname
+        ),
+        locked AS (
+            SELECT p.nickname, p.rating FROM players p
+            WHERE p.nickname IN (SELECT nickname FROM undo)
+            ORDER BY p.nickname
+            FOR UPDATE
+        )
+        UPDATE players p SET
+            wins = p.wins - u.wins,
+            losses = p.losses - u.losses,
+            rating = GREATEST(0, p.rating - u.rating_delta - u.legacy_wins * {RATING_CHANGE}
+                                 + CASE WHEN l.rating = 0 THEN 0 ELSE u.legacy_losses * {RATING_CHANGE} END),
+            total_kills = p.total_kills - u.kills,
+            total_deaths = p.total_deaths - u.deaths,
+            total_assists = p.total_assists - u.assists
+        FROM undo u JOIN locked l ON l.nickname = u.nickname
+        WHERE p.nickname = u.nickname
+        RETURNING p.nickname, u.wins, u.losses, l.rating, p.rating, u.kills, u.deaths, u.assists
+    ''', {"game_ids": game_ids})
+    diff = sorted(cur.fetchall())
+
+    # 3. Герои и роли - тоже суммами, строки блокируются в порядке ключа
+    cur.execute('''
+        WITH undo AS (
+            SELECT 
+                s.player_nickname AS nickname, s.hero AS hero_name,
+                SUM(CASE WHEN s.team = g.result THEN 1 ELSE 0 END) AS wins,
+                SUM(CASE WHEN s.team = g.result THEN 0 ELSE 1 END) AS losses,
+                SUM(s.kills) AS kills, SUM(s.deaths) AS deaths, SUM(s.assists) AS assists
+            FROM player_game_stats s JOIN games g ON g.id = s.game_id
+            WHERE g.id = ANY(%(game_ids)s)
+            GROUP BY s.player_nickname, s.hero
+        ),
+        locked AS (
+            SELECT ph.player_nickname, ph.hero_name FROM player_heroes ph
+            JOIN undo u ON u.nickname = ph.player_nickname AND u.hero_name = ph.hero_name
+            ORDER BY ph.player_nickname, ph.hero_name
+            FOR UPDATE OF ph
+        )
+        UPDATE player_heroes ph SET
+            wins = ph.wins - u.wins,
+            losses = ph.losses - u.losses,
+            total_kills = ph.total_kills - u.kills,
+            total_deaths = ph.total_deaths - u.deaths,
+            total_assists = ph.total_assists - u.assists
+        FROM undo u JOIN locked l ON l.player_nickname = u.nickname AND l.hero_name = u.hero_name
+        WHERE ph.player_nickname = u.nickname AND ph.hero_name = u.hero_name
+    ''', {"game_ids": game_ids})
+    cur.execute('''
+        WITH undo AS (
+            SELECT 
+                s.player_nickname AS nickname, s.position AS role_position,
+                SUM(CASE WHEN s.team = g.result THEN 1 ELSE 0 END) AS wins,
+                SUM(CASE WHEN s.team = g.result THEN 0 ELSE 1 END) AS losses
+            FROM player_game_stats s JOIN games g ON g.id = s.game_id
+            WHERE g.id = ANY(%(game_ids)s) AND s.position > 0
+            GROUP BY s.player_nickname, s.position
+        ),
+        locked AS (
+            SELECT rs.player_nickname, rs.role_position FROM player_role_stats rs
+            JOIN undo u ON u.nickname = rs.player_nickname AND u.role_position = rs.role_position
+            ORDER BY rs.player_nickname, rs.role_position
+            FOR UPDATE OF rs
+        )
+        UPDATE player_role_stats rs SET
+            wins = rs.wins - u.wins,
+            losses = rs.losses - u.losses
+        FROM undo u JOIN locked l ON l.player_nickname = u.nickname AND l.role_position = u.role_position
+        WHERE rs.player_nickname = u.nickname AND rs.role_position = u.role_position
+    ''', {"game_ids": game_ids})
+
+    # 4. Игры (player_game_stats удалится каскадом)
+    cur.execute('DELETE FROM games WHERE id = ANY(%s)', (game_ids,))
+    return game_ids, diff
+
+def format_undo_diff(game_ids, diff):
+    if len(game_ids) == 1:
+        text = f"✅ <b>ОТКАТ УСПЕШЕН!</b>\n\nИгра <b>ID {game_ids[0]}</b> и вся связанная с ней статистика удалены.\n\n"
+    else:
+        text = (f"✅ <b>ОТКАТ УСПЕШЕН!</b>\n\nОтменено игр: <b>{len(game_ids)}</b> "
+                f"(ID {', '.join(str(game_id) for game_id in game_ids)}).\n\n")
+    if not diff:
+        return text + "Статистики игроков в этих играх не было."
+    text += "<b>Изменения по игрокам:</b>\n"
+    for nickname, wins, losses, rating_before, rating_after, kills, deaths, assists in diff:
+        text += (f"    {nickname}: W/L -{wins}/-{losses} | Рейтинг {rating_before} → {rating_after} "
+                 f"({rating_after - rating_before:+d}) | KDA -{kills}/-{deaths}/-{assists}\n")
+    return text
+
 @bot.callback_query_handler(func=lambda call: call.data.startswith("confirm_undo_"))
 def handle_undo_game_confirmation(call):
     if not is_admin(call.from_user.id):
         try: bot.answer_callback_query(call.id, "❌ Доступ запрещён!", show_alert=True)
         except Exception: pass
         return
-    conn = get_db_conn()
-    if not conn:
-        bot.send_message(call.message.chat.id, "❌ Ошибка БД")
-        return
-    try:
-        bot.answer_callback_query(call.id, "🔄 Начинаю откат...")
-        game_id = int(call.data.replace("confirm_undo_", ""))
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT * FROM games WHERE id=%s", (game_id,))
-                game_data = cur.fetchone()
-                if not game_data:
-                    bot.edit_message_text("❌ Ошибка: Эта игра уже не существует.", call.message.chat.id, call.message.message_id)
-                    return
-                game_columns = [desc[0] for desc in cur.description]
-                game = dict(zip(game_columns, game_data))
-                cur.execute("SELECT * FROM player_game_stats WHERE game_id=%s", (game_id,))
-                stats_data = cur.fetchall()
-                stats_columns = [desc[0] for desc in cur.description]
-                player_stats = [dict(zip(stats_columns, row)) for row in stats_data]
-                if not player_stats:
-                    cur.execute("DELETE FROM games WHERE id = %s", (game_id,))
-                    bot.edit_message_text(f"✅ Игра {game_id} (без статистики) была удалена.", call.message.chat.id, call.message.message_id)
-                    return
-                winners_team = game['result']
-                for p_stat in player_stats:
-                    nickname = p_stat['player_nickname']
-                    hero = p_stat['hero']
-                    kills = p_stat['kills']
-                    deaths = p_stat['deaths']
-                    assists = p_stat['assists']
-                    position = p_stat['position']
-                    team = p_stat['team']
-                    is_winner = (team == winners_team)
-                    win_change = -1 if is_winner else 0
-                    loss_change = 0 if is_winner else -1
-                    rating_change_undo = -RATING_CHANGE if is_winner else RATING_CHANGE
-                    cur.execute("SELECT rating FROM players WHERE nickname=%s FOR UPDATE", (nickname,))
-                    current_rating = cur.fetchone()[0]
-                    new_rating = current_rating + rating_change_undo
-                    if not is_winner:
-                        if current_rating == 0:
-                           original_loss_rating_change = max(0, current_rating - RATING_CHANGE) - current_rating
-                           rating_change_undo = -original_loss_rating_change
-                           new_rating = current_rating + rating_change_undo
-                    new_rating = max(0, new_rating)
-                    cur.execute(
-                        '''UPDATE players SET 
-                                wins = wins + %s, losses = losses + %s, rating = %s, 
-                                total_kills = total_kills - %s, total_deaths = total_deaths - %s, 
-                                total_assists = total_assists - %s
-                           WHERE nickname=%s''',
-                        (win_change, loss_change, new_rating, kills, deaths, assists, nickname)
-                    )
-                    cur.execute(
-                        '''UPDATE player_heroes SET
-                                wins = wins + %s, losses = losses + %s,
-                                total_kills = total_kills - %s,
-                                total_deaths = total_deaths - %s,
-                                total_assists = total_assists - %s
-                           WHERE player_nickname = %s AND hero_name = %s''',
-                        (win_change, loss_change, kills, deaths, assists, nickname, hero)
-                    )
-                    if position > 0:
-                        cur.execute(
-                            '''UPDATE player_role_stats SET
-                                    wins = wins + %s, losses = losses + %s
-                               WHERE player_nickname = %s AND role_position = %s''',
-                            (win_change, loss_change, nickname, position)
-                        )
-                cur.execute("DELETE FROM games WHERE id = %s", (game_id,))
-        bot.edit_message_text(f"✅ <b>ОТКАТ УСПЕШЕН!</b>\n\n"
-                                f"Игра <b>ID {game_id}</b> и вся связанная с ней статистика "
-                                f"были полностью удалены из базы данных.", 
-                                call.message.chat.id, call.message.message_id)
-        print(f"✅✅✅ Транзакция ОТКАТА ИГРЫ {game_id} успешно завершена.")
-        player_cache.invalidate() # <-- ОБНОВЛЯЕМ КЭШ
-    except Exception as e:
-        print(f"❌❌❌ ОШИБКА ОТКАТА ИГРЫ: {e}")
-        import traceback
-        traceback.print_exc()
-        bot.send_message(call.message.chat.id, f"❌ КРИТИЧЕСКАЯ ОШИБКА ПРИ ОТКАТЕ:\n<code>{str(e)}</code>\n\n"
-                                                "🚫 <b>Изменения отменены.</b> База данных в безопасности.")
-    finally:
-        put_db_conn(conn)
+    with db_connection() as conn:
+        if not conn:
+            bot.send_message(call.message.chat.id, "❌ Ошибка БД")
+            return
+        try:
+            bot.answer_callback_query(call.id, "🔄 Начинаю откат...")
+            # confirm_undo_<id> (старые сообщения) или confirm_undo_<первый>_<последний>
+            ids = [int(part) for part in call.data.replace("confirm_undo_", "").split("_")]
+            first_id, last_id = ids[0], ids[-1]
+            with conn:
+                with conn.cursor() as cur:
+                    game_ids, diff = undo_games(cur, first_id, last_id)
+            if not game_ids:
+                bot.edit_message_text("❌ Ошибка: Эти игры уже не существуют.", call.message.chat.id, call.message.message_id)
+                return
+            print(f"✅✅✅ Транзакция ОТКАТА ИГР {game_ids} успешно завершена.")
+            stats_changed([row[0] for row in diff], views=True) # <-- ОБНОВЛЯЕМ КЭШ
+            reply_safely(bot.edit_message_text, format_undo_diff(game_ids, diff), call.message.chat.id, call.message.message_id)
+        except Exception as e:
+            print(f"❌❌❌ ОШИБКА ОТКАТА ИГРЫ: {e}")
+            import traceback
+            traceback.print_exc()
+            bot.send_message(call.message.chat.id, f"❌ КРИТИЧЕСКАЯ ОШИБКА ПРИ ОТКАТЕ:\n<code>{str(e)}</code>\n\n"
+                                                    "🚫 <b>Изменения отменены.</b> База данных в безопасности.")
 # ===== ОБРАБОТЧИКИ ДЛЯ 4 ОТСУТСТВУЮЩИх ФУНКЦИЙ =====
 
 # 1. ИЗМЕНИТЬ РЕЙТИНГ
@@ -2214,22 +3636,21 @@ def handle_set_rating_value(message):
         bot.send_message(chat_id, "❌ Введите число!")
         return
     
-    conn = get_db_conn()
-    if not conn:
-        bot.send_message(chat_id, "❌ Ошибка БД")
-        return
+    with db_connection() as conn:
+        if not conn:
+            bot.send_message(chat_id, "❌ Ошибка БД")
+            return
     
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("UPDATE players SET rating=%s WHERE nickname=%s", (new_rating, nickname))
-        bot.send_message(chat_id, f"✅ Рейтинг {nickname} изменён на {new_rating}!")
-        player_cache.invalidate()
-    except Exception as e:
-        bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
-    finally:
-        put_db_conn(conn)
-        del user_state[user_id]
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("UPDATE players SET rating=%s WHERE nickname=%s", (new_rating, nickname))
+            stats_changed([nickname])
+            reply_safely(bot.send_message, chat_id, f"✅ Рейтинг {nickname} изменён на {new_rating}!")
+        except Exception as e:
+            bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
+        finally:
+            del user_state[user_id]
 
 # 2. ДОБАВИТЬ MMR
 @bot.callback_query_handler(func=lambda call: call.data.startswith("select_for_add_mmr_"))
@@ -2265,22 +3686,21 @@ def handle_add_mmr_value(message):
         bot.send_message(chat_id, "❌ Введите число!")
         return
     
-    conn = get_db_conn()
-    if not conn:
-        bot.send_message(chat_id, "❌ Ошибка БД")
-        return
+    with db_connection() as conn:
+        if not conn:
+            bot.send_message(chat_id, "❌ Ошибка БД")
+            return
     
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("UPDATE players SET mmr=%s WHERE nickname=%s", (new_mmr, nickname))
-        bot.send_message(chat_id, f"✅ MMR {nickname} установлен на {new_mmr}!")
-        player_cache.invalidate()
-    except Exception as e:
-        bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
-    finally:
-        put_db_conn(conn)
-        del user_state[user_id]
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("UPDATE players SET mmr=%s WHERE nickname=%s", (new_mmr, nickname))
+            stats_changed([nickname])
+            reply_safely(bot.send_message, chat_id, f"✅ MMR {nickname} установлен на {new_mmr}!")
+        except Exception as e:
+            bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
+        finally:
+            del user_state[user_id]
 
 # 3. УСТАНОВИТЬ ПОЗИЦИИ
 @bot.callback_query_handler(func=lambda call: call.data.startswith("select_for_set_positions_"))
@@ -2351,25 +3771,24 @@ def confirm_positions(call):
     try: bot.answer_callback_query(call.id)
     except Exception: pass
     
-    conn = get_db_conn()
-    if not conn:
-        bot.send_message(chat_id, "❌ Ошибка БД")
-        return
+    with db_connection() as conn:
+        if not conn:
+            bot.send_message(chat_id, "❌ Ошибка БД")
+            return
     
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                positions_json = json.dumps(sorted(selected_positions))
-                cur.execute("UPDATE players SET positions=%s WHERE nickname=%s", (positions_json, nickname))
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    positions_json = json.dumps(sorted(selected_positions))
+                    cur.execute("UPDATE players SET positions=%s WHERE nickname=%s", (positions_json, nickname))
+            stats_changed([nickname])
         
-        pos_str = get_player_positions_str(selected_positions)
-        bot.edit_message_text(f"✅ Предпочитаемые позиции {nickname} установлены:\n{pos_str}", chat_id, call.message.message_id)
-        player_cache.invalidate()
-    except Exception as e:
-        bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
-    finally:
-        put_db_conn(conn)
-        del user_state[user_id]
+            pos_str = get_player_positions_str(selected_positions)
+            reply_safely(bot.edit_message_text, f"✅ Предпочитаемые позиции {nickname} установлены:\n{pos_str}", chat_id, call.message.message_id)
+        except Exception as e:
+            bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
+        finally:
+            del user_state[user_id]
 
 # ▼▼▼ ИСПРАВЛЕНИЕ 3.5: УДАЛЕНИЕ СТАРОЙ ФУНКЦИИ ОТМЕНЫ ▼▼▼
 # @bot.callback_query_handler(func=lambda call: call.data == "cancel_set_positions")
@@ -2408,23 +3827,21 @@ def confirm_delete_player(call):
     try: bot.answer_callback_query(call.id)
     except Exception: pass
     
-    conn = get_db_conn()
-    if not conn:
-        bot.send_message(chat_id, "❌ Ошибка БД")
-        return
+    with db_connection() as conn:
+        if not conn:
+            bot.send_message(chat_id, "❌ Ошибка БД")
+            return
     
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("DELETE FROM players WHERE nickname=%s", (nickname,))
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("DELETE FROM players WHERE nickname=%s", (nickname,))
+            stats_changed([nickname], views=True)
         
-        bot.edit_message_text(f"✅ Игрок {nickname} удалён!", chat_id, call.message.message_id)
-        player_cache.invalidate()
-    except Exception as e:
-        print(f"❌ Ошибка удаления: {e}")
-        bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
-    finally:
-        put_db_conn(conn)
+            reply_safely(bot.edit_message_text, f"✅ Игрок {nickname} удалён!", chat_id, call.message.message_id)
+        except Exception as e:
+            print(f"❌ Ошибка удаления: {e}")
+            bot.send_message(chat_id, f"❌ Ошибка: {str(e)}")
 
 # ===== КОНЕЦ ОБРАБОТЧИКОВ =====
 # ===== ГЛАВНЫЙ ЦИКЛ (НОВАЯ ВЕРСИЯ ДЛЯ RENDER/GUNICORN) =====
@@ -2446,7 +3863,7 @@ def run_bot_polling():
                 print(f"🔥🔥🔥 Ошибка при остановке polling: {e2}")
             time.sleep(10)
 
-if __name__ != "__main__":
+if __name__ != "__main__" and not IS_BALANCE_WORKER:
     print("🌀 [MAIN] Запуск потока для bot.polling()...")
     t_bot = Thread(target=run_bot_polling)
     t_bot.daemon = True
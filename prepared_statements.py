@@ -0,0 +1,126 @@
+# =========================================================================
+# ========== ПОДГОТОВЛЕННЫЕ ЗАПРОСЫ (PREPARE / EXECUTE) ==========
+# =========================================================================
+#
+# Горячие запросы бота (профиль, лидерборд, журнал активности...) каждый
+# раз разбирались и планировались Postgres заново. Здесь реестр именованных
+# запросов: на каждом соединении запрос готовится (PREPARE) при первом
+# вызове, дальше идет только EXECUTE. Какие запросы уже готовы, помнит само
+# соединение (PreparedConnection), поэтому после переподключения (новое
+# соединение в пуле) всё подготовится заново само.
+#
+# Без БД-зависимостей от main.py: модуль используют и бот, и bench_prepared.py.
+
+import psycopg2.errors
+import psycopg2.extensions
+
+# имя -> SQL в формате psycopg2 (%s); для PREPARE %s превращаются в $1, $2...
+PREPARED_STATEMENTS = {
+    # Лидерборд: все игроки в порядке рейтинга, затем KDA и WR
+    "leaderboard_rows": '''
+        SELECT
+            nickname, rating, wins, losses,
+            (CASE
+                WHEN (wins + losses) = 0 THEN 0
+                ELSE (CAST(wins AS FLOAT) / (wins + losses)) * 100
+            END) AS wr,
+            (CASE
+                WHEN total_deaths = 0 THEN (total_kills + total_assists)
+                ELSE (CAST(total_kills AS FLOAT) + total_assists) / total_deaths
+            END) AS kda
+        FROM players
+        ORDER BY
+            rating DESC,
+            kda DESC,
+            wr DESC
+    ''',
+    # Профили (get_players_stats): основные данные, роли, топ героев
+    "player_rows": '''
+        SELECT nickname, rating, wins, losses, mmr, positions, total_kills, total_deaths, total_assists
+        FROM players WHERE nickname = ANY(%s::text[])
+    ''',
+    "player_role_rows": '''
+        SELECT player_nickname, role_position, wins, losses FROM player_role_stats
+        WHERE player_nickname = ANY(%s::text[]) ORDER BY player_nickname, role_position
+    ''',
+    "player_top_heroes": '''
+        SELECT player_nickname, hero_name, wins, losses, total_kills, total_deaths, total_assists
+        FROM mv_player_hero_rankings
+        WHERE player_nickname = ANY(%s::text[]) AND hero_rank <= %s::int
+        ORDER BY player_nickname, hero_rank
+    ''',
+    # get_top_heroes / get_role_stats (один игрок)
+    "top_heroes": '''
+        SELECT hero_name, wins, losses, total_kills, total_deaths, total_assists
+        FROM mv_player_hero_rankings
+        WHERE player_nickname = %s::text AND hero_rank <= %s::int
+        ORDER BY hero_rank
+    ''',
+    "role_stats": '''
+        SELECT role_position, wins, losses
+        FROM mv_role_stats
+        WHERE player_nickname = %s::text
+        ORDER BY role_position
+    ''',
+    # Журнал активности: пачка любого размера - те же 7 массивов, поэтому запрос один
+    "activity_upsert": '''
+        INSERT INTO user_activity (user_id, username, first_name, last_name, first_visit, last_visit, total_commands)
+        SELECT * FROM unnest(%s::bigint[], %s::text[], %s::text[], %s::text[], %s::text[], %s::text[], %s::int[])
+        ON CONFLICT (user_id) DO UPDATE SET
+            last_visit = EXCLUDED.last_visit,
+            total_commands = user_activity.total_commands + EXCLUDED.total_commands
+    ''',
+}
+
+
+def _numbered(sql):
+    """'... %s ... %s' -> '... $1 ... $2' для PREPARE."""
+    parts = sql.split("%s")
+    return "".join(part + (f"${i}" if i < len(parts) else "") for i, part in enumerate(parts, 1))
+
+
+PREPARED_SQL = {name: (sql, _numbered(sql), sql.count("%s")) for name, sql in PREPARED_STATEMENTS.items()}
+
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """Соединение, которое помнит, какие запросы на нем уже подготовлены."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        # True после InvalidSqlStatementName: набор надо сверить с сервером
+        self.prepared_stale = False
+
+
+def execute_prepared(cur, name, params=()):
+    """
+    Выполняет запрос из реестра через EXECUTE (при первом вызове на этом
+    соединении сначала PREPARE). На обычном соединении (не PreparedConnection)
+    просто выполняет тот же SQL, так что вызывающему коду всё равно.
+    """
+    sql, numbered_sql, param_count = PREPARED_SQL[name]
+    prepared = getattr(cur.connection, "prepared", None)
+    if prepared is None:
+        cur.execute(sql, params)
+        return
+    if cur.connection.prepared_stale:
+        # Что реально осталось в сессии после сброса. Просто забыть всё нельзя:
+        # выжившие запросы упадут на повторном PREPARE (DuplicatePreparedStatement)
+        cur.execute("SELECT name FROM pg_prepared_statements")
+        prepared.clear()
+        prepared.update(row[0] for row in cur.fetchall())
+        cur.connection.prepared_stale = False
+    if name not in prepared:
+        cur.execute(f"PREPARE {name} AS {numbered_sql}")
+        prepared.add(name)
+    try:
+        if param_count:
+            cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * param_count)})", params)
+        else:
+            cur.execute(f"EXECUTE {name}")
+    except psycopg2.errors.InvalidSqlStatementName:
+        # Сессию сбросили (DISCARD ALL, пулер на стороне БД). Текущая транзакция
+        # уже прервана, поэтому сверка с сервером - при следующем вызове.
+        prepared.discard(name)
+        cur.connection.prepared_stale = True
+        raise
@@ -0,0 +1,47 @@
+# Ветви и границы и numpy-перебор должны отвечать ровно как полный перебор:
+# тот же лучший счет, та же сторона (radiant) и те же K альтернатив.
+# Запуск:  python -m pytest -q tests
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import balancer  # noqa: E402
+from bench_balancer import MMR_DISTRIBUTIONS, ROLE_PATTERNS, WR_DISTRIBUTIONS, make_roster  # noqa: E402
+
+SIZES = (4, 5, 6, 8, 10)
+SEEDS = range(6)
+
+
+def _rosters():
+    for size in SIZES:
+        for seed in SEEDS:
+            for mmr in MMR_DISTRIBUTIONS:
+                for wr in WR_DISTRIBUTIONS:
+                    for roles in ROLE_PATTERNS:
+                        yield make_roster(size, seed, mmr, wr, roles)
+
+
+def _signature(result):
+    """[(счет, ники radiant)] всех альтернатив; счет округлен от шума сложения float."""
+    return [(round(alt["score"], 6), tuple(p["nickname"] for p in alt["radiant"]))
+            for alt in result["alternatives"]]
+
+
+@pytest.mark.parametrize("top_k", [1, 3])
+def test_branch_and_bound_matches_brute_force(top_k):
+    for roster in _rosters():
+        expected = balancer.balance_brute_force(roster, top_k=top_k)
+        result = balancer.balance_branch_and_bound(roster, time_budget=None, top_k=top_k)
+        assert result["exact"]
+        assert _signature(result) == _signature(expected), [p["nickname"] for p in roster]
+
+
+@pytest.mark.skipif(balancer.np is None, reason="numpy не установлен")
+def test_numpy_matches_brute_force():
+    for roster in _rosters():
+        expected = balancer.balance_brute_force(roster, top_k=3)
+        assert _signature(balancer.balance_numpy(roster, top_k=3)) == _signature(expected)